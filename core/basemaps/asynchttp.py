@@ -0,0 +1,234 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import ssl
+import time
+import asyncio
+import email.message
+import urllib.request
+import urllib.error
+import urllib.parse
+
+from .httppool import useProxy
+
+
+class AsyncConnectionPool():
+    """
+    Minimal asyncio http/1.1 client with per-host keep-alive connections
+
+    Only GET requests are supported, this is all we need to fetch tiles.
+    Stream objects are bound to the event loop which has created them, so an instance
+    must be used by a single event loop and closed with aclose() before this loop ends.
+
+    maxsize : maximum number of idle connections kept per host
+    idleTimeout : idle connections older than this delay (in seconds) are closed instead of being reused
+    """
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    def __init__(self, maxsize=100, idleTimeout=30):
+        self.maxsize = maxsize
+        self.idleTimeout = idleTimeout
+        self.idle = {} # {(scheme, host, port) : [(reader, writer, last used timestamp)]}
+        self._ssl = None
+        #stats
+        self.nbCreated = 0
+        self.nbReused = 0
+        self.nbRequests = 0
+
+    @property
+    def stats(self):
+        return {
+            'requests' : self.nbRequests,
+            'created' : self.nbCreated,
+            'reused' : self.nbReused,
+            'reuseRatio' : self.nbReused / self.nbRequests if self.nbRequests else 0
+        }
+
+    async def _open(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self.nbCreated += 1
+        return reader, writer
+
+    async def _get(self, key):
+        now = time.time()
+        conns = self.idle.get(key, [])
+        while conns:
+            reader, writer, lastUsed = conns.pop()
+            if now - lastUsed > self.idleTimeout or reader.at_eof():
+                writer.close()
+                continue
+            self.nbReused += 1
+            return reader, writer, True
+        reader, writer = await self._open(key)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.maxsize:
+            conns.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    async def aclose(self):
+        '''Close all idle connections'''
+        writers = [writer for conns in self.idle.values() for reader, writer, lastUsed in conns]
+        self.idle = {}
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    @staticmethod
+    async def _readResponse(reader):
+        '''Parse status line, headers and body of an http response, return (status, reason, headers, data, keepAlive)'''
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed by remote host')
+        version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        headers = email.message.Message()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            headers[k.strip()] = v.strip()
+
+        connHeader = (headers.get('Connection') or '').lower()
+        if version == 'HTTP/1.1':
+            keepAlive = connHeader != 'close'
+        else:
+            keepAlive = connHeader == 'keep-alive'
+
+        if status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    #skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline() #chunk CRLF
+            data = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            data = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            data = await reader.read()
+            keepAlive = False
+
+        return status, reason, headers, data, keepAlive
+
+    async def _send(self, key, path, headers):
+        reader, writer, reused = await self._get(key)
+        scheme, host, port = key
+        hostHeader = host if port in (80, 443) else host + ':' + str(port)
+        lines = ['GET ' + path + ' HTTP/1.1', 'Host: ' + hostHeader]
+        lines.extend([k + ': ' + str(v) for k, v in headers.items() if k.lower() != 'host'])
+        rq = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        try:
+            writer.write(rq)
+            await writer.drain()
+            resp = await self._readResponse(reader)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            if not reused:
+                raise
+            #the server has closed this idle connection, retry once with a fresh one
+            log.debug('Stale keep-alive connection to {}, reconnecting'.format(host))
+            reader, writer = await self._open(key)
+            try:
+                writer.write(rq)
+                await writer.drain()
+                resp = await self._readResponse(reader)
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            #including cancellation (timeout), the connection state is unknown
+            writer.close()
+            raise
+
+        keepAlive = resp[4]
+        if keepAlive:
+            self._release(key, reader, writer)
+        else:
+            writer.close()
+        return resp
+
+    async def request(self, url, headers={}, timeout=None):
+        """
+        Perform a GET request and return the bytes of the response body
+        Like urlopen(), raise a urllib HTTPError for http error status (>= 400)
+        and asyncio.TimeoutError if the request is not completed before timeout
+        """
+        return await asyncio.wait_for(self._request(url, headers, timeout), timeout)
+
+    async def _request(self, url, headers, timeout=None):
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme not in ('http', 'https') or useProxy(url):
+            #let urllib handle proxies and exotic schemes in a thread
+            #the socket timeout is required, wait_for() can't interrupt the thread
+            def urlopen():
+                req = urllib.request.Request(url, None, headers)
+                with urllib.request.urlopen(req, timeout=timeout) as handle:
+                    return handle.read()
+            self.nbRequests += 1
+            return await asyncio.get_running_loop().run_in_executor(None, urlopen)
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            status, reason, respHeaders, data, keepAlive = await self._send(key, path, headers)
+            self.nbRequests += 1
+
+            if status in self.REDIRECT_CODES and respHeaders.get('Location'):
+                url = urllib.parse.urljoin(url, respHeaders['Location'])
+                continue
+
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, respHeaders, None)
+
+            return data
+
+        raise urllib.error.HTTPError(url, status, 'Too many redirections', respHeaders, None)
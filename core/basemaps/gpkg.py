@@ -22,8 +22,11 @@ log = logging.getLogger(__name__)
 import os
 import io
 import math
+import queue
 import datetime
+import threading
 import sqlite3
+import urllib.request
 
 
 #http://www.geopackage.org/spec/#tiles
@@ -34,10 +37,163 @@ import sqlite3
 #table_name refer to the name of the table witch contains tiles data
 #here for simplification, table_name will always be named "gpkg_tiles"
 
+
+class GpkgConnections():
+    '''
+    Manage the sqlite connections to a geopackage file
+    * each thread gets its own persistent read-only connection
+    * all writes go through a queue and share the only write connection. The calling thread that
+    gets the write lock commits its own write together with all the writes queued meanwhile
+    in one transaction, there is no hand off to a writer thread.
+    The database is switched to WAL journaling so that readers never wait for the writer.
+
+    A single manager is shared by all GeoPackage objects pointing to the same file, use get()
+    '''
+
+    _managers = {}
+    _managersLock = threading.Lock()
+
+    BUSY_TIMEOUT = 30 #seconds
+    MAX_BATCH = 200 #maximum number of queued writes committed in one transaction
+
+    @classmethod
+    def get(cls, path, synchronous='NORMAL'):
+        path = os.path.abspath(path)
+        with cls._managersLock:
+            manager = cls._managers.get(path)
+            if manager is None:
+                manager = cls(path, synchronous)
+                cls._managers[path] = manager
+            return manager
+
+    def __init__(self, path, synchronous='NORMAL'):
+        if synchronous not in ['OFF', 'NORMAL', 'FULL', 'EXTRA']:
+            raise ValueError('Invalid sqlite synchronous level ' + str(synchronous))
+        self.path = path
+        self.synchronous = synchronous
+        self.lock = threading.Lock()
+        self.readers = {} # {thread ident : (thread, connection)}
+        self.jobs = queue.Queue()
+        self.writeLock = threading.Lock()
+        self.writerConn = None
+        #stats
+        self.nbWrites = 0
+        self.nbCommits = 0
+
+    ############################################
+    # Readers
+
+    def reader(self):
+        '''Return the read-only connection of the calling thread'''
+        thread = threading.current_thread()
+        with self.lock:
+            item = self.readers.get(thread.ident)
+            if item is not None and item[0] is thread:
+                return item[1]
+            #close connections of terminated threads
+            for ident, (t, conn) in list(self.readers.items()):
+                if not t.is_alive():
+                    conn.close()
+                    del self.readers[ident]
+        uri = 'file:' + urllib.request.pathname2url(self.path) + '?mode=ro'
+        #check_same_thread is disabled only to let close() release connections of others threads
+        #autocommit mode (isolation_level=None), a pending read transaction would freeze the WAL snapshot
+        conn = sqlite3.connect(uri, uri=True, timeout=self.BUSY_TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.readers[thread.ident] = (thread, conn)
+        return conn
+
+    ############################################
+    # Writer
+
+    def _connectWriter(self):
+        #the write connection is used by whichever thread holds the write lock
+        conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=' + self.synchronous)
+        return conn
+
+    def _drain(self, done):
+        '''
+        Commit the queued writes by batches of MAX_BATCH jobs until the job flagged by done is committed
+        Must be called with the write lock held. Jobs queued after ours belong to threads waiting
+        for the lock, they will commit them
+        '''
+        if self.writerConn is None:
+            self.writerConn = self._connectWriter()
+        conn = self.writerConn
+        while not done.is_set():
+            batch = []
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                #isolate the faulty job
+                for job in batch:
+                    try:
+                        self._commit(conn, [job])
+                    except Exception as e:
+                        job[3].append(e)
+            for job in batch:
+                job[2].set()
+
+    def _commit(self, conn, batch):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for query, params, done, errors in batch:
+                if isinstance(params, list):
+                    conn.executemany(query, params)
+                else:
+                    conn.execute(query, params)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.nbCommits += 1
+        self.nbWrites += len(batch)
+
+    def write(self, query, params=()):
+        '''
+        Queue a write query and wait until it is committed
+        params is a tuple of parameters or a list of tuples to execute the query many times
+        '''
+        done, errors = threading.Event(), []
+        self.jobs.put( (query, params, done, errors) )
+        with self.writeLock:
+            #the previous lock holder may have committed our job along with its own
+            if not done.is_set():
+                self._drain(done)
+        if errors:
+            raise errors[0]
+
+    ############################################
+
+    def close(self):
+        '''Close all connections, they will be reopen on demand'''
+        #close readers first, so that the writer is the last connection and can checkpoint the WAL file
+        with self.lock:
+            readers, self.readers = self.readers, {}
+        for t, conn in readers.values():
+            conn.close()
+        with self.writeLock:
+            if self.writerConn is not None:
+                self.writerConn.close()
+                self.writerConn = None
+
+
+
 class GeoPackage():
 
     MAX_DAYS = 90
 
+    # sqlite synchronous level of the cache database: 'OFF', 'NORMAL', 'FULL' or 'EXTRA'
+    # In WAL mode, NORMAL is safe against corruption and much faster than FULL
+    SYNCHRONOUS = 'NORMAL'
+
     def __init__(self, path, tm):
         self.dbPath = path
         self.name = os.path.splitext(os.path.basename(path))[0]
@@ -59,6 +215,13 @@ class GeoPackage():
 
             self.insertTileMatrixSet()
 
+        self.connections = GpkgConnections.get(self.dbPath, self.SYNCHRONOUS)
+
+        #failures table is not part of the gpkg schema, also add it to databases created by older versions
+        self.createFailuresTable()
+
+    def close(self):
+        self.connections.close()
 
     def isGPKG(self):
         if not os.path.exists(self.dbPath):
@@ -164,6 +327,31 @@ class GeoPackage():
         db.close()
 
 
+    def createFailuresTable(self):
+        """
+        Create the table used to remember the tiles that could not be downloaded
+        retry_after is a julian day, before this date the tile is not requested again.
+        A trigger removes the failure record as soon as valid data is inserted for this tile
+        """
+        self.connections.write("""
+            CREATE TABLE IF NOT EXISTS bgis_failed_tiles (
+                zoom_level INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                retry_after REAL NOT NULL,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID
+        """)
+        self.connections.write("""
+            CREATE TRIGGER IF NOT EXISTS bgis_failed_tiles_clear
+            AFTER INSERT ON gpkg_tiles
+            BEGIN
+                DELETE FROM bgis_failed_tiles WHERE zoom_level = NEW.zoom_level
+                AND tile_column = NEW.tile_column AND tile_row = NEW.tile_row;
+            END
+        """)
+
+
     def insertMetadata(self):
         db = sqlite3.connect(self.dbPath)
         query = """INSERT INTO gpkg_contents (
@@ -229,11 +417,10 @@ class GeoPackage():
 
     def getTile(self, x, y, z):
         '''return tilde_data if tile exists otherwie return None'''
-        #connect with detect_types parameter for automatically convert date to Python object
-        db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
+        #reader connection use detect_types parameter for automatically convert date to Python object
+        db = self.connections.reader()
         query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
         result = db.execute(query, (z, x, y)).fetchone()
-        db.close()
         if result is None:
             return None
         timeDelta = datetime.datetime.now() - result[1]
@@ -242,80 +429,86 @@ class GeoPackage():
         return result[0]
 
     def putTile(self, x, y, z, data):
-        db = sqlite3.connect(self.dbPath)
         query = """INSERT OR REPLACE INTO gpkg_tiles
         (tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-        db.execute(query, (x, y, z, data))
-        db.commit()
-        db.close()
+        self.connections.write(query, (x, y, z, data))
 
 
-    def listExistingTiles(self, tiles):
+    def _queryTiles(self, table, columns, tiles, where, params=()):
         """
-        input : tiles list [(x,y,z)]
-        output : tiles list set [(x,y,z)] of existing records in cache db"""
-
-        db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-
-        # split out the axises
-        x, y, z = zip(*tiles)
+        Select the requested columns of exactly the submited tiles (x,y,z) that exist in the table
+        The tiles indices are loaded in a temporary table joined with the requested table through its
+        unique index, so sparse or multi zoom requests don't read unrequested rows.
+        """
+        if not tiles:
+            return []
+
+        db = self.connections.reader()
+        db.execute("""CREATE TEMP TABLE IF NOT EXISTS tiles_request (
+            zoom_level INTEGER NOT NULL,
+            tile_column INTEGER NOT NULL,
+            tile_row INTEGER NOT NULL,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+
+        #CROSS JOIN force sqlite to iterate over the request table and probe the tiles index
+        query = "SELECT " + ', '.join(['t.' + c for c in columns]) + " " \
+                "FROM tiles_request AS r CROSS JOIN " + table + " AS t " \
+                "ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+                "WHERE " + where
+
+        db.execute('BEGIN')
+        try:
+            db.execute("DELETE FROM tiles_request")
+            db.executemany("INSERT OR IGNORE INTO tiles_request VALUES (?,?,?)", [(z, x, y) for x, y, z in tiles])
+            result = db.execute(query, params).fetchall()
+            db.execute("DELETE FROM tiles_request")
+        finally:
+            db.execute('COMMIT')
 
-        query = "SELECT tile_column, tile_row, zoom_level FROM gpkg_tiles " \
-                "WHERE julianday() - julianday(last_modified) < ?" \
-                "AND zoom_level BETWEEN ? AND ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+        return result
 
-        result = db.execute(
-            query,
-            (
-                GeoPackage.MAX_DAYS,
-                min(z), max(z),
-                min(x), max(x),
-                min(y), max(y)
-            )
-        ).fetchall()
+    def _queryValidTiles(self, columns, tiles):
+        where = "julianday() - julianday(t.last_modified) < ?"
+        return self._queryTiles('gpkg_tiles', columns, tiles, where, (GeoPackage.MAX_DAYS,))
 
-        db.close()
+    def listExistingTiles(self, tiles):
+        """
+        input : tiles list [(x,y,z)]
+        output : tiles list set [(x,y,z)] of existing records in cache db"""
+        result = self._queryValidTiles(['tile_column', 'tile_row', 'zoom_level'], tiles)
+        return set(result)
 
+    def listFailedTiles(self, tiles):
+        """
+        input : tiles list [(x,y,z)]
+        output : tiles list set [(x,y,z)] of tiles whose download has failed and must not be retried yet"""
+        result = self._queryTiles('bgis_failed_tiles', ['tile_column', 'tile_row', 'zoom_level'], tiles, "t.retry_after > julianday()")
         return set(result)
 
     def listMissingTiles(self, tiles):
+        """Tiles that are neither in cache nor recently failed"""
         existing = self.listExistingTiles(tiles)
-        return set(tiles) - existing # difference
+        failed = self.listFailedTiles(tiles)
+        return set(tiles) - existing - failed # difference
 
 
     def getTiles(self, tiles):
         """tiles = list of (x,y,z) tuple
         return list of (x,y,z,data) tuple"""
-
-        db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-
-        # split out the axises
-        x, y, z = zip(*tiles)
-
-        query = "SELECT tile_column, tile_row, zoom_level, tile_data FROM gpkg_tiles " \
-                "WHERE julianday() - julianday(last_modified) < ?" \
-                "AND zoom_level BETWEEN ? AND ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
-
-        result = db.execute(
-            query,
-            (
-                GeoPackage.MAX_DAYS,
-                min(z), max(z),
-                min(x), max(x),
-                min(y), max(y)
-            )
-        ).fetchall()
-
-        db.close()
-
-        return result
+        return self._queryValidTiles(['tile_column', 'tile_row', 'zoom_level', 'tile_data'], tiles)
 
 
     def putTiles(self, tiles):
         """tiles = list of (x,y,z,data) tuple"""
-        db = sqlite3.connect(self.dbPath)
         query = """INSERT OR REPLACE INTO gpkg_tiles
         (tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-        db.executemany(query, tiles)
-        db.commit()
-        db.close()
+        self.connections.write(query, list(tiles))
+
+
+    def putFailures(self, failures):
+        """
+        failures = list of (x,y,z,reason,ttl) tuple
+        ttl is the delay in seconds before the tile can be requested again"""
+        query = """INSERT OR REPLACE INTO bgis_failed_tiles
+        (tile_column, tile_row, zoom_level, reason, retry_after) VALUES (?,?,?,?,julianday() + ? / 86400.0)"""
+        self.connections.write(query, list(failures))
@@ -0,0 +1,247 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import socket
+import threading
+import http.client
+import urllib.request
+import urllib.error
+import urllib.parse
+
+
+def useProxy(url):
+    '''Flag if urllib would send this request through a proxy, hosts listed in no_proxy are reached directly'''
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in urllib.request.getproxies():
+        return False
+    return not urllib.request.proxy_bypass(parts.hostname or '')
+
+
+class RequestCanceled(Exception):
+    pass
+
+
+class CancelToken():
+    '''
+    Let another thread abort a request sent by ConnectionPool.request(), the socket of the request
+    is shut down so that the thread blocked on it gets an error right away
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.canceled = False
+        self.conn = None
+
+    def attach(self, conn):
+        '''Register the connection used by the request, raise RequestCanceled if the token is already canceled'''
+        with self.lock:
+            if self.canceled:
+                raise RequestCanceled()
+            self.conn = conn
+
+    def detach(self):
+        '''Unregister the connection, return False if the request has been canceled meanwhile'''
+        with self.lock:
+            self.conn = None
+            return not self.canceled
+
+    def cancel(self):
+        with self.lock:
+            self.canceled = True
+            conn, self.conn = self.conn, None
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ConnectionPool():
+    """
+    Thread safe pool of persistent (keep-alive) http connections, grouped by host
+
+    urlopen() opens a new socket (and so a new TCP and TLS handshake) for each request,
+    this pool keeps the sockets opened after a request and reuses them for the next requests
+    targeting the same host. The pool is designed to be shared by all the threads of a seeding
+    process and across successive requests.
+
+    maxsize : maximum number of idle connections kept per host
+    idleTimeout : idle connections older than this delay (in seconds) are closed instead of being reused
+    """
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    def __init__(self, maxsize=10, idleTimeout=30):
+        self.maxsize = maxsize
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Lock()
+        self.idle = {} # {(scheme, host, port) : [(connection, last used timestamp)]}
+        #stats
+        self.nbCreated = 0
+        self.nbReused = 0
+        self.nbDiscarded = 0
+        self.nbRequests = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            nbIdle = sum([len(conns) for conns in self.idle.values()])
+            return {
+                'requests' : self.nbRequests,
+                'created' : self.nbCreated,
+                'reused' : self.nbReused,
+                'discarded' : self.nbDiscarded,
+                'idle' : nbIdle,
+                'reuseRatio' : self.nbReused / self.nbRequests if self.nbRequests else 0
+            }
+
+    def resetStats(self):
+        with self.lock:
+            self.nbCreated, self.nbReused, self.nbDiscarded, self.nbRequests = 0, 0, 0, 0
+
+    def _newConnection(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        with self.lock:
+            self.nbCreated += 1
+        return conn
+
+    def _getConnection(self, key, timeout):
+        '''Pop the most recently used idle connection for this host or create a new one'''
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                conn, lastUsed = conns.pop()
+                if now - lastUsed > self.idleTimeout:
+                    conn.close()
+                    self.nbDiscarded += 1
+                    continue
+                self.nbReused += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self._newConnection(key, timeout), False
+
+    def _releaseConnection(self, key, conn):
+        '''Put back a connection in the pool, or close it if the pool is full'''
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append((conn, time.time()))
+                return
+            self.nbDiscarded += 1
+        conn.close()
+
+    def clear(self):
+        '''Close all idle connections'''
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, lastUsed in conns:
+                    conn.close()
+            self.idle = {}
+
+    def _urlopen(self, url, headers, timeout):
+        '''Fallback for requests the pool can't handle (proxy, unsupported scheme)'''
+        req = urllib.request.Request(url, None, headers)
+        handle = urllib.request.urlopen(req, timeout=timeout)
+        data = handle.read()
+        handle.close()
+        with self.lock:
+            self.nbRequests += 1
+        return data
+
+    def _send(self, conn, path, headers, cancel):
+        if cancel is not None:
+            #connect now, the token needs the socket to abort the request
+            if conn.sock is None:
+                conn.connect()
+            cancel.attach(conn)
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+    def request(self, url, headers={}, timeout=None, cancel=None):
+        """
+        Perform a GET request and return the bytes of the response body
+        Like urlopen(), raise a urllib HTTPError for http error status (>= 400)
+        cancel : optional CancelToken, the request raises RequestCanceled once the token is canceled.
+        Not supported by the urlopen() fallback (proxy), the request then runs to its end
+        """
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme not in ('http', 'https') or useProxy(url):
+            return self._urlopen(url, headers, timeout)
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            conn, reused = self._getConnection(key, timeout)
+            try:
+                try:
+                    resp = self._send(conn, path, headers, cancel)
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.BadStatusLine) as e:
+                    conn.close()
+                    if not reused or (cancel is not None and cancel.canceled):
+                        raise
+                    #the server has closed this idle connection, retry once with a fresh one
+                    log.debug('Stale keep-alive connection to {}, reconnecting'.format(key[1]))
+                    conn = self._newConnection(key, timeout)
+                    resp = self._send(conn, path, headers, cancel)
+                #the body must be fully read before reusing the connection
+                data = resp.read()
+            except Exception:
+                conn.close()
+                if cancel is not None and not cancel.detach():
+                    raise RequestCanceled()
+                raise
+
+            with self.lock:
+                self.nbRequests += 1
+
+            #a canceled connection may have been shut down after the response was read, it can't be reused
+            canceled = cancel is not None and not cancel.detach()
+            if resp.will_close or canceled:
+                conn.close()
+            else:
+                self._releaseConnection(key, conn)
+
+            if resp.status in self.REDIRECT_CODES and resp.getheader('Location'):
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+            return data
+
+        raise urllib.error.HTTPError(url, resp.status, 'Too many redirections', resp.headers, None)
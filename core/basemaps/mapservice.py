@@ -24,30 +24,80 @@ log = logging.getLogger(__name__)
 import math
 import threading
 import queue
+import asyncio
+import concurrent.futures
 import time
 import urllib.request
+import urllib.error
 import imghdr
 import sys, time, os
 
+import numpy as np
+
 #core imports
 from .servicesDefs import GRIDS, SOURCES
 from .gpkg import GeoPackage
-from ..georaster import NpImage, GeoRef, BigTiffWriter
+from .httppool import ConnectionPool
+from .asynchttp import AsyncConnectionPool
+from .memcache import TileLRU
+from .policy import DownloadPolicy
+from .singleflight import SingleFlight
+from ..georaster import NpImage, GeoRef, BigTiffWriter, GeoTiffWriter, MosaicBuilder, TileDecoder, decodeTile
 from ..utils import BBOX
 from ..proj.reproj import reprojPt, reprojBbox, reprojImg
 from ..proj.ellps import dd2meters, meters2dd
 from ..proj.srs import SRS
 
+from ..checkdeps import HAS_GDAL
 from .. import settings
 USER_AGENT = settings.user_agent
 
 TIMEOUT = 4
 
+# Keep-alive http connections pool shared by all map services
+# POOL_SIZE is the maximum number of idle connections kept per host
+# POOL_IDLE_TIMEOUT is the delay in seconds after which an idle connection is closed
+POOL_SIZE = 10
+POOL_IDLE_TIMEOUT = 30
+
+# Asyncio engine settings
+# ASYNC_CONCURRENCY is the maximum number of requests in flight
+# ASYNC_BATCH_SIZE is the number of tiles written to the cache database in one transaction
+ASYNC_CONCURRENCY = 200
+ASYNC_BATCH_SIZE = 250
+
+# Default metatile size, tiles of a destination grid are built by blocks of METATILE_SIZE x METATILE_SIZE
+# tiles with a single source mosaic and a single reprojection, then sliced. Use 1 to build the tiles one by one
+METATILE_SIZE = 4
+
+# Memory budget in bytes of the in-memory cache of decoded tiles shared by all map services
+# Decoded tiles are reused by successive getImage() requests, this avoid reading and decoding
+# again the same tiles from the cache database when the user pans the map
+TILES_LRU_SIZE = 256 * 1024**2
+
+# Failed downloads are recorded in the cache database with a reason, the tile will not be
+# requested again before the delay (in seconds) defined here for this reason
+FAILED_TILES_TTL = {
+    'NOT_FOUND' : 7 * 24 * 3600, #http 404 or 410, the provider doesn't serve this tile
+    'INVALID' : 24 * 3600, #the response is not a valid image (ie an html error page)
+    'THROTTLED' : 300, #http 429, the provider still rejects our requests after all retries
+    'HTTP_ERROR' : 3600, #others http errors
+    'TIMEOUT' : 600,
+    'NETWORK' : 600, #connection refused, dns failure...
+    'BUILD_ERROR' : 3600 #unable to build a tile of the destination grid
+}
+
 # Set mosaic backgroung image color, it will be the base color for area not covered
 # by the map service (ie when requests return non valid data)
 MOSAIC_BKG_COLOR = (128,128,128,255)
 
-EMPTY_TILE_COLOR = (255,192,203,255) #color for cached tile with empty data
+# Track peak memory while building in memory mosaics, stats are logged at debug level (slow, for profiling only)
+MOSAIC_TRACE_MEMORY = False
+
+# Write bigtiff strips from a background thread, so that reading the cache and writing the tiff overlap
+BIGTIFF_WRITER_THREAD = True
+
+EMPTY_TILE_COLOR = (255,192,203,255) #color for cached tile with empty data or failed tile
 CORRUPTED_TILE_COLOR = (255,0,0,255) #color for cached tile which is non valid image data
 
 class TileMatrix():
@@ -350,6 +400,14 @@ class MapService():
             zmin & zmax
         urlTemplate
         referer
+        policy >> optional, download policy parameters (rate limit, retries, hedged requests), see policy.DEFAULT_POLICY
+
+    Download engine
+        'THREAD' >> tiles are downloaded by a pool of threads (default)
+        'ASYNC' >> tiles are downloaded by an asyncio event loop that keeps hundreds of requests in flight
+
+    Metatile size
+        number of destination grid tiles, in each direction, warped together in one reprojection
 
     Service status code
         0 = no running tasks
@@ -357,13 +415,41 @@ class MapService():
         2 = downloading
         3 = building mosaic
         4 = reprojecting
+        5 = building pyramid
     """
 
     # resampling algo for reprojection
     RESAMP_ALG = 'BL' #NN:Nearest Neighboor, BL:Bilinear, CB:Cubic, CBS:Cubic Spline, LCZ:Lanczos
 
-    def __init__(self, srckey, cacheFolder, dstGridKey=None):
+    # pool used to decode tiles when building a mosaic : 'THREAD', 'PROCESS' or None (no parallel decoding)
+    DECODE_POOL = 'THREAD'
+    DECODE_WORKERS = None #number of decoding workers, None for cpu count
+
+    # persistent http connections, shared by all instances and all downloading threads
+    httpPool = ConnectionPool(maxsize=POOL_SIZE, idleTimeout=POOL_IDLE_TIMEOUT)
 
+    # decoded tiles, shared by all instances, keyed by (srckey_laykey, grdkey, col, row, zoom)
+    tilesLRU = TileLRU(maxBytes=TILES_LRU_SIZE)
+
+    # tiles requests in progress, shared by all instances so that concurrent requests of the same tile
+    # (from seeding threads, recursive destination tile building or the viewer) wait for a single download
+    inflight = SingleFlight()
+
+    # serialize the opening of cache databases, concurrent threads (destination tiles builders)
+    # or instances must not create the same database twice
+    cachesLock = threading.Lock()
+
+    ENGINES = ['THREAD', 'ASYNC']
+
+    def __init__(self, srckey, cacheFolder, dstGridKey=None, engine='THREAD', metatileSize=METATILE_SIZE):
+
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown download engine ' + str(engine))
+        self.engine = engine
+
+        if metatileSize < 1:
+            raise ValueError('Metatile size must be at least 1')
+        self.metatileSize = metatileSize
 
         #create class attributes from source dictionnary
         self.srckey = srckey
@@ -381,6 +467,9 @@ class MapService():
             layersObj[layKey] = lay
         self.layers = layersObj
 
+        #Download policy, shared by all instances of this source so that the rate limit is global
+        self.downloadPolicy = DownloadPolicy.get(self.srckey, source.get('policy'))
+
         #Build source tile matrix set
         self.srcGridKey = self.grid
         self.srcTms = TileMatrix(GRIDS[self.srcGridKey])
@@ -399,6 +488,7 @@ class MapService():
             #'Accept-Encoding' : 'gzip,deflate', #urllib2 doesn't automatically uncompress the data
             'Accept-Language' : 'fr,en-us,en;q=0.5' ,
             #'Keep-Alive': 115 ,
+            'Connection' : 'keep-alive',
             'Proxy-Connection' : 'keep-alive',
             'User-Agent' : USER_AGENT,
             'Referer' : self.referer}
@@ -411,8 +501,6 @@ class MapService():
         #codes that indicate the current status of the service
         self.status = 0
 
-        self.lock = threading.RLock()
-
     def reportLoop(self):
         msg = self.report
         while self.running:
@@ -445,6 +533,8 @@ class MapService():
             return 'Building mosaic...'
         if self.status == 4:
             return 'Reprojecting...'
+        if self.status == 5:
+            return 'Building pyramid... ' + str(self.cptTiles)+'/'+str(self.nbTiles)
 
 
     def setDstGrid(self, grdkey):
@@ -470,13 +560,34 @@ class MapService():
             tm = self.srcTms
 
         mapKey = self.srckey + '_' + laykey + '_' + grdkey
-        cache = self.caches.get(mapKey)
-        if cache is None:
-            dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
-            self.caches[mapKey] = GeoPackage(dbPath, tm)
-            return self.caches[mapKey]
-        else:
-            return cache
+        with self.cachesLock:
+            cache = self.caches.get(mapKey)
+            if cache is None:
+                dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
+                self.caches[mapKey] = GeoPackage(dbPath, tm)
+                return self.caches[mapKey]
+            else:
+                return cache
+
+    def getLRUKey(self, laykey, col, row, zoom, useDstGrid):
+        '''Return the key of a tile in the decoded tiles LRU'''
+        grdkey = self.dstGridKey if useDstGrid else self.srcGridKey
+        return (self.srckey + '_' + laykey, grdkey, col, row, zoom)
+
+    def putInCache(self, laykey, tiles, cache, useDstGrid):
+        '''Write tiles [(x,y,z,data)] to the cache database and discard outdated decoded tiles'''
+        cache.putTiles(tiles)
+        for col, row, zoom, data in tiles:
+            self.tilesLRU.discard(self.getLRUKey(laykey, col, row, zoom, useDstGrid))
+
+    def getInflightKey(self, laykey, col, row, zoom, useDstGrid):
+        '''Return the key identifying a tile request in progress'''
+        grdkey = self.dstGridKey if useDstGrid else self.srcGridKey
+        return (self.srckey, laykey, grdkey, col, row, zoom)
+
+    def putFailures(self, failures, cache):
+        '''Record failed tiles [(x,y,z,reason)] in the cache database'''
+        cache.putFailures([(col, row, zoom, reason, FAILED_TILES_TTL[reason]) for col, row, zoom, reason in failures])
 
     def getTM(self, dstGrid=False):
         if dstGrid:
@@ -570,36 +681,47 @@ class MapService():
             return True
 
 
+    @staticmethod
+    def getFailureReason(e):
+        '''Return the key in FAILED_TILES_TTL matching a download exception'''
+        if isinstance(e, urllib.error.HTTPError):
+            if e.code in (404, 410):
+                return 'NOT_FOUND'
+            if e.code == 429:
+                return 'THROTTLED'
+            return 'HTTP_ERROR'
+        if isinstance(e, (TimeoutError, asyncio.TimeoutError)) or 'timed out' in str(e):
+            return 'TIMEOUT'
+        return 'NETWORK'
+
+    def checkTileData(self, data, url):
+        '''Return (data, failure reason), data is None if the stream is not a valid image'''
+        if imghdr.what(None, data) is None:
+            log.debug("Invalid tile data for request {}".format(url))
+            return None, 'INVALID'
+        return data, None
+
     def downloadTile(self, laykey, col, row, zoom):
         """
         Download bytes data of requested tile in source tile matrix space
         Return None if unable to download a valid stream
         """
+        return self._downloadTile(laykey, col, row, zoom)[0]
 
+    def _downloadTile(self, laykey, col, row, zoom):
+        '''Same as downloadTile() but return (data, failure reason)'''
         url = self.buildUrl(laykey, col, row, zoom)
         log.debug(url)
 
         try:
-            #make request
-            req = urllib.request.Request(url, None, self.headers)
-            handle = urllib.request.urlopen(req, timeout=TIMEOUT)
-            #open image stream
-            data = handle.read()
-            handle.close()
+            #make request through a reused keep-alive connection, with rate limit and retries
+            data = self.downloadPolicy.request(self.httpPool.request, url, self.headers, timeout=TIMEOUT)
         except Exception as e:
             log.error("Can't download tile x{} y{}. Error {}".format(col, row, e))
-            data = None
+            return None, self.getFailureReason(e)
 
         #Make sure the stream is correct
-        if data is not None:
-            format = imghdr.what(None, data)
-            if format is None:
-                data = None
-
-        if data is None:
-            log.debug("Invalid tile data for request {}".format(url))
-
-        return data
+        return self.checkTileData(data, url)
 
 
     def tileRequest(self, laykey, col, row, zoom, toDstGrid=True):
@@ -607,20 +729,28 @@ class MapService():
         Return bytes data of the requested tile or None if unable to get valid data
         Tile is downloaded from map service and, if needed, reprojected to fit the destination grid
         """
+        return self._tileRequest(laykey, col, row, zoom, toDstGrid)[0]
 
+    def _tileRequest(self, laykey, col, row, zoom, toDstGrid=True):
+        '''
+        Same as tileRequest() but return (data, failure reason)
+        The reason is None if the failure must not be recorded (out of bounds tile or canceled request)
+        '''
         #Select tile matrix set
         tm = self.getTM(toDstGrid)
 
         #don't try to get tiles out of map bounds
         if not self.isTileInMapsBounds(col, row, zoom, tm):
-            return None
+            return None, None
 
+        key = self.getInflightKey(laykey, col, row, zoom, toDstGrid)
         if not toDstGrid:
-            data = self.downloadTile(laykey, col, row, zoom)
-        else:
-            data = self.buildDstTile(laykey, col, row, zoom)
+            return self.inflight.do(key, self._downloadTile, laykey, col, row, zoom)
 
-        return data
+        data = self.inflight.do(key, self.buildDstTile, laykey, col, row, zoom)
+        if data is None and self.running:
+            return None, 'BUILD_ERROR'
+        return data, None
 
 
     def buildDstTile(self, laykey, col, row, zoom):
@@ -628,6 +758,16 @@ class MapService():
 
         #get tile bbox
         bbox = self.dstTms.getTileBbox(col, row, zoom)
+
+        img = self.buildDstImage(laykey, bbox, zoom)
+        if img is None:
+            return None
+
+        return img.toBLOB()
+
+
+    def buildDstImage(self, laykey, bbox, zoom):
+        '''build an image that fit the destination tile matrix at given zoom level for the bbox of one or more tiles'''
         xmin, ymin, xmax, ymax = bbox
 
         #get closest zoom level
@@ -656,12 +796,69 @@ class MapService():
             return None
 
         #Reprojection
-        tileSize = self.dstTms.tileSize
-        img = NpImage(reprojImg(crs1, crs2, mosaic.toGDAL(), out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, sqPx=True, resamplAlg=self.RESAMP_ALG))
+        img_w = int(round((xmax - xmin) / res))
+        img_h = int(round((ymax - ymin) / res))
+        return mosaic.reproj(crs1, crs2, out_ul=(xmin,ymax), out_size=(img_w,img_h), out_res=res, sqPx=True, resamplAlg=self.RESAMP_ALG)
 
-        return img.toBLOB()
 
+    def buildDstMetatile(self, laykey, tiles):
+        """
+        Build several tiles of the destination tile matrix with a single source mosaic and a single
+        reprojection, then slice the result. All tiles must share the same zoom level.
+        Return [(x,y,z,data,reason)], see _tileRequest()
+        """
+        tm = self.dstTms
+        res = tm.getRes(tiles[0][2])
+        tileSize = tm.tileSize
 
+        #don't try to get tiles out of map bounds
+        results = [(col, row, zoom, None, None) for col, row, zoom in tiles if not self.isTileInMapsBounds(col, row, zoom, tm)]
+        tiles = [tile for tile in tiles if self.isTileInMapsBounds(*tile, tm)]
+        if not tiles:
+            return results
+
+        #the metatile covers the smallest block containing the requested tiles
+        bboxes = [tm.getTileBbox(col, row, zoom) for col, row, zoom in tiles]
+        xmin = min([bbox[0] for bbox in bboxes])
+        ymin = min([bbox[1] for bbox in bboxes])
+        xmax = max([bbox[2] for bbox in bboxes])
+        ymax = max([bbox[3] for bbox in bboxes])
+
+        img = self.buildDstImage(laykey, (xmin, ymin, xmax, ymax), tiles[0][2])
+        if img is None:
+            reason = 'BUILD_ERROR' if self.running else None
+            return results + [(col, row, zoom, None, reason) for col, row, zoom in tiles]
+
+        for (col, row, zoom), bbox in zip(tiles, bboxes):
+            posx = int(round((bbox[0] - xmin) / res))
+            posy = int(round((ymax - bbox[3]) / res))
+            tile = NpImage(img.data[posy:posy+tileSize, posx:posx+tileSize])
+            results.append( (col, row, zoom, tile.toBLOB(), None) )
+
+        return results
+
+
+    def getJobs(self, tiles, toDstGrid):
+        '''
+        Split the tiles to seed into jobs [[(x,y,z)]]
+        In metatile mode, tiles of the destination grid are grouped by blocks of metatileSize x metatileSize
+        '''
+        n = self.metatileSize
+        if not toDstGrid or n == 1:
+            return [[tile] for tile in tiles]
+        blocks = {}
+        for col, row, zoom in tiles:
+            blocks.setdefault((col // n, row // n, zoom), []).append( (col, row, zoom) )
+        return list(blocks.values())
+
+
+    def _jobRequest(self, laykey, job, toDstGrid):
+        '''Process a job returned by getJobs(), return [(x,y,z,data,reason)]'''
+        if len(job) == 1:
+            col, row, zoom = job[0]
+            data, reason = self._tileRequest(laykey, col, row, zoom, toDstGrid)
+            return [(col, row, zoom, data, reason)]
+        return self.buildDstMetatile(laykey, job)
 
 
     def seedTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, buffSize=5000, cpt=True):
@@ -673,20 +870,22 @@ class MapService():
         """
 
         def downloading(laykey, tilesQueue, tilesData, toDstGrid):
-            '''Worker that process the queue and seed tilesData array [(x,y,z,data)]'''
+            '''Worker that process the queue and seed tilesData array [(x,y,z,data)] and failures list [(x,y,z,reason)]'''
             #infinite loop that processes items into the queue
             while not tilesQueue.empty(): #empty is True if all item was get but it not tell if all task was done
                 #cancel thread if requested
                 if not self.running:
                     break
                 #Get a job into the queue
-                col, row, zoom = tilesQueue.get() #get() pop the item from queue
+                job = tilesQueue.get() #get() pop the item from queue
                 #do the job
-                data = self.tileRequest(laykey, col, row, zoom, toDstGrid)
-                if data is not None:
-                    tilesData.put( (col, row, zoom, data) ) #will block if the queue is full
-                if cpt:
-                    self.cptTiles += 1
+                for col, row, zoom, data, reason in self._jobRequest(laykey, job, toDstGrid):
+                    if data is not None:
+                        tilesData.put( (col, row, zoom, data) ) #will block if the queue is full
+                    elif reason is not None:
+                        failures.append( (col, row, zoom, reason) ) #list.append is thread safe
+                    if cpt:
+                        self.cptTiles += 1
                 #self.nTaskDone += 1
                 #flag it's done
                 tilesQueue.task_done() #it's just a count of finished tasks used by join() to know if the work is finished
@@ -702,12 +901,12 @@ class MapService():
                 if tilesData.full() or \
                 ( (finished() or not self.running) and not tilesData.empty()):
                     data = [tilesData.get() for i in range(tilesData.qsize())]
-                    with self.lock:
-                        cache.putTiles(data)
+                    self.putInCache(laykey, data, cache, toDstGrid)
                 if finished() and tilesData.empty():
                     break
                 if not self.running:
                     break
+                time.sleep(0.05) #do not burn a cpu core while waiting
 
         if cpt:
             #init cpt progress
@@ -730,15 +929,23 @@ class MapService():
         #Downloading tiles
         if cpt:
             self.status = 2
-        if len(missing) > 0:
+        failures = []
+        if len(missing) > 0 and self.engine == 'ASYNC':
+            asyncio.run(self._seedTilesAsync(laykey, missing, cache, toDstGrid, nbThread, cpt, failures))
+
+        elif len(missing) > 0:
 
             #Result queue
             tilesData = queue.Queue(maxsize=buffSize)
 
             #Seed the queue
             jobs = queue.Queue()
-            for tile in missing:
-                jobs.put(tile)
+            for job in self.getJobs(missing, toDstGrid):
+                jobs.put(job)
+
+            #one hedging worker per downloading thread, so that hedged requests are not delayed
+            if self.downloadPolicy.hedge:
+                self.downloadPolicy.setHedgeWorkers(nbThread)
 
             #Launch threads
             threads = []
@@ -757,12 +964,118 @@ class MapService():
             for t in threads:
                 t.join()
 
+        #Remember failed tiles so that next requests will not try them again before a while
+        if failures:
+            log.debug("{} tiles failed".format(len(failures)))
+            self.putFailures(failures, cache)
+
         #Reinit status and cpt progress
         if cpt:
             self.status = 0
             self.nbTiles, self.cptTiles = 0, 0
 
 
+    async def downloadTileAsync(self, laykey, col, row, zoom, pool):
+        """
+        Coroutine version of downloadTile() using an AsyncConnectionPool
+        Return None if unable to download a valid stream
+        """
+        return (await self._downloadTileAsync(laykey, col, row, zoom, pool))[0]
+
+    async def _downloadTileAsync(self, laykey, col, row, zoom, pool):
+        '''Same as downloadTileAsync() but return (data, failure reason)'''
+        url = self.buildUrl(laykey, col, row, zoom)
+        log.debug(url)
+
+        try:
+            data = await self.downloadPolicy.requestAsync(pool.request, url, self.headers, timeout=TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("Can't download tile x{} y{}. Error {}".format(col, row, repr(e)))
+            return None, self.getFailureReason(e)
+
+        #Make sure the stream is correct
+        return self.checkTileData(data, url)
+
+
+    async def _seedTilesAsync(self, laykey, tiles, cache, toDstGrid, nbThread, cpt, failures):
+        """
+        Asyncio seeding engine, download the requested tiles with at most ASYNC_CONCURRENCY
+        requests in flight and write them to the cache by batches through a single writer coroutine
+        Tiles of the destination grid are built in a thread pool because it involves blocking
+        calls (recursive getImage and reprojection)
+        Failed tiles are appended to the failures list [(x,y,z,reason)]
+        """
+        loop = asyncio.get_running_loop()
+        pool = AsyncConnectionPool(maxsize=ASYNC_CONCURRENCY, idleTimeout=POOL_IDLE_TIMEOUT)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=nbThread)
+        jobs = self.getJobs(tiles, toDstGrid)
+        nbJobs = len(jobs)
+        jobs = iter(jobs)
+        results = asyncio.Queue(maxsize=ASYNC_CONCURRENCY * 2)
+
+        async def downloading():
+            for job in jobs: #the iterator is shared by all workers
+                if not self.running:
+                    break
+                try:
+                    if toDstGrid:
+                        jobResults = await loop.run_in_executor(executor, self._jobRequest, laykey, job, True)
+                    else:
+                        col, row, zoom = job[0]
+                        if self.isTileInMapsBounds(col, row, zoom, self.srcTms):
+                            key = self.getInflightKey(laykey, col, row, zoom, False)
+                            data, reason = await self.inflight.doAsync(key, self._downloadTileAsync, laykey, col, row, zoom, pool)
+                        else:
+                            data, reason = None, None
+                        jobResults = [(col, row, zoom, data, reason)]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    #like a failed thread job, an error must not abort the others workers and the cache writer
+                    log.error("Can't get tiles {}".format(job), exc_info=True)
+                    reason = 'BUILD_ERROR' if toDstGrid else self.getFailureReason(e)
+                    jobResults = [(col, row, zoom, None, reason) for col, row, zoom in job]
+                for col, row, zoom, data, reason in jobResults:
+                    if data is not None:
+                        await results.put( (col, row, zoom, data) )
+                    elif reason is not None:
+                        failures.append( (col, row, zoom, reason) )
+                    if cpt:
+                        self.cptTiles += 1
+
+        async def putInCache():
+            batch = []
+            while True:
+                try:
+                    tile = await asyncio.wait_for(results.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    tile = False #no new tile, flush what we have
+                if tile is None: #end signal
+                    break
+                if tile:
+                    batch.append(tile)
+                if batch and (len(batch) >= ASYNC_BATCH_SIZE or tile is False):
+                    data, batch = batch, []
+                    await loop.run_in_executor(None, self.putInCache, laykey, data, cache, toDstGrid)
+            if batch:
+                await loop.run_in_executor(None, self.putInCache, laykey, batch, cache, toDstGrid)
+
+        writer = asyncio.ensure_future(putInCache())
+        try:
+            nbWorkers = min(ASYNC_CONCURRENCY, nbJobs)
+            await asyncio.gather(*[downloading() for i in range(nbWorkers)])
+        finally:
+            await results.put(None)
+            await writer
+            await pool.aclose()
+            executor.shutdown(wait=True)
+        log.debug('Async seeding connections stats {}'.format(pool.stats))
+        log.debug('Download policy stats {}'.format(self.downloadPolicy.stats))
+        log.debug('In flight requests stats {}'.format(self.inflight.stats))
+
+
     def getTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, cpt=True):
         """
         Return bytes data of requested tiles
@@ -786,20 +1099,149 @@ class MapService():
         return BBoxRequest(tm, bbox, zoom)
 
 
-    def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=10, buffSize=5000):
+    def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=10, buffSize=5000, pyramid=False):
         """
         Seed the cache with the tiles covering the requested bbox
+        pyramid (bool) : with a list of zoom levels, only download the highest one and build
+        the others from it (see buildPyramid()). Tiles that can't be built, because some of their children
+        are out of the bbox or failed, are then downloaded
         """
         #Select tile matrix set
         tm = self.getTM(toDstGrid)
         if isinstance(zoom, list):
+            zmax = max(zoom)
+            if pyramid and all([self.canBuildPyramid(tm, z) for z in range(min(zoom), zmax)]):
+                self.seedTiles(laykey, BBoxRequest(tm, bbox, zmax).tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize)
+                zooms = [z for z in zoom if z < zmax]
+                self.buildPyramid(laykey, bbox, zooms, toDstGrid=toDstGrid, nbThread=nbThread)
+                #seedTiles() only downloads the tiles still missing
+                if self.running and zooms:
+                    self.seedTiles(laykey, BBoxRequestMZ(tm, bbox, zooms).tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize)
+                return
+            elif pyramid:
+                log.warning('Pyramid requires a resolution factor of 2 between zoom levels, all levels will be downloaded')
             rq = BBoxRequestMZ(tm, bbox, zoom)
         else:
             rq = BBoxRequest(tm, bbox, zoom)
-        self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=10, buffSize=5000)
+        self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize)
+
+
+    def canBuildPyramid(self, tm, zoom):
+        '''Test if the tiles of a zoom level are made of exactly 2x2 tiles of the next level'''
+        if zoom + 1 >= tm.nbLevels:
+            return False
+        return abs(tm.getRes(zoom) / tm.getRes(zoom + 1) - 2) < 1e-9
+
+    def getChildTiles(self, tm, col, row, zoom):
+        '''Return [((x,y,z), dx, dy)] the 4 tiles of the next zoom level and their position in the parent tile'''
+        if tm.originLoc == "NW":
+            top, bottom = 2 * row, 2 * row + 1
+        else: #rows are counting from bottom
+            top, bottom = 2 * row + 1, 2 * row
+        return [
+            ((2 * col, top, zoom + 1), 0, 0),
+            ((2 * col + 1, top, zoom + 1), 1, 0),
+            ((2 * col, bottom, zoom + 1), 0, 1),
+            ((2 * col + 1, bottom, zoom + 1), 1, 1)
+        ]
+
+    def buildParentTile(self, tm, col, row, zoom, children):
+        """
+        Build a tile by 2x2 box downsampling of its 4 children
+        children is a dict {(x,y,z) : data}
+        Return None if a child inside the map bounds is not available
+        """
+        tileSize = tm.tileSize
+        block = NpImage.new(2 * tileSize, 2 * tileSize, bkgColor=MOSAIC_BKG_COLOR)
+        for child, dx, dy in self.getChildTiles(tm, col, row, zoom):
+            if not self.isTileInMapsBounds(*child, tm):
+                continue
+            data = children.get(child)
+            if data is None:
+                return None
+            try:
+                img = NpImage(data)
+            except Exception as e:
+                log.error('Corrupted tile on cache', exc_info=True)
+                return None
+            block.paste(img, dx * tileSize, dy * tileSize)
+
+        #average each block of 2x2 pixels, uint16 is enough to sum 4 uint8 values
+        data = block.data.astype(np.uint16)
+        data = (data[0::2, 0::2] + data[0::2, 1::2] + data[1::2, 0::2] + data[1::2, 1::2] + 2) // 4
+        data = data.astype(np.uint8)
+        if np.all(data[:, :, 3] == 255):
+            data = data[:, :, 0:3]
+        return NpImage(data).toBLOB()
+
+    def buildPyramid(self, laykey, bbox, zooms, toDstGrid=True, nbThread=10, chunkSize=256, cpt=True):
+        """
+        Build the tiles of the requested zoom levels by downsampling the cached tiles of the next level,
+        without any download. Levels are processed from the highest to the lowest so that a level can be
+        built from the one just computed, missing intermediate levels are also built.
+        Tiles are built in parallel by a pool of nbThread threads and written by chunks of chunkSize tiles.
+        Tiles whose children are not all in cache are left missing, they will be downloaded on demand.
+        """
+        tm = self.getTM(toDstGrid)
+        cache = self.getCache(laykey, toDstGrid)
+        if not zooms:
+            return
+        zmax = max(zooms) #highest level to build
+        zooms = list(range(zmax, min(zooms) - 1, -1))
+        for zoom in zooms:
+            if not self.canBuildPyramid(tm, zoom):
+                raise ValueError('Zoom level {} cannot be built from level {}, a resolution factor of 2 is required'.format(zoom, zoom + 1))
+
+        if cpt:
+            self.status = 5
+            self.nbTiles, self.cptTiles = 0, 0
+        nbBuilt = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nbThread) as executor:
+            for zoom in zooms:
+                missing = list(cache.listMissingTiles(BBoxRequest(tm, bbox, zoom).tiles))
+                if cpt:
+                    self.nbTiles += len(missing)
+                for i in range(0, len(missing), chunkSize):
+                    if not self.running:
+                        break
+                    parents = missing[i:i+chunkSize]
+                    children = [child for col, row, z in parents for child, dx, dy in self.getChildTiles(tm, col, row, z)]
+                    children = {(col, row, z) : data for col, row, z, data in cache.getTiles(children)}
+
+                    def build(tile):
+                        col, row, z = tile
+                        return col, row, z, self.buildParentTile(tm, col, row, z, children)
+
+                    tiles = [tile for tile in executor.map(build, parents) if tile[3] is not None]
+                    if tiles:
+                        self.putInCache(laykey, tiles, cache, toDstGrid)
+                    nbBuilt += len(tiles)
+                    if cpt:
+                        self.cptTiles += len(parents)
+
+        log.debug('Pyramid built, {} tiles computed from cache'.format(nbBuilt))
+        if cpt:
+            self.status = 0
+            self.nbTiles, self.cptTiles = 0, 0
+
 
+    @staticmethod
+    def discardTiff(writer, path):
+        '''Close the writer of a canceled or failed bigTiff output and remove the partial file and its sidecars'''
+        try:
+            writer.close() #stop the background writer and release the file, without hiding the original error
+        except Exception as e:
+            log.error('Unable to close {} : {}'.format(path, e))
+        for p in (path, os.path.splitext(path)[0] + '.tfw', path + '.aux.xml'):
+            if os.path.exists(p):
+                try:
+                    os.remove(p)
+                except OSError as e:
+                    log.warning('Unable to remove partial output {} : {}'.format(p, e))
 
-    def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=10, cpt=True):
+
+    def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, memmap=False, outCRS=None, toDstGrid=True, nbThread=10, cpt=True):
         """
         Build a mosaic of tiles covering the requested bounding box
         #laykey (str)
@@ -807,13 +1249,18 @@ class MapService():
         #zoom (int)
         #path (str): if None the function will return a georeferenced NpImage object. If not None, then the resulting output will be
         writen as geotif file on disk and the function will return None
-        #bigTiff (bool): if true then the raster will be writen by small part with the help of GDAL API. If false the raster will be
-        writen at one, in this case all the tiles must fit in memory otherwise it will raise a memory overflow error
-        #outCRS : destination CRS if a reprojection if expected (require GDAL support)
+        #bigTiff (bool): if true then the raster will be writen by small part with the help of GDAL API, or with a pure python
+        tiled GeoTIFF writer if GDAL is not available. If false the raster will be writen at one, in this case all the tiles
+        must fit in memory otherwise it will raise a memory overflow error
+        #memmap (bool): if true, and bigTiff is false, the mosaic is stored in a memory mapped temporary file, so that large
+        mosaics can be built without GDAL and without filling the RAM. The returned NpImage wraps the mapped array and,
+        with GDAL, exposes it through a raw VRT dataset when saving or reprojecting
+        #outCRS : destination CRS if a reprojection if expected (require GDAL support for bigTiff output)
         #toDstGrid (bool) : decide if the function will seed the destination tile matrix sets for this MapService instance
         (different from the source tile matrix set)
         #nbThread (int) : nimber of threads that will be used for downloading tiles
         #cpt (bool) : define if the service must report or not tiles downloading count for this request
+        Return None if the request is canceled or if no tile covers the bbox
         """
 
         #Select tile matrix set
@@ -826,6 +1273,11 @@ class MapService():
         cols, rows = rq.cols, rq.rows
         rqTiles = rq.tiles #[(x,y,z)]
 
+        #empty bbox, there is no mosaic to build
+        if rq.nbTiles == 0:
+            log.warning('No tile covers the requested bbox {}'.format(bbox))
+            return None
+
         ##method 1) Seed the cache with all required tiles
         self.seedCache(laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000)
         cache = self.getCache(laykey, toDstGrid)
@@ -842,56 +1294,132 @@ class MapService():
 
         if bigTiff and path is None:
             raise ValueError('No output path defined for creating bigTiff')
+        if bigTiff and not HAS_GDAL and outCRS is not None and outCRS != tm.CRS:
+            raise NotImplementedError('Reprojection of bigTiff output requires GDAL')
 
         if not bigTiff:
-            #Create numpy image in memory
-            mosaic = NpImage.new(img_w, img_h, bkgColor=MOSAIC_BKG_COLOR, georef=georef)
-            chunkSize = rq.nbTiles
+            #Create numpy image in memory, tiles will be decoded straight into it
+            mosaic = MosaicBuilder(img_w, img_h, bkgColor=MOSAIC_BKG_COLOR, georef=georef, trace=MOSAIC_TRACE_MEMORY, memmap=memmap)
+            if not memmap:
+                chunkSize = rq.nbTiles
+            else:
+                chunkSize = 1024 #bound the number of tiles data loaded at once to keep memory usage flat
+                #fill the mapped file row of tiles by row of tiles, so that its pages are completed and written
+                #back sequentially instead of being dirtied again by each tile of the row
+                rqTiles = [(col, row, zoom) for row in rows for col in cols]
+            #chunks of (tiles, builder, vertical offset of the builder in the final image)
+            chunks = ( (rqTiles[i:i+chunkSize], mosaic, 0) for i in range(0, rq.nbTiles, chunkSize) )
         else:
             #Create bigtiff file on disk
-            mosaic = BigTiffWriter(path, img_w, img_h, georef)
-            ds = mosaic.ds
-            chunkSize = 5 #number of tiles to extract in one cache request
+            if HAS_GDAL:
+                writer = BigTiffWriter(path, img_w, img_h, georef, background=BIGTIFF_WRITER_THREAD)
+            else:
+                #deflate compressed tiled tiff with internal overviews
+                writer = GeoTiffWriter(path, img_w, img_h, georef)
+            #Process one row of tiles at once : one cache request, then the row is assembled in a strip buffer
+            #which is written to the tiff with a single call
+            chunks = ( ([(col, row, zoom) for col in cols],
+                MosaicBuilder(img_w, tileSize, bkgColor=MOSAIC_BKG_COLOR),
+                abs(row - rq.firstRow) * tileSize) for row in rows )
+
+        #Tiles are decoded in parallel. With threads, tiles are directly decoded into the mosaic or the strip buffer,
+        #with processes decoded arrays are sent back and pasted from this thread
+        decoder = TileDecoder(self.DECODE_POOL, self.DECODE_WORKERS)
+        directDecode = decoder.poolType != 'PROCESS'
+        fn = decodeTile if not directDecode else None
+
+        #Decoded tiles are kept in memory for interactive requests only, streamed outputs (bigtiff or memmap)
+        #can be larger than the RAM, caching their tiles would evict the working set of the map viewer.
+        #Lookups are still done, a hit saves a decode
+        useLRU = not bigTiff and not memmap
 
         #Build mosaic
-        for i in range(0, rq.nbTiles, chunkSize):
-            chunkTiles = rqTiles[i:i+chunkSize]
+        completed = False
+        try:
+            for chunkTiles, builder, offsetY in chunks:
+
+                #Tiles already decoded by a previous request are pick up from memory
+                decoded, toRead = [], []
+                for col, row, z in chunkTiles:
+                    arr = self.tilesLRU.get(self.getLRUKey(laykey, col, row, z, toDstGrid))
+                    if arr is None:
+                        toRead.append((col, row, z))
+                    else:
+                        decoded.append((col, row, z, arr))
 
-            ##method 1) Get cached tiles
-            tiles = cache.getTiles(chunkTiles) #[(x,y,z,data)]
+                ##method 1) Get cached tiles
+                tiles = cache.getTiles(toRead) #[(x,y,z,data)]
 
-            ##method 2) Get tiles from www or cache (all tiles must fit in memory)
-            #tiles = self.getTiles(laykey, chunkTiles, toDstGrid, nbThread, cpt)
+                #Tiles known as failed are directly rendered as empty tiles
+                if len(tiles) < len(toRead):
+                    found = set((col, row, z) for col, row, z, data in tiles)
+                    missing = [t for t in toRead if t not in found]
+                    tiles.extend([(col, row, z, None) for col, row, z in cache.listFailedTiles(missing)])
 
-            if cpt:
-                self.status = 3
-            for tile in tiles:
+                ##method 2) Get tiles from www or cache (all tiles must fit in memory)
+                #tiles = self.getTiles(laykey, chunkTiles, toDstGrid, nbThread, cpt)
 
-                if not self.running:
-                    if cpt:
-                        self.status = 0
-                    return None
-
-                col, row, z, data = tile
-
-                #TODO corrupted or empty tiles must be deleted from cache are fetched again
-                if data is None:
-                    #create an empty tile
-                    img = NpImage.new(tileSize, tileSize, bkgColor=EMPTY_TILE_COLOR)
-                else:
-                    try:
-                        img = NpImage(data)
-                    except Exception as e:
-                        log.error('Corrupted tile on cache', exc_info=True)
-                        #create an empty tile if we are unable to get a valid stream
-                        img = NpImage.new(tileSize, tileSize, bkgColor=CORRUPTED_TILE_COLOR)
+                if cpt:
+                    self.status = 3
+
+                jobs = []
+                for col, row, z, data in decoded + tiles:
+                    posx = (col - rq.firstCol) * tileSize
+                    posy = abs((row - rq.firstRow)) * tileSize - offsetY
+                    #TODO corrupted or empty tiles must be deleted from cache are fetched again
+                    if data is None:
+                        builder.fill(posx, posy, tileSize, tileSize, EMPTY_TILE_COLOR)
+                    elif not isinstance(data, bytes):
+                        #already decoded array
+                        builder.paste(data, posx, posy)
+                    elif directDecode:
+                        jobs.append( ((col, row, z, posx, posy), (data, posx, posy)) )
+                    else:
+                        jobs.append( ((col, row, z, posx, posy), (data,)) )
+
+                for (col, row, z, posx, posy), arr, e in decoder.imap(fn or builder.decode, jobs):
+
+                    if not self.running:
+                        builder.close()
+                        if cpt:
+                            self.status = 0
+                        return None
 
+                    if e is not None:
+                        log.error('Corrupted tile on cache', exc_info=e)
+                        #create an empty tile if we are unable to get a valid stream
+                        builder.fill(posx, posy, tileSize, tileSize, CORRUPTED_TILE_COLOR)
+                        continue
+
+                    if not directDecode:
+                        builder.paste(arr, posx, posy)
+                    if useLRU:
+                        #the view must not be cached, it would keep the whole mosaic in memory
+                        arr = arr.copy() if directDecode else arr
+                        self.tilesLRU.put(self.getLRUKey(laykey, col, row, z, toDstGrid), arr)
+
+                if bigTiff:
+                    writer.writeStrip(builder.data, 0, offsetY)
+
+            if bigTiff:
+                writer.flush() #wait for pending strips
+            completed = True
+        finally:
+            decoder.close()
+            if bigTiff and not completed:
+                #canceled or failed, an incomplete file must not be left on disk
+                self.discardTiff(writer, path)
 
-                posx = (col - rq.firstCol) * tileSize
-                posy = abs((row - rq.firstRow)) * tileSize
-                mosaic.paste(img, posx, posy)
+        if not bigTiff:
+            log.debug('Mosaic stats {}'.format(mosaic.stats))
+            mosaic = mosaic.toNpImage()
+        else:
+            mosaic = writer
+            ds = getattr(writer, 'ds', None)
 
         if not self.running:
+            if bigTiff:
+                self.discardTiff(writer, path)
             if cpt:
                 self.status = 0
             return None
@@ -903,15 +1431,17 @@ class MapService():
             time.sleep(0.1) #make sure client have enough time to get the new status...
 
             if not bigTiff:
-                mosaic = NpImage(reprojImg(tm.CRS, outCRS, mosaic.toGDAL(), sqPx=True, resamplAlg=self.RESAMP_ALG))
+                mosaic = mosaic.reproj(tm.CRS, outCRS, sqPx=True, resamplAlg=self.RESAMP_ALG)
             else:
                 outPath = path[:-4] + '_' + str(outCRS) + '.tif'
                 ds = reprojImg(tm.CRS, outCRS, mosaic.ds, sqPx=True, resamplAlg=self.RESAMP_ALG, path=outPath)
 
         #build overviews for file output
         if bigTiff:
-            ds.BuildOverviews(overviewlist=[2,4,8,16,32])
-            ds = None
+            if HAS_GDAL:
+                ds.BuildOverviews(overviewlist=[2,4,8,16,32])
+                ds = None
+            writer.close() #without GDAL, overviews are computed while writing
 
         if not bigTiff and path is not None:
             mosaic.save(path)
@@ -0,0 +1,104 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import threading
+import collections
+
+
+class TileLRU():
+    '''
+    Thread safe in-memory cache of decoded tiles (numpy arrays)
+    The size of the cache is bounded by the total bytes of the stored arrays, least recently used
+    tiles are evicted once the memory budget is exceeded.
+
+    maxBytes : memory budget in bytes
+    '''
+
+    def __init__(self, maxBytes=256*1024**2):
+        self._maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.tiles = collections.OrderedDict() # {key : array}
+        self.nbytes = 0
+        #stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+
+    @maxBytes.setter
+    def maxBytes(self, maxBytes):
+        with self.lock:
+            self._maxBytes = maxBytes
+            self._evict()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'tiles' : len(self.tiles),
+                'bytes' : self.nbytes,
+                'maxBytes' : self._maxBytes
+            }
+
+    def _evict(self):
+        while self.nbytes > self._maxBytes and self.tiles:
+            key, data = self.tiles.popitem(last=False)
+            self.nbytes -= data.nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        '''Return the cached array or None'''
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if data.nbytes > self._maxBytes:
+            return
+        #cached arrays are shared between requests, make sure no one will edit them in place
+        data.setflags(write=False)
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.tiles[key] = data
+            self.nbytes += data.nbytes
+            self._evict()
+
+    def discard(self, key):
+        with self.lock:
+            data = self.tiles.pop(key, None)
+            if data is not None:
+                self.nbytes -= data.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.nbytes = 0
@@ -0,0 +1,365 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import math
+import random
+import asyncio
+import threading
+import collections
+import concurrent.futures
+import email.utils
+import urllib.error
+
+from .httppool import CancelToken
+
+
+# Default download policy, can be overriden for each source with a "policy" dict in servicesDefs
+DEFAULT_POLICY = {
+    'rate' : None, #maximum number of requests per second sent to the provider, None for no limit
+    'burst' : 10, #number of requests that can be sent at once before the rate limit applies
+    'retries' : 2, #number of new attempts after a 429 or 5xx response
+    'backoff' : 0.5, #base delay (seconds) of the exponential backoff
+    'maxBackoff' : 30, #maximum delay (seconds) between two attempts, also cap the Retry-After header
+    'hedge' : False, #send a second request when the first one is slower than usual
+    'hedgePercentile' : 95, #latency percentile after which the hedged request is sent
+    'hedgeMinSamples' : 20 #number of latency samples required before sending hedged requests
+}
+
+HEDGE_WORKERS = 10 #initial size of the threads pool running the hedged requests of a policy, see setHedgeWorkers()
+
+
+class TokenBucket():
+    '''
+    Thread safe token bucket rate limiter
+    rate : number of tokens added per second
+    burst : capacity of the bucket
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self):
+        '''Take a token and return the delay (seconds) to wait before using it'''
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def tryAcquire(self):
+        '''Take a token only if one is available now'''
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class LatencyTracker():
+    '''Keep the latest request durations to estimate latency percentiles'''
+
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.samples.append(value)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        k = min(len(samples) - 1, int(math.ceil(p / 100 * len(samples))) - 1)
+        return samples[max(0, k)]
+
+
+class DownloadPolicy():
+    '''
+    Wrap the requests sent to a tile provider with
+    * a token bucket rate limit
+    * retries with exponential backoff and full jitter on 429 and 5xx responses, the Retry-After
+    header sent by the server is honored
+    * optional hedged requests : when a request takes longer than the configured latency percentile,
+    a second identical request is sent and the first response wins, the slower one is canceled
+
+    A single policy is shared by all the map services of a provider, use get()
+    '''
+
+    _policies = {}
+    _policiesLock = threading.Lock()
+
+    @classmethod
+    def get(cls, key, params=None):
+        with cls._policiesLock:
+            policy = cls._policies.get(key)
+            if policy is None:
+                policy = cls(**(params or {}))
+                cls._policies[key] = policy
+            return policy
+
+    def __init__(self, **params):
+        for k in params:
+            if k not in DEFAULT_POLICY:
+                raise ValueError('Unknown download policy parameter ' + str(k))
+        opts = dict(DEFAULT_POLICY, **params)
+        for k, v in opts.items():
+            setattr(self, k, v)
+        if self.rate:
+            self.bucket = TokenBucket(self.rate, self.burst)
+        else:
+            self.bucket = None
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        self.executor = None #threads pool sending the hedged requests
+        self.nbHedgeWorkers = 0
+        self.nbHedging = 0 #number of threads currently in a request with hedging enabled
+        #stats
+        self.nbRequests = 0
+        self.nbRetries = 0
+        self.nbHedged = 0
+        self.nbHedgeWins = 0
+        self.throttled = 0 #cumulated time (seconds) requests spent waiting for the rate limiter
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'requests' : self.nbRequests,
+                'retries' : self.nbRetries,
+                'hedged' : self.nbHedged,
+                'hedgeWins' : self.nbHedgeWins,
+                'throttled' : self.throttled,
+                'hedgeDelay' : self.hedgeDelay()
+            }
+
+    def _count(self, attr, value=1):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + value)
+
+    ############################################
+
+    def throttleDelay(self):
+        '''Reserve a request slot and return the delay to wait before sending it'''
+        if self.bucket is None:
+            return 0
+        delay = self.bucket.reserve()
+        if delay > 0:
+            self._count('throttled', delay)
+        return delay
+
+    def hedgeDelay(self):
+        '''Delay after which a hedged request is sent, None if hedging is disabled or not enough samples'''
+        if not self.hedge or len(self.latency) < self.hedgeMinSamples:
+            return None
+        return self.latency.percentile(self.hedgePercentile)
+
+    def _canHedge(self):
+        return self.bucket is None or self.bucket.tryAcquire()
+
+    @staticmethod
+    def isRetryable(e):
+        return isinstance(e, urllib.error.HTTPError) and (e.code == 429 or e.code >= 500)
+
+    def retryDelay(self, attempt, e):
+        '''Delay before the next attempt, from Retry-After header or exponential backoff with full jitter'''
+        retryAfter = e.headers.get('Retry-After') if e.headers is not None else None
+        if retryAfter is not None:
+            try:
+                delay = float(retryAfter)
+            except ValueError:
+                try:
+                    date = email.utils.parsedate_to_datetime(retryAfter)
+                    delay = date.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(self.maxBackoff, max(0, delay))
+        return random.uniform(0, min(self.maxBackoff, self.backoff * 2**attempt))
+
+    ############################################
+    # Threads
+
+    def _growExecutor(self, n):
+        '''Replace the hedging pool by a larger one and return the former pool, must be called with the lock held'''
+        if n <= self.nbHedgeWorkers:
+            return None
+        executor, self.nbHedgeWorkers = self.executor, n
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+        return executor
+
+    def setHedgeWorkers(self, n):
+        '''
+        Size the threads pool running the hedged requests, it needs one worker per thread sending requests
+        through this policy, otherwise hedged requests are sent late. The pool never shrinks
+        '''
+        with self.lock:
+            executor = self._growExecutor(n)
+        if executor is not None:
+            executor.shutdown(wait=False) #running hedged requests end normally
+
+    def _submitHedge(self, fn):
+        '''Run fn in the hedging pool, grown to the number of threads currently sending requests'''
+        with self.lock:
+            executor = self._growExecutor(max(HEDGE_WORKERS, self.nbHedging))
+            future = self.executor.submit(fn)
+        if executor is not None:
+            executor.shutdown(wait=False)
+        return future
+
+    def _timed(self, fn, *args, **kwargs):
+        t0 = time.monotonic()
+        result = fn(*args, **kwargs)
+        self.latency.add(time.monotonic() - t0)
+        return result
+
+    def _hedged(self, fn, *args, **kwargs):
+        '''
+        The request is sent from the calling thread, the hedged one from the threads pool. fn must accept
+        a cancel keyword argument (a CancelToken, see ConnectionPool.request) so that the slower one is aborted
+        '''
+        delay = self.hedgeDelay()
+        if delay is None:
+            return self._timed(fn, *args, **kwargs)
+        first, second = CancelToken(), CancelToken()
+        finished = threading.Event()
+        t0 = time.monotonic()
+
+        def hedge():
+            #the worker may have been busy, the delay runs from the first request
+            if finished.wait(max(0, delay - (time.monotonic() - t0))) or not self._canHedge():
+                return None
+            self._count('nbHedged')
+            result = self._timed(fn, *args, cancel=second, **kwargs)
+            first.cancel()
+            return result
+
+        self._count('nbHedging')
+        try:
+            future = self._submitHedge(hedge)
+            try:
+                result = self._timed(fn, *args, cancel=first, **kwargs)
+            except Exception as e:
+                #canceled because the hedged request has answered first, or failed : the hedged request,
+                #if sent, is the last chance
+                finished.set()
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result is None:
+                    raise e
+                self._count('nbHedgeWins')
+                return result
+            finished.set()
+            second.cancel()
+            return result
+        finally:
+            self._count('nbHedging', -1)
+
+    def request(self, fn, *args, **kwargs):
+        '''Call fn(*args, **kwargs) according to the policy and return its result'''
+        for attempt in range(self.retries + 1):
+            delay = self.throttleDelay()
+            if delay > 0:
+                time.sleep(delay)
+            self._count('nbRequests')
+            try:
+                return self._hedged(fn, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not self.isRetryable(e):
+                    raise
+                delay = self.retryDelay(attempt, e)
+                log.debug('Request failed ({}), retry in {:.2f} seconds'.format(e, delay))
+                self._count('nbRetries')
+                time.sleep(delay)
+
+    ############################################
+    # Asyncio
+
+    async def _timedAsync(self, fn, *args, **kwargs):
+        t0 = time.monotonic()
+        result = await fn(*args, **kwargs)
+        self.latency.add(time.monotonic() - t0)
+        return result
+
+    async def _hedgedAsync(self, fn, *args, **kwargs):
+        delay = self.hedgeDelay()
+        if delay is None:
+            return await self._timedAsync(fn, *args, **kwargs)
+        first = asyncio.ensure_future(self._timedAsync(fn, *args, **kwargs))
+        tasks = [first]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if not done and self._canHedge():
+                self._count('nbHedged')
+                tasks.append(asyncio.ensure_future(self._timedAsync(fn, *args, **kwargs)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count('nbHedgeWins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            #cancel the slower request
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def requestAsync(self, fn, *args, **kwargs):
+        '''Await the coroutine fn(*args, **kwargs) according to the policy and return its result'''
+        for attempt in range(self.retries + 1):
+            delay = self.throttleDelay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._count('nbRequests')
+            try:
+                return await self._hedgedAsync(fn, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not self.isRetryable(e):
+                    raise
+                delay = self.retryDelay(attempt, e)
+                log.debug('Request failed ({}), retry in {:.2f} seconds'.format(e, delay))
+                self._count('nbRetries')
+                await asyncio.sleep(delay)
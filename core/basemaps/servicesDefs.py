@@ -131,6 +131,13 @@ GRIDS = {
 #A source can have multiple layers but have only one grid
 #so to support multiple grid it's necessary to duplicate source definition
 
+#A source can define an optional "policy" dict to control how tiles are downloaded
+#(see policy.DEFAULT_POLICY for the list of parameters and their default values):
+# - "rate" and "burst" : token bucket rate limit, maximum number of requests per second for this provider
+# - "retries", "backoff" and "maxBackoff" : retry with exponential backoff and jitter on 429 and 5xx responses
+# - "hedge", "hedgePercentile" and "hedgeMinSamples" : send a second request when the first one is slower
+#than the given latency percentile, the first response wins
+
 SOURCES = {
 
 
@@ -164,7 +171,8 @@ SOURCES = {
             "MAPNIK" : {"urlKey" : '', "name" : 'Mapnik', "description" : '', "format" : 'png', "zmin" : 0, "zmax" : 19}
         },
         "urlTemplate": "https://tile.openstreetmap.org/{Z}/{X}/{Y}.png",
-        "referer": "" #https://www.openstreetmap.org will return 418 error
+        "referer": "", #https://www.openstreetmap.org will return 418 error
+        "policy": {"rate": 20, "burst": 20} #comply with osm tile usage policy, avoid heavy use
     },
 
 
@@ -0,0 +1,112 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import asyncio
+import threading
+import concurrent.futures
+
+
+class SingleFlight():
+    '''
+    Coalesce concurrent calls sharing the same key : the first caller runs the function,
+    the others wait for its result instead of running it again.
+    Work across threads and asyncio coroutines, the shared result is hold by a concurrent Future.
+    If the leading call is canceled, waiting callers run the function themselves.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # {key : Future}
+        #stats
+        self.nbCalls = 0
+        self.nbShared = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'calls' : self.nbCalls,
+                'avoided' : self.nbShared, #duplicate calls that reused the result of a running call
+                'inFlight' : len(self.calls)
+            }
+
+    def _join(self, key):
+        '''Return the future of the running call and a flag indicating if the caller is the leader'''
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.nbShared += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self.calls[key] = future
+            self.nbCalls += 1
+            return future, True
+
+    def _leave(self, key):
+        with self.lock:
+            del self.calls[key]
+
+    def do(self, key, fn, *args, **kwargs):
+        '''Return fn(*args, **kwargs) or the result of the identical call already running'''
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result()
+                except concurrent.futures.CancelledError:
+                    continue
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._leave(key)
+                future.set_exception(e)
+                raise
+            except BaseException:
+                self._leave(key)
+                future.cancel()
+                raise
+            self._leave(key)
+            future.set_result(result)
+            return result
+
+    async def doAsync(self, key, fn, *args, **kwargs):
+        '''Coroutine version of do(), fn must be a coroutine function'''
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    #shield the shared future, canceling this waiter must not cancel the others
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except asyncio.CancelledError:
+                    if future.cancelled():
+                        continue
+                    raise #this waiter is canceled, not the leading call
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                self._leave(key)
+                future.set_exception(e)
+                raise
+            except BaseException:
+                self._leave(key)
+                future.cancel()
+                raise
+            self._leave(key)
+            future.set_result(result)
+            return result
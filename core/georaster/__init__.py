@@ -2,4 +2,8 @@ from .georef import GeoRef
 from .georaster import GeoRaster
 from .npimg import NpImage
 from .bigtiffwriter import BigTiffWriter
+from .geotiffwriter import GeoTiffWriter
+from .tiffreader import TiffReader
+from .mesh import demToMesh
+from .mosaic import MosaicBuilder, TileDecoder, decodeTile
 from .img_utils import getImgFormat, getImgDim, isValidStream
@@ -21,6 +21,8 @@
 
 
 import os
+import queue
+import threading
 import numpy as np
 from .npimg import NpImage
 
@@ -41,16 +43,23 @@ class BigTiffWriter():
 
 
     def __del__(self):
-        # properly close gdal dataset
+        #a finalizer must not raise, write errors are reported by flush() and close()
+        try:
+            self._stopWriter()
+        except Exception:
+            pass
         self.ds = None
 
 
-    def __init__(self, path, w, h, georef, geoTiffOptions={'TFW':'YES', 'TILED':'YES', 'BIGTIFF':'YES', 'COMPRESS':'JPEG', 'JPEG_QUALITY':80, 'PHOTOMETRIC':'YCBCR'}):
+    def __init__(self, path, w, h, georef, geoTiffOptions={'TFW':'YES', 'TILED':'YES', 'BIGTIFF':'YES', 'COMPRESS':'JPEG', 'JPEG_QUALITY':80, 'PHOTOMETRIC':'YCBCR'}, background=False):
         '''
         path = fule system path for the ouput tiff
         w, h = width and height in pixels
         georef : a Georef object used to set georeferencing informations, optional
         geoTiffOptions : GDAL create option for tiff format
+        background : if True, strips submited to writeStrip() are written by a background thread, so that
+        the caller can prepare the next strip while the previous one is compressed and written. Call flush()
+        to wait for all pending writes before using the dataset, and close() when done
         '''
 
         if not HAS_GDAL:
@@ -96,6 +105,15 @@ class BigTiffWriter():
             self.ds.SetProjection(self.georef.crs.getOgrSpatialRef().ExportToWkt())
         #self.georef.toWorldFile(os.path.splitext(path)[0] + '.tfw')
 
+        #Background writer
+        self.writer = None
+        self.errors = []
+        if background:
+            self.strips = queue.Queue(maxsize=2) #bound the number of strips waiting in memory
+            self.writer = threading.Thread(target=self._writerLoop)
+            self.writer.daemon = True
+            self.writer.start()
+
 
     def paste(self, data, x, y):
         '''data = numpy array or NpImg'''
@@ -127,6 +145,65 @@ class BigTiffWriter():
 
 
 
+    def _writeStrip(self, data, x, y):
+        '''Write a rgb or rgba array with a single dataset level call (+ one call for the mask)'''
+        h, w = data.shape[0], data.shape[1]
+        n = data.shape[2]
+        data = np.ascontiguousarray(data)
+        #pixel interleaved buffer, select the bands to write with the spacing parameters
+        nbBands = min(n, self.nbBands)
+        self.ds.WriteRaster(x, y, w, h, data.tobytes(), w, h, band_list=list(range(1, nbBands+1)),
+            buf_pixel_space=n, buf_line_space=w*n, buf_band_space=1)
+        if n == 4 and self.useMask:
+            self.mask.WriteArray(data[:,:,3], x, y)
+
+    def _writerLoop(self):
+        while True:
+            item = self.strips.get()
+            if item is None:
+                return
+            if self.errors:
+                continue #drop remaining strips after a failure
+            try:
+                self._writeStrip(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def writeStrip(self, data, x, y):
+        '''
+        Write a block of pixels (numpy array rgb or rgba) covering several tiles, typically a full row of tiles
+        In background mode the array must not be modified after this call
+        '''
+        if isinstance(data, NpImage):
+            data = data.data
+        if self.errors:
+            raise self.errors[0]
+        if self.writer is None:
+            self._writeStrip(data, x, y)
+        else:
+            self.strips.put( (data, x, y) ) #block if the writer is late
+
+    def _stopWriter(self):
+        writer = getattr(self, 'writer', None)
+        if writer is not None:
+            self.strips.put(None)
+            writer.join()
+            self.writer = None
+
+    def flush(self):
+        '''Wait until all strips are written and stop the background writer'''
+        self._stopWriter()
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        '''Write pending strips and close the dataset, the file is complete after this call'''
+        try:
+            self.flush()
+        finally:
+            self.mask = None
+            self.ds = None
+
     def __repr__(self):
         return '\n'.join([
         "* Data infos :",
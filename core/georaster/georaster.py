@@ -20,6 +20,9 @@
 #  ***** GPL LICENSE BLOCK *****
 
 import os
+import math
+
+import numpy as np
 
 import logging
 log = logging.getLogger(__name__)
@@ -27,7 +30,8 @@ log = logging.getLogger(__name__)
 from ..lib import Tyf #geotags reader
 
 from .georef import GeoRef
-from .npimg import NpImage
+from .npimg import NpImage, getImgEngine
+from .tiffreader import TiffReader
 from .img_utils import getImgFormat, getImgDim
 
 from ..utils import XY as xy
@@ -245,12 +249,129 @@ class GeoRaster():
         '''Get GDAL dataset'''
         return gdal.Open(self.path, gdal.GA_ReadOnly)
 
-    def readAsNpArray(self, subset=True):
-        '''Read raster pixels values as Numpy Array'''
+    def _readTiff(self, box=None, memmap=True, decode=True):
+        '''
+        Read tiff pixels (all or a BBOX window in pixels coordinates space, max included) without the imaging library
+        memmap : uncompressed contiguous files are memory mapped, nothing is read until the pixels are accessed
+        decode : otherwise decode only the strips or tiles intersecting the window
+        Return None if the file is not supported
+        '''
+        try:
+            reader = TiffReader(self.path)
+            if memmap and reader.isContiguous:
+                data = reader.memmap()
+                if box is not None:
+                    data = data[max(0, box.ymin):box.ymax+1, max(0, box.xmin):box.xmax+1]
+                return data
+            if decode and box is not None:
+                return reader.readWindow(box.xmin, box.ymin, box.xmax - box.xmin + 1, box.ymax - box.ymin + 1)
+        except (NotImplementedError, IOError, KeyError) as e:
+            log.debug('Cannot read tiff without imaging library ({})'.format(e))
+        return None
+
+    def _sampledGeoRef(self, px, py, stepX, stepY, outW, outH):
+        '''
+        Georef of an image of pixels sampled every (stepX, stepY) pixels, (px, py) is the position of the center
+        of the first sampled pixel, in the full resolution pixels space (pixel corners at integer coordinates)
+        '''
+        ox, oy = self.georef.geoFromPx(px, py, pxCenter=False)
+        pxSize = (stepX * self.pxSize.x, stepY * self.pxSize.y)
+        return GeoRef((outW, outH), pxSize, (ox, oy), pxCenter=True, crs=self.georef.crs)
 
+    def _readDecimated(self, x, y, w, h, stepX, stepY):
+        '''
+        Read the pixels sampled every (stepX, stepY) pixels of a window, from the best overview level available
+        Return the sampled data and its georef, or None if the file has no usable overview reader
+        '''
+        if self.isTiff:
+            try:
+                levels = TiffReader.levels(self.path)
+                #coarsest level whose pixels are not larger than the sampling step
+                W, H = self.size
+                valid = [lvl for lvl in levels if W / lvl[1] <= stepX and H / lvl[2] <= stepY]
+                idx, levelW, levelH = min(valid or levels[0:1], key=lambda lvl: lvl[1])
+                reader = TiffReader(self.path, idx)
+                #window and step in the level pixels space
+                fx, fy = W / levelW, H / levelH
+                lx, ly = int(x / fx), int(y / fy)
+                lw = max(1, min(levelW, math.ceil((x + w) / fx)) - lx)
+                lh = max(1, min(levelH, math.ceil((y + h) / fy)) - ly)
+                lsx, lsy = max(1, int(stepX / fx)), max(1, int(stepY / fy))
+                xs, ys = np.arange(lx, lx + lw, lsx), np.arange(ly, ly + lh, lsy)
+                log.debug('Decimated read from tiff level {} ({}x{})'.format(idx, levelW, levelH))
+                data = reader.readSampled(xs, ys)
+                #the level pixels are fx * fy full resolution pixels
+                georef = self._sampledGeoRef((xs[0] + 0.5) * fx, (ys[0] + 0.5) * fy, lsx * fx, lsy * fy, len(xs), len(ys))
+                return data, georef
+            except (NotImplementedError, IOError, KeyError) as e:
+                log.debug('Cannot read tiff overviews ({})'.format(e))
+        if HAS_GDAL:
+            #GDAL pick the best overview level (internal or external) when the buffer is smaller than the window
+            outW, outH = math.ceil(w / stepX), math.ceil(h / stepY)
+            ds = gdal.Open(self.path, gdal.GA_ReadOnly)
+            data = ds.ReadAsArray(x, y, w, h, buf_xsize=outW, buf_ysize=outH)
+            ds = None
+            if data.ndim == 3:
+                data = np.rollaxis(data, 0, 3)
+            #nearest neighbor resampling, output pixels are sampled at their center
+            sx, sy = w / outW, h / outH
+            return data, self._sampledGeoRef(x + sx / 2, y + sy / 2, sx, sy, outW, outH)
+        return None
+
+    def readAsNpArray(self, subset=True, memmap=False, targetRes=None):
+        '''
+        Read raster pixels values as Numpy Array
+        memmap : if the file is an uncompressed tiff, return a copy on write numpy memmap instead of loading the data.
+        Disabled by default so that callers get an in memory array they can freely modify
+        targetRes : expected pixel size in map units. If it is at least twice the raster resolution, one pixel every
+        floor(targetRes / resolution) is read, from the best overview level. In this case the returned image has its own
+        georef, located at the sampled pixels, and the raster georef is not modified
+        '''
+        if targetRes is not None and not self.hasRotation:
+            #tolerance for targetRes computed as a multiple of the pixel size
+            stepX = max(1, math.floor(targetRes / abs(self.pxSize.x) + 1e-9))
+            stepY = max(1, math.floor(targetRes / abs(self.pxSize.y) + 1e-9))
+            if stepX > 1 or stepY > 1:
+                return self._readAsDecimatedNpArray(subset, stepX, stepY)
+
+        box = None
         if subset and self.subBoxGeo is not None:
+            box = self.subBoxPx
+
+        data = None
+        if self.isTiff:
+            #Without GDAL, imaging libraries decode the whole file before slicing it,
+            #so only decode the tiff strips or tiles intersecting the subbox
+            data = self._readTiff(box, memmap=memmap, decode=getImgEngine() != 'GDAL')
+
+        if data is not None:
+            if box is not None:
+                self.georef.setSubBoxPx(box)
+                self.georef.applySubBox()
+            img = NpImage(data, noData=self.noData, georef=self.georef)
+        elif box is not None:
             #georef = GeoRef(self.size, self.pxSize, self.subBoxGeoOrigin, rot=self.rotation, pxCenter=True)
-            img = NpImage(self.path, subBoxPx=self.subBoxPx, noData=self.noData, georef=self.georef, adjustGeoref=True)
+            img = NpImage(self.path, subBoxPx=box, noData=self.noData, georef=self.georef, adjustGeoref=True)
         else:
             img = NpImage(self.path, noData=self.noData, georef=self.georef)
         return img
+
+    def _readAsDecimatedNpArray(self, subset, stepX, stepY):
+        #pixels window
+        if subset and self.subBoxGeo is not None:
+            box = self.subBoxPx
+            x, y = max(0, box.xmin), max(0, box.ymin)
+            w, h = min(box.xmax + 1, self.size.x) - x, min(box.ymax + 1, self.size.y) - y
+        else:
+            x, y = 0, 0
+            w, h = self.size
+
+        res = self._readDecimated(x, y, w, h, stepX, stepY)
+        if res is not None:
+            data, georef = res
+        else:
+            #no overview support, decimate the full resolution data
+            xs, ys = np.arange(x, x + w, stepX), np.arange(y, y + h, stepY)
+            data = NpImage(self.path).data[np.ix_(ys, xs)]
+            georef = self._sampledGeoRef(x + 0.5, y + 0.5, stepX, stepY, len(xs), len(ys))
+        return NpImage(data, noData=self.noData, georef=georef)
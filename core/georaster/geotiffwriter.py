@@ -0,0 +1,308 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import io
+import os
+import math
+import zlib
+import struct
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+from .npimg import NpImage
+from ..lib import Tyf
+from ..lib.Tyf import ifd as tyfIfd
+
+
+# TIFF field types
+SHORT, LONG, ASCII, DOUBLE = 3, 4, 2, 12
+
+
+class _TiledLevel():
+    '''
+    One resolution level of the output file. Rows of pixels are buffered until a full row
+    of tiles is available, tiles are then compressed and appended to the file.
+    Each completed row of tiles is downsampled and sent to the next overview level.
+    '''
+
+    def __init__(self, writer, w, h):
+        self.writer = writer
+        self.w, self.h = w, h
+        ts = writer.tileSize
+        self.nbTilesX = math.ceil(w / ts)
+        self.nbTilesY = math.ceil(h / ts)
+        self.offsets = []
+        self.byteCounts = []
+        #buffer for one row of tiles, width padded to the tile size
+        self.buff = np.zeros((ts, self.nbTilesX * ts, writer.nbBands), np.uint8)
+        self.filled = 0 #number of pixel rows currently in the buffer
+        self.y = 0 #number of pixel rows received
+        self.child = None
+
+    def addRows(self, data):
+        ts = self.writer.tileSize
+        i = 0
+        while i < data.shape[0]:
+            n = min(ts - self.filled, data.shape[0] - i)
+            self.buff[self.filled:self.filled+n, 0:self.w] = data[i:i+n]
+            self.filled += n
+            self.y += n
+            i += n
+            if self.filled == ts or self.y == self.h:
+                self.flushRow()
+
+    def flushRow(self):
+        if self.filled == 0:
+            return
+        ts = self.writer.tileSize
+        #TIFF tiles are always full, pad the last row of tiles by repeating the last line
+        if self.filled < ts:
+            self.buff[self.filled:] = self.buff[self.filled-1]
+        for i in range(self.nbTilesX):
+            offset, size = self.writer._writeTile(self.buff[:, i*ts:(i+1)*ts])
+            self.offsets.append(offset)
+            self.byteCounts.append(size)
+        if self.child is not None:
+            rows = self.filled
+            self.child.addRows(downsample(self.buff[0:rows, 0:self.w]))
+        self.filled = 0
+
+
+def downsample(data):
+    '''Reduce an array by a factor 2 with a 2x2 box filter, odd dimensions are padded by edge replication'''
+    h, w = data.shape[0:2]
+    if h % 2 or w % 2:
+        data = np.pad(data, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    acc = data[0::2, 0::2].astype(np.uint16)
+    acc += data[1::2, 0::2]
+    acc += data[0::2, 1::2]
+    acc += data[1::2, 1::2]
+    acc += 2 #rounding
+    return (acc // 4).astype(np.uint8)
+
+
+class GeoTiffWriter():
+    '''
+    Pure python tiled GeoTIFF writer, usefull to build large georeferenced rasters when GDAL is not available.
+    Pixels are pushed by strips of full width from top to bottom with writeStrip(), only one row of tiles
+    per resolution level is kept in memory. Tiles are deflate compressed and written as soon as they are complete,
+    the TIFF directories (written with Tyf) are appended at the end of the file when calling close().
+    Overviews are computed on the fly and stored as reduced resolution subfiles, as GDAL does.
+
+    The classic TIFF format is used, so the file size is limited to 4GB
+    '''
+
+    def __init__(self, path, w, h, georef, nbBands=4, tileSize=256, compress=6, predictor=True, overviews=True, worldFile=True):
+        '''
+        path = file system path for the ouput tiff
+        w, h = width and height in pixels
+        georef : a Georef object used to set georeferencing informations, optional
+        nbBands : 1 (grayscale), 3 (rgb) or 4 (rgba)
+        tileSize : size of internal tiles, must be a multiple of 16
+        compress : zlib compression level, 0 to disable compression
+        predictor : use horizontal differencing, improve compression ratio
+        overviews : build internal overviews until the image fits into one tile
+        worldFile : also write the georeferencing to a .tfw file, for softwares which don't read the geotags
+        '''
+        if tileSize % 16:
+            raise ValueError('Tile size must be a multiple of 16')
+        if nbBands not in (1, 3, 4):
+            raise ValueError('Unsupported number of bands')
+        self.path = path
+        self.w, self.h = w, h
+        self.size = (w, h)
+        self.georef = georef
+        self.nbBands = nbBands
+        self.tileSize = tileSize
+        self.compress = compress
+        self.predictor = predictor and compress > 0
+        self.worldFile = worldFile
+        self.dtype = 'uint8'
+
+        self.f = io.open(path, 'wb')
+        #header, offset of the first IFD is updated on close
+        self.f.write(struct.pack('<2sHL', b'II', 42, 0))
+
+        #resolution levels
+        self.levels = [_TiledLevel(self, w, h)]
+        if overviews:
+            lw, lh = w, h
+            while lw > tileSize or lh > tileSize:
+                lw, lh = math.ceil(lw / 2), math.ceil(lh / 2)
+                level = _TiledLevel(self, lw, lh)
+                self.levels[-1].child = level
+                self.levels.append(level)
+
+    def __repr__(self):
+        return '\n'.join([
+        "* Data infos :",
+        " size {}".format(self.size),
+        " type {}".format(self.dtype),
+        " number of bands {}".format(self.nbBands),
+        " overviews {}".format(len(self.levels) - 1),
+        "* Georef & Geometry : \n{}".format(self.georef)
+        ])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _writeTile(self, tile):
+        '''Compress and append a tile to the file, return its offset and byte count'''
+        if self.predictor:
+            tile = tile.copy()
+            tile[:, 1:] -= tile[:, :-1].copy() #uint8 arithmetic wraps as expected by the tiff predictor
+        data = np.ascontiguousarray(tile).tobytes()
+        if self.compress:
+            data = zlib.compress(data, self.compress)
+        offset = self.f.tell()
+        if offset + len(data) >= 2**32:
+            raise IOError('Output file exceed classic TIFF size limit (4GB)')
+        self.f.write(data)
+        return offset, len(data)
+
+    def writeStrip(self, data, x, y):
+        '''
+        Append a block of full width rows (numpy array rgb or rgba), strips must be written from top to bottom
+        Missing bands are completed (opaque alpha) and extra bands are dropped
+        '''
+        if isinstance(data, NpImage):
+            data = data.data
+        if x != 0 or data.shape[1] != self.w:
+            raise ValueError('Strips must cover the full width of the image')
+        if y != self.levels[0].y:
+            raise ValueError('Strips must be written in order, expected row {}'.format(self.levels[0].y))
+        if data.ndim == 2:
+            data = data[:, :, None]
+        n = data.shape[2]
+        if n != self.nbBands:
+            if self.nbBands == 1:
+                data = data[:, :, 0:1]
+            elif n < 3:
+                data = np.repeat(data[:, :, 0:1], 3, axis=2)
+            if data.shape[2] > self.nbBands:
+                data = data[:, :, 0:self.nbBands]
+            elif data.shape[2] < self.nbBands:
+                alpha = np.full(data.shape[0:2] + (1,), 255, np.uint8)
+                data = np.concatenate((data, alpha), axis=2)
+        self.levels[0].addRows(data)
+
+    def flush(self):
+        '''For compatibility with BigTiffWriter, strips are written synchronously'''
+        pass
+
+    ############################################
+    # Tiff directories
+
+    def _geoTags(self, tif):
+        '''Add GeoTIFF tags to a Tyf ifd'''
+        georef = self.georef
+        xmin, ymax = georef.corners[0]
+        if georef.hasRotation:
+            xres, yres = georef.pxSize
+            xrot, yrot = georef.rotation
+            tif.set(34264, DOUBLE, (xres, xrot, 0., xmin, yrot, yres, 0., ymax, 0., 0., 0., 0., 0., 0., 0., 1.)) #ModelTransformationTag
+        else:
+            tif.set(33550, DOUBLE, (abs(georef.pxSize.x), abs(georef.pxSize.y), 0.)) #ModelPixelScaleTag
+            tif.set(33922, DOUBLE, (0., 0., 0., xmin, ymax, 0.)) #ModelTiepointTag
+
+        #GeoKeyDirectory : header (version, revision, minor, number of keys) then (key, location, count, value)
+        keys = [(1025, 0, 1, 1)] #GTRasterTypeGeoKey = RasterPixelIsArea
+        ascii = b''
+        crs = georef.crs
+        if crs is not None:
+            geographic = crs.isGeo
+            if geographic is None and crs.isEPSG:
+                geographic = 4000 <= crs.code < 5000
+            keys.append((1024, 0, 1, 2 if geographic else 1)) #GTModelTypeGeoKey
+            if crs.isEPSG:
+                keys.append((2048 if geographic else 3072, 0, 1, crs.code)) #GeographicTypeGeoKey or ProjectedCSTypeGeoKey
+            else:
+                citation = str(crs).encode('ascii', 'replace') + b'|'
+                keys.append((1026, 34737, len(citation), len(ascii))) #GTCitationGeoKey
+                ascii += citation
+        keys.sort()
+        directory = (1, 1, 0, len(keys)) + sum(keys, ())
+        tif.set(34735, SHORT, directory)
+        if ascii:
+            tif.set(34737, ASCII, ascii + b'\x00')
+
+    def _ifd(self, level, overview):
+        tif = tyfIfd.Ifd()
+        n = self.nbBands
+        tif.set(254, LONG, 1 if overview else 0) #NewSubfileType, reduced resolution image
+        tif.set(256, LONG, level.w) #ImageWidth
+        tif.set(257, LONG, level.h) #ImageLength
+        tif.set(258, SHORT, (8,) * n) #BitsPerSample
+        tif.set(259, SHORT, 8 if self.compress else 1) #Compression, adobe deflate
+        tif.set(262, SHORT, 1 if n == 1 else 2) #PhotometricInterpretation, min is black or RGB
+        tif.set(277, SHORT, n) #SamplesPerPixel
+        tif.set(284, SHORT, 1) #PlanarConfiguration, contiguous
+        if self.predictor:
+            tif.set(317, SHORT, 2) #Predictor, horizontal differencing
+        tif.set(322, SHORT, self.tileSize) #TileWidth
+        tif.set(323, SHORT, self.tileSize) #TileLength
+        tif.set(324, LONG, tuple(level.offsets)) #TileOffsets
+        tif.set(325, LONG, tuple(level.byteCounts)) #TileByteCounts
+        if n == 4:
+            tif.set(338, SHORT, 2) #ExtraSamples, unassociated alpha
+        tif.set(339, SHORT, (1,) * n) #SampleFormat, unsigned integer
+        if not overview and self.georef is not None:
+            self._geoTags(tif)
+        return tif
+
+    def close(self):
+        '''Write remaining tiles and the tiff directories, no more strips can be added after this call'''
+        if self.f is None:
+            return
+        try:
+            #complete missing rows (canceled build) with transparent pixels
+            base = self.levels[0]
+            if base.y < self.h:
+                log.warning('Incomplete GeoTIFF, {} missing rows'.format(self.h - base.y))
+                blank = np.zeros((self.tileSize, self.w, self.nbBands), np.uint8)
+                while base.y < self.h:
+                    base.addRows(blank[0:min(self.tileSize, self.h - base.y)])
+
+            #write the directories chain at the end of the file
+            self.f.seek(0, 2)
+            pointer = 4 #location of the previous "next ifd" offset
+            for i, level in enumerate(self.levels):
+                offset = self.f.seek(0, 2)
+                offset += offset % 2 #ifd must begin on a word boundary
+                self.f.seek(offset)
+                nextPointer = Tyf._write_IFD(self._ifd(level, i > 0), self.f, offset)
+                self.f.seek(pointer)
+                self.f.write(struct.pack('<L', offset))
+                pointer = nextPointer
+            if self.worldFile and self.georef is not None:
+                self.georef.toWorldFile(os.path.splitext(self.path)[0] + '.tfw')
+        finally:
+            self.f.close()
+            self.f = None
+
+    def __del__(self):
+        if getattr(self, 'f', None) is not None:
+            self.close()
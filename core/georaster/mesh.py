@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import numpy as np
+
+
+def nodataMask(data, noData=None):
+    '''Return a boolean array flagging masked, nodata and nan values'''
+    mask = np.ma.getmaskarray(data).copy()
+    values = np.ma.getdata(data)
+    if noData is not None:
+        if np.isnan(noData):
+            mask |= np.isnan(values)
+        else:
+            mask |= values == noData
+    return mask
+
+
+def demToMesh(georef, data=None, step=1, noData=None, dx=0, dy=0, reproj=None, buildFaces=True):
+    '''
+    Build the vertices and the quad faces of a grid mesh from a raster, without any loop over the pixels
+    georef : GeoRef of the raster window, vertices are located at pixels center
+    data : 2D array of elevations matching the georef, None to build a flat mesh
+    step : take one pixel every step pixels in both directions
+    noData : value flagging cells without elevation, these vertices and the faces using them are discarded
+    dx, dy : shift applied to vertices coordinates, after the optional reprojection
+    reproj : a Reproj object, all the vertices are reprojected in one batch
+    Return verts (n, 3) float array and faces (m, 4) int array of vertex indices, ordered anticlockwise (face up)
+    '''
+    w, h = georef.rSize.x, georef.rSize.y
+    x0, y0 = georef.origin #pxcenter
+    pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
+
+    cols = np.arange(0, w, step)
+    rows = np.arange(0, h, step)
+    nx, ny = len(cols), len(rows)
+
+    if data is None:
+        zz = np.zeros((ny, nx))
+        valid = np.ones((ny, nx), dtype=bool)
+    else:
+        if data.ndim != 2:
+            raise ValueError('Elevation data must be a one band raster')
+        zz = data[::step, ::step]
+        valid = ~nodataMask(zz, noData)
+        zz = np.ma.getdata(zz)
+
+    #coordinates of valid vertices only, so nodata are not reprojected
+    xx = x0 + pxSizeX * cols
+    yy = y0 + pxSizeY * rows
+    xs = np.broadcast_to(xx, (ny, nx))[valid]
+    ys = np.broadcast_to(yy[:, None], (ny, nx))[valid]
+    if reproj is not None and len(xs):
+        xs, ys = reproj.arrays(xs, ys)
+    verts = np.column_stack((xs - dx, ys - dy, zz[valid]))
+
+    if not buildFaces or nx < 2 or ny < 2:
+        return verts, np.empty((0, 4), dtype=np.int64)
+
+    #index of each grid node in the vertices array, -1 for nodata
+    idx = np.full((ny, nx), -1, dtype=np.int64)
+    idx[valid] = np.arange(len(verts))
+
+    #quad corners, cell (i, j) is bounded by rows i, i+1 and columns j, j+1 (rows counting from top)
+    topLeft, topRight = idx[:-1, :-1], idx[:-1, 1:]
+    bottomLeft, bottomRight = idx[1:, :-1], idx[1:, 1:]
+    faces = np.stack((topRight, topLeft, bottomLeft, bottomRight), axis=-1).reshape(-1, 4)
+    faces = faces[(faces >= 0).all(axis=1)]
+    return verts, faces
@@ -0,0 +1,273 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import io
+import os
+import time
+import random
+import threading
+import tracemalloc
+import concurrent.futures
+
+import numpy as np
+
+from .npimg import NpImage, getImgEngine
+from ..checkdeps import HAS_GDAL, HAS_PIL, HAS_IMGIO
+
+if HAS_PIL:
+    from PIL import Image
+
+if HAS_GDAL:
+    from osgeo import gdal
+
+if HAS_IMGIO:
+    from ..lib import imageio
+
+
+def rgba32(color):
+    '''Pack an rgba color as the uint32 value of its 4 bytes in memory order'''
+    return np.frombuffer(bytes(color), np.uint32)[0]
+
+
+class MosaicBuilder():
+    '''
+    Assemble tiles into a single preallocated RGBA array
+    Tiles are decoded and written into views of the output array, without intermediate NpImage objects.
+    With GDAL, bands are directly decoded into the output array, others imaging libraries decode
+    the tile into a temporary array which is then copied once.
+
+    trace (bool) : track the peak memory allocated while building the mosaic with tracemalloc.
+    Tracing has an overhead, it should only be enabled for profiling
+    memmap (bool) : store the output array in a memory mapped temporary file instead of RAM
+    '''
+
+    def __init__(self, width, height, bkgColor=(255,255,255,255), georef=None, trace=False, memmap=False):
+        self.IFACE = getImgEngine()
+        self.georef = georef
+
+        self.trace = trace and not tracemalloc.is_tracing()
+        if self.trace:
+            tracemalloc.start()
+
+        self.t0 = time.perf_counter()
+        if memmap:
+            self.data = NpImage.newMemmap(width, height, bkgColor=bkgColor).data
+        else:
+            self.data = np.empty((height, width, 4), np.uint8)
+        #rgba pixels seen as single uint32 values, a color fill is then a plain contiguous write
+        self.data32 = self.data.view(np.uint32)[:, :, 0]
+        if not memmap:
+            self.data32[:] = rgba32(bkgColor)
+        #stats
+        self.lock = threading.Lock() #tiles can be decoded by several threads
+        self.nbTiles = 0
+        self.nbBytes = 0 #size of the decoded streams
+        self.peakMemory = None
+
+    def _count(self, nbBytes=0):
+        with self.lock:
+            self.nbTiles += 1
+            self.nbBytes += nbBytes
+
+    @property
+    def size(self):
+        h, w = self.data.shape[0:2]
+        return w, h
+
+    @property
+    def stats(self):
+        elapsed = time.perf_counter() - self.t0
+        w, h = self.size
+        if self.trace:
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+        return {
+            'tiles' : self.nbTiles,
+            'megapixels' : w * h / 1e6,
+            'seconds' : elapsed,
+            'tilesPerSecond' : self.nbTiles / elapsed if elapsed else None,
+            'megapixelsPerSecond' : w * h / 1e6 / elapsed if elapsed else None,
+            'inputMB' : self.nbBytes / 1024**2,
+            'peakMemory' : self.peakMemory #bytes, None if tracing is disabled
+        }
+
+    def _view(self, x, y, w, h):
+        '''Return the view of the output array matching the tile position, clipped to the mosaic extent'''
+        return self.data[y:y+h, x:x+w]
+
+    def fill(self, x, y, w, h, color):
+        '''Fill an area with an rgba color'''
+        self.data32[y:y+h, x:x+w] = rgba32(color)
+        self._count()
+
+    def paste(self, data, x, y):
+        '''Copy an array (one band, rgb or rgba) into the mosaic, with rgb input the alpha band is unchanged'''
+        self._count()
+        return self._paste(data, x, y)
+
+    def _paste(self, data, x, y):
+        h, w = data.shape[0:2]
+        view = self._view(x, y, w, h)
+        h, w = view.shape[0:2]
+        if data.ndim == 2:
+            view[:, :, 0:3] = data[:h, :w, None]
+        elif data.shape[2] == 2: #grayscale and alpha
+            view[:, :, 0:3] = data[:h, :w, 0:1]
+            view[:, :, 3] = data[:h, :w, 1]
+        else:
+            n = min(4, data.shape[2])
+            view[:, :, 0:n] = data[:h, :w, 0:n]
+        return view
+
+    def decode(self, data, x, y):
+        '''
+        Decode an image stream into the mosaic at given position
+        Return the view of the output array filled by the tile or raise an exception if the stream is not a valid image
+        Tiles can be decoded concurrently by several threads as long as they don't overlap
+        '''
+        if self.IFACE == 'GDAL':
+            view = self._decodeGDAL(data, x, y)
+        elif self.IFACE == 'PIL':
+            img = Image.open(io.BytesIO(data))
+            if img.mode not in ('L', 'RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            view = self._paste(np.asarray(img), x, y)
+        elif self.IFACE == 'IMGIO':
+            view = self._paste(imageio.imread(data), x, y)
+        self._count(len(data))
+        return view
+
+    def _decodeGDAL(self, data, x, y):
+        #build a random name to make the function thread safe
+        vsipath = '/vsimem/' + ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for i in range(5))
+        gdal.FileFromMemBuffer(vsipath, data)
+        try:
+            ds = gdal.Open(vsipath)
+            if ds is None:
+                raise IOError('Unable to decode tile data')
+            nbBands = ds.RasterCount
+            if nbBands == 1 and ds.GetRasterBand(1).GetColorTable() is not None:
+                #indexed colors, let NpImage convert the palette
+                return self._paste(NpImage(ds).data, x, y)
+            view = self._view(x, y, ds.RasterXSize, ds.RasterYSize)
+            h, w = view.shape[0:2]
+            if nbBands <= 2: #grayscale with optional alpha
+                ds.GetRasterBand(1).ReadAsArray(0, 0, w, h, buf_obj=view[:, :, 0])
+                view[:, :, 1] = view[:, :, 0]
+                view[:, :, 2] = view[:, :, 0]
+                if nbBands == 2:
+                    ds.GetRasterBand(2).ReadAsArray(0, 0, w, h, buf_obj=view[:, :, 3])
+            else:
+                for i in range(min(4, nbBands)):
+                    ds.GetRasterBand(i+1).ReadAsArray(0, 0, w, h, buf_obj=view[:, :, i])
+            ds = None
+        finally:
+            gdal.Unlink(vsipath)
+        return view
+
+    def close(self):
+        '''Stop memory tracing'''
+        if self.trace:
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.trace = False
+
+    def toNpImage(self):
+        '''Return the mosaic as a georeferenced NpImage, the array is not copied'''
+        self.close()
+        return NpImage(self.data, georef=self.georef)
+
+
+def decodeTile(data):
+    '''Decode an image stream to a numpy array, top level function so that it can be run by a worker process'''
+    return NpImage(data).data
+
+
+class TileDecoder():
+    '''
+    Run decoding jobs with a pool of threads or processes and yield the results in completion order
+    poolType : 'THREAD', 'PROCESS' or None to decode in the calling thread
+    poolSize : number of workers, cpu count if None
+
+    Threads are efficient because imaging libraries release the GIL while decoding. Processes do not
+    share the GIL at all but decoded arrays have to be pickled back to the main process. Note that
+    Blender's embedded interpreter can not always spawn worker processes.
+    '''
+
+    POOL_TYPES = ['THREAD', 'PROCESS', None]
+
+    def __init__(self, poolType='THREAD', poolSize=None):
+        if poolType not in self.POOL_TYPES:
+            raise ValueError('Unknown pool type ' + str(poolType))
+        self.poolType = poolType
+        self.poolSize = poolSize or os.cpu_count() or 1
+        self.pool = None
+        if poolType == 'THREAD':
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.poolSize)
+        elif poolType == 'PROCESS':
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.poolSize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def imap(self, fn, jobs):
+        '''
+        jobs : iterable of (key, args), fn(*args) is called for each job
+        yield (key, result, exception) in completion order, exception is None if the job succeeds
+        The number of pending jobs is bounded so that results don't accumulate in memory
+        '''
+        if self.pool is None:
+            for key, args in jobs:
+                try:
+                    yield key, fn(*args), None
+                except Exception as e:
+                    yield key, None, e
+            return
+
+        maxPending = self.poolSize * 2
+        pending = {}
+        jobs = iter(jobs)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < maxPending:
+                try:
+                    key, args = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[self.pool.submit(fn, *args)] = key
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                e = future.exception()
+                if e is None:
+                    yield key, future.result(), None
+                else:
+                    yield key, None, e
@@ -21,12 +21,18 @@
 
 import os
 import io
+import mmap
 import random
+import logging
+import tempfile
+import weakref
+log = logging.getLogger(__name__)
 
 import numpy as np
 
 from .georef import GeoRef
 from ..proj.reproj import reprojImg
+from .warp import warp
 from ..maths.fillnodata import replace_nans #inpainting function (ie fill nodata)
 from ..utils import XY as xy
 from ..checkdeps import HAS_GDAL, HAS_PIL, HAS_IMGIO
@@ -42,30 +48,35 @@ if HAS_IMGIO:
     from ..lib import imageio
 
 
-class NpImage():
-    '''Represent an image as Numpy array'''
+def getImgEngine():
+    '''Return the imaging library to use according to settings and available modules'''
 
-    def _getIFACE(self):
+    engine = settings.img_engine
 
-        engine = settings.img_engine
-
-        if engine == 'AUTO':
-            if HAS_GDAL:
-                return 'GDAL'
-            elif HAS_IMGIO:
-                return 'IMGIO'
-            elif HAS_PIL:
-                return 'PIL'
-            else:
-                raise ImportError("No image engine available")
-        elif engine == 'GDAL'and HAS_GDAL:
+    if engine == 'AUTO':
+        if HAS_GDAL:
             return 'GDAL'
-        elif engine == 'IMGIO' and HAS_IMGIO:
+        elif HAS_IMGIO:
             return 'IMGIO'
-        elif engine == 'PIL'and HAS_PIL:
+        elif HAS_PIL:
             return 'PIL'
         else:
-            raise ImportError(str(engine) + " interface unavailable")
+            raise ImportError("No image engine available")
+    elif engine == 'GDAL'and HAS_GDAL:
+        return 'GDAL'
+    elif engine == 'IMGIO' and HAS_IMGIO:
+        return 'IMGIO'
+    elif engine == 'PIL'and HAS_PIL:
+        return 'PIL'
+    else:
+        raise ImportError(str(engine) + " interface unavailable")
+
+
+class NpImage():
+    '''Represent an image as Numpy array'''
+
+    def _getIFACE(self):
+        return getImgEngine()
 
     #GeoGef delegation by composition instead of inheritance
     #this special method is called whenever the requested attribute or method is not found in the object
@@ -218,6 +229,32 @@ class NpImage():
         data[:,:,3] = a
         return cls(data, noData=noData, georef=georef)
 
+    @classmethod
+    def newMemmap(cls, w, h, path=None, bkgColor=(255,255,255,255), noData=None, georef=None):
+        '''
+        Create a new rgba image backed by a memory mapped file, so that its size is not limited by the available RAM
+        If no path is submited, the data is stored in a temporary file removed when the array is released
+        '''
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='bgis_', suffix='.raw')
+            os.close(fd)
+            temp = True
+        else:
+            temp = False
+        data = np.memmap(path, dtype=np.uint8, mode='w+', shape=(h, w, 4))
+        if temp:
+            weakref.finalize(data, _removeFile, path)
+        #fill by strips to avoid touching the whole mapping at once
+        strip = max(1, 2**24 // (w * 4))
+        for y in range(0, h, strip):
+            data[y:y+strip] = bkgColor
+        return cls(data, noData=noData, georef=georef)
+
+    @property
+    def isMemmap(self):
+        '''Flag if the data is backed by a memory mapped file'''
+        return isinstance(self.data, np.memmap) and self.data.filename is not None
+
     def _applySubBox(self, data):
         '''Use numpy slice to extract subset of data'''
         if self.subBoxPx is not None:
@@ -275,7 +312,10 @@ class NpImage():
         if img.mode == 'P': #palette (indexed color)
             img = img.convert('RGBA')
         data = np.asarray(img)
-        data.setflags(write=True) #PIL return a non writable array
+        try:
+            data.setflags(write=True) #PIL return a non writable array
+        except ValueError:
+            data = data.copy() #recent numpy refuse it for arrays that don't own their buffer
         return self._applySubBox(data)
 
     def _npFromGDAL(self, ds):
@@ -354,7 +394,10 @@ class NpImage():
 
 
     def toGDAL(self):
-        '''Get GDAL memory driver dataset'''
+        '''Get GDAL memory driver dataset, or a raw VRT dataset pointing to the file of a memory mapped image'''
+        if self.isMemmap and self.data.mode != 'c':
+            #pages modified in a copy on write mapping are not visible from the file
+            return self._memmapToGDAL()
         w, h = self.size
         n = self.nbBands
         dtype = str(self.dtype)
@@ -376,6 +419,48 @@ class NpImage():
         return mem
 
 
+    def _memmapToGDAL(self):
+        '''
+        Build a VRT dataset whose raw bands directly read the memory mapped file, the data is not copied
+        Any strided view of the mapping is supported (subbox, bands subset)
+        '''
+        data = self.data
+        data.flush()
+        #file offset of the first item : numpy maps the file from an allocation granularity aligned offset
+        mapStart = data.offset - data.offset % mmap.ALLOCATIONGRANULARITY
+        mapAddr = np.frombuffer(data._mmap, dtype=np.uint8).__array_interface__['data'][0]
+        offset = mapStart + data.__array_interface__['data'][0] - mapAddr
+
+        w, h = self.size
+        n = self.nbBands
+        dtype = str(self.dtype)
+        if dtype == 'uint8': dtype = 'byte'
+        dtype = gdal.GetDataTypeName(gdal.GetDataTypeByName(dtype))
+        byteOrder = 'MSB' if data.dtype.byteorder == '>' else 'LSB'
+        lineOffset = data.strides[0]
+        pixelOffset = data.strides[1]
+        bandOffset = data.strides[2] if data.ndim == 3 else 0
+
+        bands = []
+        for i in range(n):
+            bands.append('''
+    <VRTRasterBand dataType="{}" band="{}" subClass="VRTRawRasterBand">
+        <SourceFilename relativeToVRT="0">{}</SourceFilename>
+        <ImageOffset>{}</ImageOffset>
+        <PixelOffset>{}</PixelOffset>
+        <LineOffset>{}</LineOffset>
+        <ByteOrder>{}</ByteOrder>
+    </VRTRasterBand>'''.format(dtype, i+1, os.path.abspath(data.filename), offset + i * bandOffset, pixelOffset, lineOffset, byteOrder))
+        vrt = '<VRTDataset rasterXSize="{}" rasterYSize="{}">{}\n</VRTDataset>'.format(w, h, ''.join(bands))
+
+        ds = gdal.Open(vrt)
+        #write georef
+        if self.isGeoref:
+            ds.SetGeoTransform(self.georef.toGDAL())
+            if self.georef.crs is not None:
+                ds.SetProjection(self.georef.crs.getOgrSpatialRef().ExportToWkt())
+        return ds
+
     def removeAlpha(self):
         if self.hasAlpha:
             self.data = self.data[:, :, 0:3]
@@ -472,9 +557,14 @@ class NpImage():
             self.data = replace_nans(self.data, max_iter=5, tolerance=0.5, kernel_size=2, method='localmean')
 
     def reproj(self, crs1, crs2, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL'):
-        ds1 = self.toGDAL()
+        '''Reproject the image with GDAL, or with the numpy warper if GDAL is not available'''
         if not self.isGeoref:
             raise IOError('Unable to reproject non georeferenced image')
+        if not HAS_GDAL:
+            data, georef = warp(self.data, self.georef, crs1, crs2, out_ul=out_ul, out_size=out_size, out_res=out_res,
+                sqPx=sqPx, resamplAlg=resamplAlg, noData=self.noData)
+            return NpImage(data, noData=self.noData, georef=georef)
+        ds1 = self.toGDAL()
         ds2 = reprojImg(crs1, crs2, ds1, out_ul=out_ul, out_size=out_size, out_res=out_res, sqPx=sqPx, resamplAlg=resamplAlg)
         return NpImage(ds2)
 
@@ -488,3 +578,10 @@ class NpImage():
         "* Statistics : min {} max {}".format(self.getMin(), self.getMax()),
         "* Georef & Geometry : \n{}".format(self.georef)
         ])
+
+
+def _removeFile(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        log.warning('Unable to remove temporary file {} : {}'.format(path, e))
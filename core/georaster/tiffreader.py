@@ -0,0 +1,322 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import io
+import zlib
+import struct
+
+import numpy as np
+
+from ..lib import Tyf
+
+
+#Compression schemes
+NONE, LZW, DEFLATE, ADOBE_DEFLATE, PACKBITS = 1, 5, 32946, 8, 32773
+
+SAMPLE_FORMATS = {1:'u', 2:'i', 3:'f'}
+
+
+def lzwDecode(data):
+    '''Decode a TIFF LZW stream (msb first codes with early change)'''
+    CLEAR, EOI = 256, 257
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    codeLen = 9
+    prev = None
+    pos, n = 0, len(data)
+    bitBuff, bitCount = 0, 0
+    while True:
+        while bitCount < codeLen:
+            if pos == n:
+                return bytes(out) #missing EOI code
+            bitBuff = (bitBuff << 8) | data[pos]
+            pos += 1
+            bitCount += 8
+        bitCount -= codeLen
+        code = bitBuff >> bitCount
+        bitBuff &= (1 << bitCount) - 1
+        if code == CLEAR:
+            del table[258:]
+            codeLen = 9
+            prev = None
+            continue
+        if code == EOI:
+            break
+        if prev is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+            else:
+                entry = prev + prev[:1]
+            table.append(prev + entry[:1])
+        out += entry
+        prev = entry
+        if len(table) + 1 >= (1 << codeLen) and codeLen < 12:
+            codeLen += 1
+    return bytes(out)
+
+
+def packBitsDecode(data):
+    '''Decode a PackBits (run length) stream'''
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i]
+        i += 1
+        if c < 128: #literal run
+            out += data[i:i+c+1]
+            i += c + 1
+        elif c > 128: #repeated byte
+            out += data[i:i+1] * (257 - c)
+            i += 1
+    return bytes(out)
+
+
+class TiffReader():
+    '''
+    Read a window of pixels from a TIFF file without decoding the whole image.
+    Tags are parsed with Tyf, then only the strips or tiles intersecting the window are read and decoded.
+    Supported : uncompressed, deflate, LZW and PackBits compression, horizontal and floating point predictors,
+    chunky or planar layout, 8 to 64 bits samples. BigTIFF, JPEG compression and indexed colors are not supported
+    and raise a NotImplementedError
+    '''
+
+    @staticmethod
+    def levels(path):
+        '''
+        List the resolution levels of a tiff file as (ifd index, width, height), full resolution first
+        Overviews are the subfiles flagged as reduced resolution images, masks are ignored
+        '''
+        levels = []
+        for i, tif in enumerate(Tyf.open(path)):
+            subfileType = tif.get(254).value[0] if tif.get(254) is not None else 0
+            if (i == 0 or subfileType & 1) and not subfileType & 4:
+                levels.append( (i, tif.get(256).value[0], tif.get(257).value[0]) )
+        return levels
+
+    def __init__(self, path, idx=0):
+        self.path = path
+        self.idx = idx
+        with io.open(path, 'rb') as f:
+            header = f.read(4)
+        if header[0:2] not in (b'II', b'MM'):
+            raise IOError('Not a valid TIFF file')
+        self.byteorder = '<' if header[0:2] == b'II' else '>'
+        if struct.unpack(self.byteorder + 'H', header[2:4])[0] == 43:
+            raise NotImplementedError('BigTIFF file not supported')
+
+        tif = Tyf.open(path)[idx]
+        tag = lambda k, default=None: tif.get(k).value if tif.get(k) is not None else default
+
+        self.width = tag(256)[0]
+        self.height = tag(257)[0]
+        self.nbBands = tag(277, (1,))[0]
+        bits = tag(258, (1,))
+        self.compression = tag(259, (NONE,))[0]
+        self.photometric = tag(262, (None,))[0]
+        self.planar = tag(284, (1,))[0]
+        self.predictor = tag(317, (1,))[0]
+        sampleFormat = tag(339, (1,))[0]
+
+        if any(b != bits[0] for b in bits) or bits[0] not in (8, 16, 32, 64):
+            raise NotImplementedError('Unsupported bit depth {}'.format(bits))
+        if sampleFormat not in SAMPLE_FORMATS:
+            raise NotImplementedError('Unsupported sample format {}'.format(sampleFormat))
+        if self.compression not in (NONE, LZW, DEFLATE, ADOBE_DEFLATE, PACKBITS):
+            raise NotImplementedError('Unsupported compression {}'.format(self.compression))
+        if self.photometric == 3:
+            raise NotImplementedError('Indexed colors not supported')
+        if self.predictor not in (1, 2, 3):
+            raise NotImplementedError('Unsupported predictor {}'.format(self.predictor))
+        self.dtype = np.dtype(self.byteorder + SAMPLE_FORMATS[sampleFormat] + str(bits[0] // 8))
+
+        self.isTiled = tif.get(324) is not None
+        if self.isTiled:
+            self.blockWidth = tag(322)[0]
+            self.blockHeight = tag(323)[0]
+            self.offsets = tag(324)
+            self.byteCounts = tag(325)
+        else:
+            self.blockWidth = self.width
+            self.blockHeight = min(tag(278, (self.height,))[0], self.height)
+            self.offsets = tag(273)
+            self.byteCounts = tag(279)
+        self.nbBlocksX = -(-self.width // self.blockWidth)
+        self.nbBlocksY = -(-self.height // self.blockHeight)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def isContiguous(self):
+        '''Flag if pixels are stored uncompressed, interleaved and in a single contiguous block of bytes'''
+        if self.compression != NONE or self.predictor != 1 or self.isTiled:
+            return False
+        if self.planar == 2 and self.nbBands > 1:
+            return False
+        rowSize = self.width * self.nbBands * self.dtype.itemsize
+        expected = self.offsets[0]
+        for i, (offset, byteCount) in enumerate(zip(self.offsets, self.byteCounts)):
+            size = min(self.blockHeight, self.height - i * self.blockHeight) * rowSize
+            if offset != expected or byteCount < size:
+                return False
+            expected += size
+        return True
+
+    def memmap(self):
+        '''
+        Return the whole raster as a numpy memmap, pixels are read from disk only when accessed
+        so slicing a window or a step is free. The mapping is copy on write, changes are never written to the file
+        '''
+        if not self.isContiguous:
+            raise NotImplementedError('Only uncompressed contiguous tiff can be memory mapped')
+        if self.nbBands == 1:
+            shape = (self.height, self.width)
+        else:
+            shape = (self.height, self.width, self.nbBands)
+        return np.memmap(self.path, dtype=self.dtype, mode='c', offset=self.offsets[0], shape=shape)
+
+    def _decompress(self, data):
+        if self.compression in (DEFLATE, ADOBE_DEFLATE):
+            return zlib.decompress(data)
+        elif self.compression == LZW:
+            return lzwDecode(data)
+        elif self.compression == PACKBITS:
+            return packBitsDecode(data)
+        return data
+
+    def _readBlock(self, f, idx, nbRows, r0, r1):
+        '''
+        Return rows r0 to r1 of a strip or tile as an array (rows, width, samples)
+        nbRows is the number of rows stored in the block, samples is 1 if the layout is planar
+        '''
+        spp = self.nbBands if self.planar == 1 else 1
+        rowSize = self.blockWidth * spp * self.dtype.itemsize
+        if self.compression == NONE and self.predictor == 1:
+            #only read the requested rows
+            f.seek(self.offsets[idx] + r0 * rowSize)
+            data = f.read((r1 - r0) * rowSize)
+            return np.frombuffer(data, self.dtype).reshape(r1 - r0, self.blockWidth, spp)
+        f.seek(self.offsets[idx])
+        data = self._decompress(f.read(self.byteCounts[idx]))
+        data = data[0:nbRows * rowSize]
+        if self.predictor == 3:
+            #floating point predictor : bytes are differenced, then stored by planes from the most significant
+            n = self.dtype.itemsize
+            arr = np.frombuffer(data, np.uint8).reshape(nbRows, -1, spp)
+            arr = np.cumsum(arr, axis=1, dtype=np.uint8) #bytes are differenced with a stride of one pixel
+            arr = arr.reshape(nbRows, n, -1).transpose(0, 2, 1)
+            arr = np.ascontiguousarray(arr).view(self.dtype.newbyteorder('>'))
+            arr = arr.reshape(nbRows, self.blockWidth, spp)
+        else:
+            arr = np.frombuffer(data, self.dtype).reshape(nbRows, self.blockWidth, spp)
+            if self.predictor == 2:
+                #horizontal differencing, integer overflow wraps as expected
+                arr = np.cumsum(arr, axis=1, dtype=self.dtype)
+        return arr[r0:r1]
+
+    def readWindow(self, x, y, w, h, outSize=None):
+        '''
+        Read a window of pixels, (x, y) is the upper left pixel, the window is clipped to the raster extent
+        outSize : (width, height) of the returned array, the window is decimated with a nearest neighbor sampling,
+        only the blocks containing sampled pixels are decoded
+        Return a numpy array (h, w) for one band rasters or (h, w, bands)
+        '''
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        x, y = max(0, x), max(0, y)
+        w, h = x1 - x, y1 - y
+        if w <= 0 or h <= 0:
+            raise ValueError('Window outside raster extent')
+        if outSize is not None and tuple(outSize) != (w, h):
+            xs = x + sampleIndices(w, outSize[0])
+            ys = y + sampleIndices(h, outSize[1])
+            return self._readSampled(xs, ys)
+        bw, bh = self.blockWidth, self.blockHeight
+        out = np.empty((h, w, self.nbBands), self.dtype.newbyteorder('='))
+        planes = range(self.nbBands) if self.planar == 2 else [None]
+        nbBlocks = self.nbBlocksX * self.nbBlocksY
+        with io.open(self.path, 'rb') as f:
+            for by in range(y // bh, (y + h - 1) // bh + 1):
+                #rows stored in the block, last strip can be shorter than others
+                nbRows = bh if self.isTiled else min(bh, self.height - by * bh)
+                r0 = max(y, by * bh) - by * bh
+                r1 = min(y + h, by * bh + nbRows) - by * bh
+                for bx in range(x // bw, (x + w - 1) // bw + 1):
+                    c0 = max(x, bx * bw) - bx * bw
+                    c1 = min(x + w, (bx + 1) * bw) - bx * bw
+                    oy, ox = by * bh + r0 - y, bx * bw + c0 - x
+                    for plane in planes:
+                        idx = by * self.nbBlocksX + bx
+                        if plane is not None:
+                            idx += plane * nbBlocks
+                        block = self._readBlock(f, idx, nbRows, r0, r1)
+                        if plane is None:
+                            out[oy:oy+r1-r0, ox:ox+c1-c0] = block[:, c0:c1]
+                        else:
+                            out[oy:oy+r1-r0, ox:ox+c1-c0, plane] = block[:, c0:c1, 0]
+        if self.nbBands == 1:
+            return out[:, :, 0]
+        return out
+
+    def readSampled(self, xs, ys):
+        '''
+        Read the pixels at the intersections of the columns xs and rows ys (sorted arrays of indices)
+        Contiguous files are sampled through a memory map, otherwise only the blocks containing sampled pixels are decoded
+        Return a numpy array (len(ys), len(xs)) for one band rasters or (len(ys), len(xs), bands)
+        '''
+        if self.isContiguous:
+            return self.memmap()[np.ix_(ys, xs)].astype(self.dtype.newbyteorder('='))
+        return self._readSampled(xs, ys)
+
+    def _readSampled(self, xs, ys):
+        '''Read the pixels at the intersections of the columns xs and rows ys (sorted arrays of indices)'''
+        bw, bh = self.blockWidth, self.blockHeight
+        out = np.empty((len(ys), len(xs), self.nbBands), self.dtype.newbyteorder('='))
+        planes = range(self.nbBands) if self.planar == 2 else [None]
+        nbBlocks = self.nbBlocksX * self.nbBlocksY
+        with io.open(self.path, 'rb') as f:
+            for by in np.unique(ys // bh):
+                nbRows = bh if self.isTiled else min(bh, self.height - by * bh)
+                iSel = np.nonzero(ys // bh == by)[0]
+                rows = ys[iSel] - by * bh
+                r0, r1 = rows[0], rows[-1] + 1
+                for bx in np.unique(xs // bw):
+                    jSel = np.nonzero(xs // bw == bx)[0]
+                    cols = xs[jSel] - bx * bw
+                    for plane in planes:
+                        idx = by * self.nbBlocksX + bx
+                        if plane is not None:
+                            idx += plane * nbBlocks
+                        block = self._readBlock(f, idx, nbRows, r0, r1)[np.ix_(rows - r0, cols)]
+                        if plane is None:
+                            out[np.ix_(iSel, jSel)] = block
+                        else:
+                            out[np.ix_(iSel, jSel, [plane])] = block
+        if self.nbBands == 1:
+            return out[:, :, 0]
+        return out
+
+
+def sampleIndices(size, outSize):
+    '''Indices of the pixels sampled to reduce a row or a column of pixels to outSize, nearest neighbor at pixel center'''
+    return np.minimum(size - 1, ((np.arange(outSize) + 0.5) * size / outSize).astype(int))
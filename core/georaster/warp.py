@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+from .georef import GeoRef
+from ..proj.srs import SRS
+from ..proj.reproj import getReproj, reprojImgGrid
+
+
+#maximum error of the approximated inverse transform, in source pixels (same default as GDAL)
+WARP_MAX_ERR = 0.125
+#number of output pixels processed at once, bound the memory used by the resampling
+WARP_CHUNK_PIXELS = 2**20
+
+
+def _kernel(resamplAlg, pos):
+    '''
+    Return the taps offsets and weights of the separable resampling kernel
+    pos : fractional pixel positions, pixels centers are at integer positions
+    return origin (int array), offsets list and weights list (arrays)
+    '''
+    if resamplAlg == 'NN':
+        return np.floor(pos + 0.5).astype(np.int64), [0], [np.ones_like(pos)]
+    p0 = np.floor(pos)
+    t = pos - p0
+    p0 = p0.astype(np.int64)
+    if resamplAlg == 'BL':
+        return p0, [0, 1], [1 - t, t]
+    #cubic convolution (Keys, a=-0.5)
+    a = -0.5
+    def w(d):
+        d = np.abs(d)
+        return np.where(d <= 1, ((a + 2) * d - (a + 3)) * d * d + 1,
+            np.where(d < 2, ((a * d - 5 * a) * d + 8 * a) * d - 4 * a, 0))
+    return p0, [-1, 0, 1, 2], [w(t + 1), w(t), w(t - 1), w(t - 2)]
+
+
+def resample(data, cols, rows, resamplAlg='BL', noData=None, hasAlpha=False, mask=None):
+    '''
+    Sample a raster at fractional pixels positions
+    data : array (h, w, n)
+    cols, rows : 1D arrays of positions, pixels centers are at integer positions
+    noData : value flagging invalid source pixels
+    hasAlpha : the last band is an alpha band, it's used as a density to weight the color bands
+    mask : optional boolean array (h, w) flagging invalid source pixels
+    return values (npts, n) as float and a boolean array flagging the positions without any valid data
+    '''
+    h, w, n = data.shape
+    #flat views, gathering with a single index is faster than with a pair of indices
+    values = np.ma.getdata(data).reshape(-1, n)
+    if mask is not None:
+        mask = mask.ravel()
+
+    c0, dc, wc = _kernel(resamplAlg, cols)
+    r0, dr, wr = _kernel(resamplAlg, rows)
+
+    acc = np.zeros((len(cols), n))
+    wsum = np.zeros(len(cols)) #sum of weights of valid taps
+    dsum = np.zeros(len(cols)) #same weighted by density
+    for i, oy in enumerate(dr):
+        r = r0 + oy
+        rin = (r >= 0) & (r < h)
+        r = np.clip(r, 0, h - 1)
+        for j, ox in enumerate(dc):
+            c = c0 + ox
+            inside = rin & (c >= 0) & (c < w)
+            idx = r * w + np.clip(c, 0, w - 1)
+            v = values[idx].astype(float)
+            valid = inside if mask is None else inside & ~mask[idx]
+            if noData is not None:
+                valid &= ~(v == noData).all(axis=1)
+            wt = wr[i] * wc[j]
+            wt[~valid] = 0
+            wsum += wt
+            if hasAlpha:
+                d = wt * v[:, -1] / 255
+                acc[:, -1] += wt * v[:, -1]
+                v[:, :-1] *= d[:, None]
+                acc[:, :-1] += v[:, :-1]
+                dsum += d
+            else:
+                v *= wt[:, None]
+                acc += v
+
+    empty = np.abs(wsum) < 1e-6
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if hasAlpha:
+            acc[:, :-1] /= np.where(np.abs(dsum) < 1e-9, 1, dsum)[:, None]
+            acc[:, -1] /= np.where(empty, 1, wsum)
+        else:
+            acc /= np.where(empty, 1, wsum)[:, None]
+    #positions outside the raster extent are never valid
+    empty |= (cols < -0.5) | (cols > w - 0.5) | (rows < -0.5) | (rows > h - 0.5)
+    return acc, empty
+
+
+def warp(data, georef, crs1, crs2, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL', noData=None,
+        maxErr=WARP_MAX_ERR, chunkSize=WARP_CHUNK_PIXELS):
+    '''
+    Reproject a raster with numpy, same parameters and output grid than reprojImg() but GDAL is not required
+    Each output pixel center is transformed back to the source crs (with an approximated transformer)
+    then the source raster is resampled at this location. The output is processed by blocks of rows
+    so that the memory used does not depends on the raster size.
+
+    data : numpy array (h, w) or (h, w, n), or masked array
+    georef : GeoRef object of the input raster
+    resamplAlg : NN (nearest), BL (bilinear) or CB (cubic), other GDAL algorithms fallback to cubic
+    noData : value flagging invalid source pixels, also used to fill output pixels without data (0 if None)
+    A 2 or 4 bands uint8 raster is considered to have an alpha band : alpha is resampled as a band
+    and used to weight the color bands, pixels outside the source extent are fully transparent
+    maxErr : maximum error of the approximated inverse transform in source pixels, 0 to use the exact transform
+    return (data, georef) of the reprojected raster
+    '''
+    if resamplAlg not in ('NN', 'BL', 'CB'):
+        log.debug('Resampling algorithm {} is not available without GDAL, use cubic instead'.format(resamplAlg))
+        resamplAlg = 'CB'
+
+    ndim = data.ndim
+    if ndim == 2:
+        data = data[:, :, None]
+    h, w, n = data.shape
+    hasAlpha = data.dtype == np.uint8 and n in (2, 4)
+    mask = None
+    if np.ma.is_masked(data):
+        mask = np.ma.getmaskarray(data).any(axis=2)
+    data = np.ascontiguousarray(np.ma.getdata(data))
+
+    bbox = georef.bbox
+    xmin, ymax, resx, resy, img_w, img_h = reprojImgGrid(crs1, crs2, bbox, w, h, out_ul, out_size, out_res, sqPx)
+    crs = crs2 if isinstance(crs2, SRS) else SRS(crs2)
+    georef2 = GeoRef((img_w, img_h), (resx, resy), (xmin, ymax), pxCenter=False, crs=crs)
+
+    #inverse transform, from output crs to pixels of the source raster
+    rprj = getReproj(crs2, crs1)
+    if maxErr:
+        rprj = rprj.approx(maxErr * min(abs(georef.pxSize.x), abs(georef.pxSize.y)))
+    ox, oy = georef.origin
+    pxx, pxy = georef.pxSize
+    rotx, roty = georef.rotation
+    det = pxx * pxy - rotx * roty
+
+    out = np.empty((img_h, img_w, n), dtype=data.dtype)
+    fill = 0 if noData is None else noData
+    nbRows = max(1, chunkSize // max(img_w, 1))
+    xs = xmin + resx * (np.arange(img_w) + 0.5)
+    for y in range(0, img_h, nbRows):
+        rows = np.arange(y, min(y + nbRows, img_h))
+        ys = ymax + resy * (rows + 0.5)
+        X, Y = rprj.arrays(np.tile(xs, len(rows)), np.repeat(ys, img_w))
+        dx, dy = X - ox, Y - oy
+        cols = (pxy * dx - roty * dy) / det
+        srcRows = (pxx * dy - rotx * dx) / det
+        #points outside the source crs domain
+        bad = ~(np.isfinite(cols) & np.isfinite(srcRows))
+        cols[bad], srcRows[bad] = -2, -2
+
+        values, empty = resample(data, cols, srcRows, resamplAlg, noData, hasAlpha, mask)
+        if np.issubdtype(data.dtype, np.integer):
+            info = np.iinfo(data.dtype)
+            values = np.clip(np.round(values), info.min, info.max)
+        values[empty] = fill
+        if hasAlpha:
+            values[empty, -1] = 0
+        out[y:y+len(rows)] = values.reshape(len(rows), img_w, n)
+
+    if ndim == 2:
+        out = out[:, :, 0]
+    return out, georef2
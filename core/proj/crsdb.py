@@ -0,0 +1,234 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import os
+import re
+import zlib
+import time
+import sqlite3
+import threading
+import warnings
+import logging
+log = logging.getLogger(__name__)
+
+from ..checkdeps import HAS_PYPROJ
+
+if HAS_PYPROJ:
+    import pyproj
+
+
+#default location of the offline crs catalogue, it can be built with CrsIndex.build() or shipped prebuilt
+#it lives in the BlenderGIS user data folder (also the default tiles cache folder), outside the addon sources
+CRS_DB_PATH = os.path.join(os.path.expanduser('~'), '.bgis', 'crs.sqlite')
+#maximum number of search results
+CRS_SEARCH_LIMIT = 50
+#search results order by kind, the 2D crs usable as scene crs come before compound, vertical or 3D crs
+CRS_KIND_RANK = "CASE c.kind WHEN 'PROJECTED_CRS' THEN 0 WHEN 'GEOGRAPHIC_2D_CRS' THEN 0 ELSE 1 END"
+#bm25 weights of the name, area and code columns of the full text index. The name weight is high enough
+#for crs whose name holds all the words to score above the ones matching some of them in their area
+CRS_FTS_WEIGHTS = (100.0, 1.0, 5.0)
+
+
+class CrsIndex():
+    '''
+    Offline catalogue of CRS definitions stored in a SQLite database (code, name, area of use, bounds,
+    proj4 and esri wkt) with a full text index on names and areas, so that crs can be searched and
+    their definitions retrieved without requesting epsg.io.
+    Definitions are zlib compressed, the whole EPSG registry takes a few MB.
+    If the SQLite library lacks the FTS5 extension, text search fallback to slower LIKE queries.
+    '''
+
+    def __init__(self, path=CRS_DB_PATH):
+        if not os.path.exists(path):
+            raise IOError('CRS database not found : ' + path)
+        self.path = path
+        #read only connection shared by all threads, queries are serialized with a lock
+        self.db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            tables = [r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            self.hasFTS = 'crs_fts' in tables
+            self.meta = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @classmethod
+    def build(cls, path=CRS_DB_PATH, auths=('EPSG', 'ESRI')):
+        '''Build the catalogue from the PROJ database shipped with pyproj, return a CrsIndex instance'''
+        if not HAS_PYPROJ:
+            raise ImportError('PYPROJ not available')
+        t0 = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmpPath = path + '.tmp'
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        db = sqlite3.connect(tmpPath)
+        try:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute('''CREATE TABLE crs (id INTEGER PRIMARY KEY, auth TEXT, code TEXT, name TEXT, kind TEXT, area TEXT,
+                west REAL, south REAL, east REAL, north REAL, deprecated INTEGER, proj4 BLOB, wkt BLOB)''')
+            db.execute("CREATE UNIQUE INDEX crs_code ON crs (auth, code)")
+
+            nb = 0
+            for auth in auths:
+                for info in pyproj.database.query_crs_info(auth_name=auth):
+                    proj4, wkt = None, None
+                    try:
+                        crs = pyproj.CRS.from_authority(info.auth_name, info.code)
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('ignore') #pyproj warns about proj4 lossy export
+                            proj4 = crs.to_proj4()
+                        wkt = crs.to_wkt('WKT1_ESRI') or crs.to_wkt()
+                    except Exception as e:
+                        log.debug('Cannot export crs {}:{}, {}'.format(info.auth_name, info.code, e))
+                    area = info.area_of_use
+                    db.execute("INSERT OR IGNORE INTO crs VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                        info.auth_name, info.code, info.name, info.type.name,
+                        area.name if area else None,
+                        area.west if area else None, area.south if area else None,
+                        area.east if area else None, area.north if area else None,
+                        int(info.deprecated),
+                        zlib.compress(proj4.encode('utf8')) if proj4 else None,
+                        zlib.compress(wkt.encode('utf8')) if wkt else None
+                    ))
+                    nb += 1
+
+            try:
+                db.execute('''CREATE VIRTUAL TABLE crs_fts USING fts5(name, area, code, content='crs', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2')''')
+                db.execute("INSERT INTO crs_fts(crs_fts) VALUES('rebuild')")
+            except sqlite3.OperationalError as e:
+                log.warning('SQLite FTS5 extension unavailable, full text search will be slower : {}'.format(e))
+
+            meta = {'source':'pyproj ' + pyproj.__version__, 'proj':pyproj.proj_version_str,
+                'date':time.strftime('%Y-%m-%d'), 'count':str(nb)}
+            db.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+            db.commit()
+            db.execute("VACUUM")
+        finally:
+            db.close()
+        _closeCrsIndex(path) #the file can not be replaced while opened on Windows
+        os.replace(tmpPath, path)
+        log.info('CRS database built with {} definitions in {} seconds'.format(nb, round(time.time() - t0, 2)))
+        return cls(path)
+
+    ############################################
+    # Queries
+
+    @staticmethod
+    def _result(row):
+        '''Format a row like epsg.io search results'''
+        r = {'code':row['code'], 'name':row['name'], 'auth':row['auth'], 'kind':row['kind'], 'area':row['area'],
+            'deprecated':bool(row['deprecated'])}
+        if row['north'] is not None:
+            r['bbox'] = [row['north'], row['west'], row['south'], row['east']]
+        return r
+
+    def search(self, query, auth='EPSG', limit=CRS_SEARCH_LIMIT):
+        '''
+        Search crs by code prefix (digits query) or by words prefix in names and areas of use
+        return a list of dict with code, name, kind, area and bbox keys, valid crs first
+        '''
+        query = str(query).strip()
+        if not query:
+            return []
+        cols = "c.auth, c.code, c.name, c.kind, c.area, c.west, c.south, c.east, c.north, c.deprecated"
+
+        if query.isdigit():
+            #exact code first then codes starting with the query, as a range scan on the index
+            upper = query[:-1] + chr(ord(query[-1]) + 1)
+            sql = '''SELECT {} FROM crs c WHERE auth = ? AND code >= ? AND code < ?
+                ORDER BY code != ?, deprecated, length(code), code LIMIT ?'''.format(cols)
+            args = (auth, query, upper, query, limit)
+
+        else:
+            words = re.findall(r'\w+', query)
+            if not words:
+                return []
+            if self.hasFTS:
+                match = ' '.join('"{}"*'.format(w) for w in words)
+                #2D crs first, then by relevance of the single match, with matches in names far above matches in areas
+                sql = '''SELECT {} FROM crs_fts f JOIN crs c ON c.id = f.rowid
+                    WHERE crs_fts MATCH ? AND c.auth = ?
+                    ORDER BY c.deprecated, {}, bm25(crs_fts, {}, {}, {}), length(c.name) LIMIT ?'''.format(cols,
+                    CRS_KIND_RANK, *CRS_FTS_WEIGHTS)
+                args = (match, auth, limit)
+            else:
+                where = ' AND '.join(["(c.name LIKE ? OR c.area LIKE ?)"] * len(words))
+                inName = ' AND '.join(["c.name LIKE ?"] * len(words))
+                sql = '''SELECT {} FROM crs c WHERE {} AND c.auth = ?
+                    ORDER BY c.deprecated, NOT ({}), {}, length(c.name) LIMIT ?'''.format(cols, where, inName, CRS_KIND_RANK)
+                likes = ['%' + w + '%' for w in words]
+                args = sum([(like, like) for like in likes], ()) + (auth,) + tuple(likes) + (limit,)
+
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [self._result(row) for row in rows]
+
+    def _get(self, code, auth, field):
+        with self.lock:
+            row = self.db.execute("SELECT {} FROM crs WHERE auth = ? AND code = ?".format(field), (auth, str(code))).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf8')
+
+    def get(self, code, auth='EPSG'):
+        '''Return the description of a crs as a dict, or None if the code is unknown'''
+        with self.lock:
+            row = self.db.execute("SELECT * FROM crs WHERE auth = ? AND code = ?", (auth, str(code))).fetchone()
+        if row is None:
+            return None
+        r = self._result(row)
+        r['proj4'] = zlib.decompress(row['proj4']).decode('utf8') if row['proj4'] else None
+        r['wkt'] = zlib.decompress(row['wkt']).decode('utf8') if row['wkt'] else None
+        return r
+
+    def getEsriWkt(self, code, auth='EPSG'):
+        return self._get(code, auth, 'wkt')
+
+    def getProj4(self, code, auth='EPSG'):
+        return self._get(code, auth, 'proj4')
+
+
+_crsIndex = None
+_crsIndexLock = threading.Lock()
+
+def getCrsIndex():
+    '''Return the shared CrsIndex instance, or None if the database does not exist'''
+    global _crsIndex
+    with _crsIndexLock:
+        if _crsIndex is None or _crsIndex.path != CRS_DB_PATH:
+            if not os.path.exists(CRS_DB_PATH):
+                return None
+            try:
+                _crsIndex = CrsIndex(CRS_DB_PATH)
+            except Exception as e:
+                log.error('Cannot open CRS database {} : {}'.format(CRS_DB_PATH, e))
+                return None
+        return _crsIndex
+
+def _closeCrsIndex(path):
+    global _crsIndex
+    with _crsIndexLock:
+        if _crsIndex is not None and _crsIndex.path == path:
+            _crsIndex.close()
+            _crsIndex = None
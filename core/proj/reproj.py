@@ -18,7 +18,17 @@
 #  ***** GPL LICENSE BLOCK *****
 
 
+import os
+import sys
 import math
+import threading
+import collections
+import concurrent.futures
+from multiprocessing import shared_memory
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
 
 from .srs import SRS
 from .utm import UTM, UTM_EPSG_CODES
@@ -54,10 +64,86 @@ def lonLatToWebMerc(lon, lat):
     y = lat * k
     return x, y
 
+#numpy versions, process arrays of coordinates in one shot
+
+def webMercToLonLatArrays(xs, ys):
+    k = GRS80.perimeter/360
+    lons = np.asarray(xs, dtype=float) / k
+    lats = np.asarray(ys, dtype=float) / k
+    lats = 180 / math.pi * (2 * np.arctan( np.exp( lats * math.pi / 180.0)) - math.pi / 2.0)
+    return lons, lats
+
+def lonLatToWebMercArrays(lons, lats):
+    k = GRS80.perimeter/360
+    xs = np.asarray(lons, dtype=float) * k
+    lats = np.log( np.tan((90 + np.asarray(lats, dtype=float)) * math.pi / 360.0 )) / (math.pi / 180.0)
+    ys = lats * k
+    return xs, ys
+
+#under this number of points, the builtin engine uses the scalar functions to avoid numpy overhead
+BUILTIN_ARRAYS_MIN_PTS = 64
+
+#approximate transformer, default depth limit of the quadtree (the finest cells are 1/1024 of the data extent)
+APPROX_MAX_DEPTH = 10
+#under this number of points the approximate transformer uses the exact transform directly
+APPROX_MIN_PTS = 256
+
 
 ######################################
 # Raster reproj using GDAL
 
+def reprojImgGrid(crs1, crs2, bbox, img_w, img_h, out_ul=None, out_size=None, out_res=None, sqPx=False):
+    '''
+    Compute the destination grid of a raster reprojection, see reprojImg() for the parameters
+    bbox >> BBOX of the input raster in crs1, img_w, img_h >> size of the input raster
+    return (xmin, ymax, resx, resy, img_w, img_h) of the output raster
+    '''
+    xmin, ymax = bbox.xmin, bbox.ymax
+    #source resolution
+    resx = (bbox.xmax - bbox.xmin) / img_w
+    resy = -(bbox.ymax - bbox.ymin) / img_h
+
+    if out_ul is not None:
+        xmin, ymax = out_ul
+    else:
+        xmin, ymax = reprojPt(crs1, crs2, xmin, ymax)
+
+    #submit resolution and size
+    if out_res is not None and out_size is not None:
+        resx, resy = out_res, -out_res
+        img_w, img_h = out_size
+
+    #submit resolution and auto compute the best image size
+    if out_res is not None and out_size is None:
+        resx, resy = out_res, -out_res
+        #reprojected image size depend on final bbox and expected resolution
+        xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
+        img_w = int( (xmax - xmin) / resx )
+        img_h = int( (ymax - ymin) / abs(resy) )
+
+    #submit image size and ...
+    if out_res is None and out_size is not None:
+        img_w, img_h = out_size
+        #...let's res as source value ? (image will be croped)
+
+    #Keep original image px size and compute resolution to approximately preserve geosize
+    if out_res is None and out_size is None:
+        #find the res that match source diagolal size
+        xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
+        '''
+        dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
+        px_diag = math.sqrt(img_w**2 + img_h**2)
+        res = dst_diag / px_diag
+        '''
+        resx = (xmax-xmin) / img_w
+        resy = -(ymax-ymin) / img_h
+        if sqPx:
+            resx = max(resx, abs(resy))
+            resy = -resx
+
+    return xmin, ymax, resx, resy, img_w, img_h
+
+
 def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL', path=None, geoTiffOptions={'TFW':'YES', 'TILED':'YES', 'BIGTIFF':'YES', 'COMPRESS':'JPEG', 'JPEG_QUALITY':80, 'PHOTOMETRIC':'YCBCR'}):
     '''
     Use GDAL Python binding to reproject an image
@@ -104,44 +190,7 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
     # ds2 will be a template empty raster to reproject the data into
     # we can directly set its size, res and top left coord as expected
     # reproject funtion will match the template (clip and resampling)
-
-    if out_ul is not None:
-        xmin, ymax = out_ul
-    else:
-        xmin, ymax = reprojPt(crs1, crs2, xmin, ymax)
-
-    #submit resolution and size
-    if out_res is not None and out_size is not None:
-        resx, resy = out_res, -out_res
-        img_w, img_h = out_size
-
-    #submit resolution and auto compute the best image size
-    if out_res is not None and out_size is None:
-        resx, resy = out_res, -out_res
-        #reprojected image size depend on final bbox and expected resolution
-        xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
-        img_w = int( (xmax - xmin) / resx )
-        img_h = int( (ymax - ymin) / resy )
-
-    #submit image size and ...
-    if out_res is None and out_size is not None:
-        img_w, img_h = out_size
-        #...let's res as source value ? (image will be croped)
-
-    #Keep original image px size and compute resolution to approximately preserve geosize
-    if out_res is None and out_size is None:
-        #find the res that match source diagolal size
-        xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
-        '''
-        dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
-        px_diag = math.sqrt(img_w**2 + img_h**2)
-        res = dst_diag / px_diag
-        '''
-        resx = (xmax-xmin) / img_w
-        resy = -(ymax-ymin) / img_h
-        if sqPx:
-            resx = max(resx, abs(resy))
-            resy = -resx
+    xmin, ymax, resx, resy, img_w, img_h = reprojImgGrid(crs1, crs2, bbox, img_w, img_h, out_ul, out_size, out_res, sqPx)
 
     if path is None:
         ds2 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GetDataTypeByName(dtype))
@@ -235,6 +284,7 @@ class Reproj():
         elif self.iproj == 'PYPROJ':
             self.crs1 = crs1.getPyProj()
             self.crs2 = crs2.getPyProj()
+            self.transformer = pyproj.Transformer.from_proj(self.crs1, self.crs2)
 
         elif self.iproj == 'EPSGIO':
             if crs1.isEPSG and crs2.isEPSG:
@@ -284,17 +334,19 @@ class Reproj():
                 ys, xs = zip(*pts)
             else:
                 xs, ys = zip(*pts)
-            transformer = pyproj.Transformer.from_proj(self.crs1, self.crs2)
             if self.crs2.crs.is_geographic:
-                ys, xs = transformer.transform(xs, ys)
+                ys, xs = self.transformer.transform(xs, ys)
             else:
-                xs, ys = transformer.transform(xs, ys)
+                xs, ys = self.transformer.transform(xs, ys)
             return list(zip(xs, ys))
 
         elif self.iproj == 'EPSGIO':
             return EPSGIO.reprojPts(self.crs1, self.crs2, pts)
 
         elif self.iproj == 'BUILTIN':
+            if len(pts) >= BUILTIN_ARRAYS_MIN_PTS:
+                xs, ys = self.arrays(*zip(*pts))
+                return list(zip(xs.tolist(), ys.tolist()))
             #Web Mercator
             if self.crs1 == 4326 and self.crs2 == 3857:
                 return [lonLatToWebMerc(*pt) for pt in pts]
@@ -306,6 +358,48 @@ class Reproj():
             elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 4326:
                 return [self.utm.utm_to_lonlat(*pt) for pt in pts]
 
+    def arrays(self, xs, ys):
+        '''
+        Reproject coordinates given as two sequences or numpy arrays of same length
+        return a tuple of two float numpy arrays (xs, ys)
+        '''
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if xs.shape != ys.shape:
+            raise ReprojError('xs and ys arrays must have the same shape')
+        if xs.size == 0 or self.iproj == 'NO_REPROJ':
+            return xs.copy(), ys.copy()
+
+        if self.iproj == 'BUILTIN':
+            #Web Mercator
+            if self.crs1 == 4326 and self.crs2 == 3857:
+                return lonLatToWebMercArrays(xs, ys)
+            elif self.crs1 == 3857 and self.crs2 == 4326:
+                return webMercToLonLatArrays(xs, ys)
+            #UTM
+            if self.crs1 == 4326 and self.crs2 in UTM_EPSG_CODES:
+                return self.utm.lonlat_to_utm_arrays(xs, ys)
+            elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 4326:
+                return self.utm.utm_to_lonlat_arrays(xs, ys)
+
+        elif self.iproj == 'PYPROJ':
+            if self.crs1.crs.is_geographic:
+                xs, ys = ys, xs
+            if self.crs2.crs.is_geographic:
+                ys2, xs2 = self.transformer.transform(xs.ravel(), ys.ravel())
+            else:
+                xs2, ys2 = self.transformer.transform(xs.ravel(), ys.ravel())
+            return np.asarray(xs2, dtype=float).reshape(xs.shape), np.asarray(ys2, dtype=float).reshape(xs.shape)
+
+        #other engines only accept a list of points
+        pts = self.pts(list(zip(xs.ravel().tolist(), ys.ravel().tolist())))
+        pts = np.array(pts, dtype=float)
+        return pts[:, 0].reshape(xs.shape), pts[:, 1].reshape(xs.shape)
+
+    def approx(self, maxErr, maxDepth=APPROX_MAX_DEPTH):
+        '''Return an approximate transformer based on this one, see ApproxReproj'''
+        return ApproxReproj(self, maxErr, maxDepth)
+
     def pt(self, x, y):
         if x is None or y is None:
             raise ReprojError('Cannot reproj None coordinates')
@@ -328,13 +422,358 @@ class Reproj():
 
 
 
+######################################
+# Approximate transformer
+
+class ApproxReproj():
+    '''
+    Approximate transformer, in the spirit of GDAL approx transformer.
+    The exact transform is only evaluated on the nodes of an adaptive quadtree covering the points extent,
+    other points are bilinearly interpolated. A cell is accepted when the interpolation error
+    measured at its center and edges middles is lower than maxErr (in target crs units), otherwise
+    it's splitted in 4 sub cells. Cells which do not contain any point are never evaluated.
+    Points in cells that still fail at maxDepth, or where the exact transform is undefined,
+    are reprojected with the exact transformer. Refinement also stops before the number of evaluated
+    nodes exceeds the number of points.
+
+    The tree is addressed with integer cell coordinates, points are assigned to their leaf with
+    a lookup table at the finest level (4**maxDepth int32 values, 4MB for the default depth).
+    The exact transform of the nodes is the main cost, so this is worth for engines with a high cost
+    per point (GDAL, pyproj, epsg.io), the numpy builtin engine is usually faster than the tree itself.
+
+    rprj : the exact Reproj object
+    maxErr : maximum interpolation error in target crs units
+    maxDepth : maximum number of subdivisions
+    '''
+
+    def __init__(self, rprj, maxErr, maxDepth=APPROX_MAX_DEPTH):
+        self.rprj = rprj
+        self.maxErr = maxErr
+        self.maxDepth = maxDepth
+        self.stats = {}
+
+    #samples in a cell on the half cell grid : 4 corners then the control points (center and edges middles)
+    _U = np.array([0, 2, 0, 2, 1, 1, 0, 2, 1])
+    _V = np.array([0, 0, 2, 2, 1, 0, 1, 1, 2])
+
+    @staticmethod
+    def _interp(corners, u, v):
+        '''Bilinear interpolation from corners arrays (..., 4) ordered (u0v0, u1v0, u0v1, u1v1)'''
+        c00, c10, c01, c11 = corners[..., 0], corners[..., 1], corners[..., 2], corners[..., 3]
+        return c00 * (1-u) * (1-v) + c10 * u * (1-v) + c01 * (1-u) * v + c11 * u * v
+
+    def pts(self, pts):
+        if len(pts) == 0:
+            return []
+        xs, ys = self.arrays(*zip(*pts))
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    def arrays(self, xs, ys):
+        '''Same as Reproj.arrays(), the achieved error and the counts of exact evaluations are stored in self.stats'''
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if xs.shape != ys.shape:
+            raise ReprojError('xs and ys arrays must have the same shape')
+        shape = xs.shape
+        xs, ys = xs.ravel(), ys.ravel()
+        n = xs.size
+        self.stats = {'points':n, 'exactPts':n, 'gridPts':0, 'fallbackPts':n, 'cells':0, 'depth':0, 'maxErr':0.0}
+        if n < APPROX_MIN_PTS or self.rprj.iproj == 'NO_REPROJ':
+            xs2, ys2 = self.rprj.arrays(xs, ys)
+            return xs2.reshape(shape), ys2.reshape(shape)
+
+        #coordinates of each point in finest cells units
+        D = self.maxDepth
+        N = 2**D
+        xmin, ymin = xs.min(), ys.min()
+        w, h = xs.max() - xmin, ys.max() - ymin
+        X = (xs - xmin) * (N / w) if w > 0 else np.zeros(n)
+        Y = (ys - ymin) * (N / h) if h > 0 else np.zeros(n)
+        fine = np.clip(Y.astype(np.int64), 0, N-1) * N + np.clip(X.astype(np.int64), 0, N-1)
+
+        #pyramid of occupied cells, so that empty cells are never evaluated
+        occupied = [None] * (D+1)
+        occupied[D] = np.zeros(N*N, dtype=bool)
+        occupied[D][fine] = True
+        occupied[D] = occupied[D].reshape(N, N)
+        for d in range(D-1, -1, -1):
+            occupied[d] = occupied[d+1].reshape(2**d, 2, 2**d, 2).any(axis=(1, 3))
+
+        #accepted cells per level and bilinear coefficients of the leaves (f = a + b*u + c*v + d*u*v)
+        accepted = [None] * (D+1)
+        coefs, origins = [], []
+        nbLeaves = 0
+        gridPts = 0
+        achievedErr = 0.0
+
+        cx, cy = np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64) #active cells at the current level
+        depth = 0
+        for d in range(D+1):
+            depth = d
+            #nodes of the half cell grid, shared between adjacent cells
+            m = 2**(d+1) + 1
+            nx = 2 * cx[:, None] + self._U
+            ny = 2 * cy[:, None] + self._V
+            nodes, inv = np.unique(ny * m + nx, return_inverse=True)
+            if gridPts + nodes.size > n:
+                #refining is now more expensive than the exact transform of the remaining points
+                break
+            try:
+                tx, ty = self.rprj.arrays(xmin + (nodes % m) * (w / (m-1)), ymin + (nodes // m) * (h / (m-1)))
+            except Exception as e:
+                log.debug('Exact transform failed on grid nodes, fallback to exact points : {}'.format(e))
+                break
+            gridPts += nodes.size
+            tx, ty = tx[inv].reshape(nx.shape), ty[inv].reshape(nx.shape)
+
+            #error between interpolated and exact values at control points
+            u, v = self._U[4:] / 2, self._V[4:] / 2
+            ix = self._interp(tx[:, None, 0:4], u, v)
+            iy = self._interp(ty[:, None, 0:4], u, v)
+            err = np.hypot(ix - tx[:, 4:], iy - ty[:, 4:]).max(axis=1)
+            err[~np.isfinite(err)] = np.inf
+            ok = err <= self.maxErr
+
+            if ok.any():
+                k = int(ok.sum())
+                accepted[d] = (cy[ok], cx[ok], np.arange(nbLeaves, nbLeaves + k, dtype=np.int32))
+                s = 2**(D-d) #cell size in finest cells units
+                origins.append(np.column_stack((cx[ok] * s, cy[ok] * s, np.full(k, s))))
+                for t in (tx[ok], ty[ok]):
+                    c00, c10, c01, c11 = t[:, 0], t[:, 1], t[:, 2], t[:, 3]
+                    coefs.append((c00, c10 - c00, c01 - c00, c11 - c10 - c01 + c00))
+                nbLeaves += k
+                achievedErr = max(achievedErr, float(err[ok].max()))
+
+            if ok.all() or d == D:
+                break
+
+            #children of failed cells which contain some points
+            cx, cy = cx[~ok], cy[~ok]
+            cx = (2 * cx[:, None] + [0, 1, 0, 1]).ravel()
+            cy = (2 * cy[:, None] + [0, 0, 1, 1]).ravel()
+            keep = occupied[d+1][cy, cx]
+            cx, cy = cx[keep], cy[keep]
+
+        #lookup table fine cell > leaf, painted from coarse to fine levels
+        lut = np.full((1, 1), -1, dtype=np.int32)
+        for d in range(D+1):
+            if d:
+                lut = lut.repeat(2, axis=0).repeat(2, axis=1)
+            if accepted[d] is not None:
+                lut[accepted[d][0], accepted[d][1]] = accepted[d][2]
+
+        #interpolate all points from their leaf
+        outX = np.empty(n)
+        outY = np.empty(n)
+        leaf = lut.ravel()[fine]
+        approx = leaf >= 0
+        if nbLeaves:
+            leaf = leaf[approx]
+            origins = np.concatenate(origins)
+            size = origins[:, 2][leaf]
+            u = (X[approx] - origins[:, 0][leaf]) / size
+            v = (Y[approx] - origins[:, 1][leaf]) / size
+            for out, levels in zip((outX, outY), (coefs[0::2], coefs[1::2])):
+                a, b, c, dd = (np.concatenate(coef)[leaf] for coef in zip(*levels))
+                out[approx] = a + u * (b + v * dd) + v * c
+
+        exact = ~approx
+        nbExact = int(exact.sum())
+        if nbExact:
+            outX[exact], outY[exact] = self.rprj.arrays(xs[exact], ys[exact])
+
+        self.stats = {'points':n, 'exactPts':gridPts + nbExact, 'gridPts':gridPts, 'fallbackPts':nbExact,
+            'cells':nbLeaves, 'depth':depth, 'maxErr':achievedErr}
+        return outX.reshape(shape), outY.reshape(shape)
+
+    def pt(self, x, y):
+        return self.rprj.pt(x, y)
+
+    def bbox(self, bbox):
+        return self.rprj.bbox(bbox)
+
+
+######################################
+# Cache of Reproj objects
+
+#maximum number of Reproj objects kept in memory
+REPROJ_CACHE_SIZE = 64
+
+class ReprojCache():
+    '''
+    Thread safe and bounded cache of Reproj objects, keyed by the crs pair and the proj engine
+    Building a Reproj is slow (crs parsing, osr or pyproj transformers init, even a network ping
+    for epsg.io in auto mode), so helper functions like reprojPt() or reprojBbox() fetch them from here.
+    GDAL and pyproj transformers must not be shared between threads, so with these engines
+    each thread gets its own instance. Least recently used objects are evicted first.
+    '''
+
+    def __init__(self, maxSize=REPROJ_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict() # {key : Reproj}
+        #stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'size' : len(self.items),
+                'maxSize' : self.maxSize
+            }
+
+    @staticmethod
+    def key(crs1, crs2):
+        try:
+            crs1, crs2 = str(SRS(crs1)), str(SRS(crs2))
+        except Exception as e:
+            raise ReprojError(str(e))
+        engine = settings.proj_engine
+        if engine in ['GDAL', 'PYPROJ'] or (engine == 'AUTO' and (HAS_GDAL or HAS_PYPROJ)):
+            thread = threading.get_ident()
+        else:
+            thread = None #builtin and epsg.io engines are stateless
+        return (crs1, crs2, engine, thread)
+
+    def get(self, crs1, crs2):
+        '''Return a cached Reproj object, build it if needed'''
+        key = self.key(crs1, crs2)
+        with self.lock:
+            rprj = self.items.get(key)
+            if rprj is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return rprj
+            self.misses += 1
+        #build outside the lock, in the worst case two threads build the same object
+        rprj = Reproj(crs1, crs2)
+        with self.lock:
+            self.items[key] = rprj
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+        return rprj
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+reprojCache = ReprojCache()
+
+
+def getReproj(crs1, crs2):
+    '''Return a Reproj object from crs1 to crs2, shared with other callers through the cache'''
+    return reprojCache.get(crs1, crs2)
+
+
+######################################
+# Parallel reprojection of large arrays
+
+#number of points per job
+REPROJ_CHUNK_SIZE = 2**20
+#'THREAD' or 'PROCESS'. Processes are opt-in : with the spawn start method (Windows, macOS) the workers
+#are started with sys.executable, which is the Blender binary when running inside Blender
+REPROJ_POOL_TYPE = 'THREAD'
+
+def _attachSharedMemory(name):
+    '''Attach an existing shared memory block, its lifetime remains managed by the process which created it'''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    #pool workers share the resource tracker of the parent process, which will unregister the block on unlink
+    return shared_memory.SharedMemory(name=name)
+
+def _reprojSharedChunk(name, n, start, stop, crs1, crs2, engine):
+    '''Worker process job, reproject in place the slice [start:stop] of a (2, n) shared coordinates buffer'''
+    if settings.proj_engine != engine:
+        settings.proj_engine = engine
+    shm = _attachSharedMemory(name)
+    try:
+        buff = np.ndarray((2, n), dtype=np.float64, buffer=shm.buf)
+        buff[0, start:stop], buff[1, start:stop] = getReproj(crs1, crs2).arrays(buff[0, start:stop], buff[1, start:stop])
+        del buff #release the buffer export before closing
+    finally:
+        shm.close()
+
+def _reprojChunk(crs1, crs2, xs, ys, start, stop):
+    '''
+    Worker thread job, arrays are shared with the calling thread
+    GDAL and pyproj transformers must not be shared between threads, the cache gives each worker its own Reproj
+    '''
+    xs[start:stop], ys[start:stop] = getReproj(crs1, crs2).arrays(xs[start:stop], ys[start:stop])
+
+def reprojArrays(crs1, crs2, xs, ys, poolType=REPROJ_POOL_TYPE, poolSize=None, chunkSize=REPROJ_CHUNK_SIZE):
+    '''
+    Reproject large coordinates arrays by chunks with a pool of processes or threads
+    xs, ys : sequences or numpy arrays of same shape
+    poolType : 'THREAD', 'PROCESS' or None to process the chunks in the calling thread,
+        processes need an interpreter able to start workers, which is not the case of Blender with the spawn method
+    poolSize : number of workers, cpu count if None
+    With processes, coordinates are exchanged through a shared memory block and reprojected in place,
+    so only the crs and slices bounds are pickled. Each worker keeps its own Reproj cache.
+    With threads, parallelism depends on the engine releasing the GIL (numpy, pyproj and recent GDAL do).
+    return a tuple of two float numpy arrays (xs, ys)
+    '''
+    xs = np.array(xs, dtype=np.float64) #copy, the chunks are reprojected in place
+    ys = np.array(ys, dtype=np.float64)
+    if xs.shape != ys.shape:
+        raise ReprojError('xs and ys arrays must have the same shape')
+    shape = xs.shape
+    xs, ys = xs.ravel(), ys.ravel()
+    n = xs.size
+    #check the transformation is available before starting the workers, this instance belongs to the calling thread
+    rprj = getReproj(crs1, crs2)
+    poolSize = poolSize or os.cpu_count() or 1
+    if n <= chunkSize or poolType is None or poolSize == 1 or rprj.iproj == 'NO_REPROJ':
+        xs, ys = rprj.arrays(xs, ys)
+        return xs.reshape(shape), ys.reshape(shape)
+
+    bounds = [(start, min(start + chunkSize, n)) for start in range(0, n, chunkSize)]
+    poolSize = min(poolSize, len(bounds))
+
+    if poolType == 'THREAD':
+        with concurrent.futures.ThreadPoolExecutor(max_workers=poolSize) as pool:
+            futures = [pool.submit(_reprojChunk, crs1, crs2, xs, ys, start, stop) for start, stop in bounds]
+            for future in futures:
+                future.result() #raise the exception of the first failed job
+        return xs.reshape(shape), ys.reshape(shape)
+
+    elif poolType == 'PROCESS':
+        shm = shared_memory.SharedMemory(create=True, size=2 * n * 8)
+        try:
+            buff = np.ndarray((2, n), dtype=np.float64, buffer=shm.buf)
+            buff[0], buff[1] = xs, ys
+            crs1, crs2 = str(SRS(crs1)), str(SRS(crs2))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=poolSize) as pool:
+                futures = [pool.submit(_reprojSharedChunk, shm.name, n, start, stop, crs1, crs2, settings.proj_engine)
+                    for start, stop in bounds]
+                for future in futures:
+                    future.result()
+            xs, ys = buff[0].copy(), buff[1].copy()
+            del buff
+        finally:
+            shm.close()
+            shm.unlink()
+        return xs.reshape(shape), ys.reshape(shape)
+
+    else:
+        raise ValueError('Unknown pool type ' + str(poolType))
+
+
 def reprojPt(crs1, crs2, x, y):
     """
     Reproject x1,y1 coords from crs1 to crs2
     crs can be an EPSG code (interger or string) or a proj4 string
-    WARN : do not use this function in a loop because Reproj() init is slow
+    Reproj objects are cached but prefer reprojPts() to reproject several points
     """
-    rprj = Reproj(crs1, crs2)
+    rprj = getReproj(crs1, crs2)
     return rprj.pt(x, y)
 
 
@@ -343,11 +782,10 @@ def reprojPts(crs1, crs2, pts):
     Reproject [pts] from crs1 to crs2
     crs can be an EPSG code (integer or srid string) or a proj4 string
     pts must be [(x,y)]
-    WARN : do not use this function in a loop because Reproj() init is slow
     """
-    rprj = Reproj(crs1, crs2)
+    rprj = getReproj(crs1, crs2)
     return rprj.pts(pts)
 
 def reprojBbox(crs1, crs2, bbox):
-    rprj = Reproj(crs1, crs2)
+    rprj = getReproj(crs1, crs2)
     return rprj.bbox(bbox)
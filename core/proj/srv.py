@@ -25,6 +25,7 @@ from urllib.error import URLError, HTTPError
 import json
 
 from .. import settings
+from .crsdb import getCrsIndex
 
 USER_AGENT = settings.user_agent
 
@@ -130,6 +131,13 @@ class EPSGIO():
         if not query:
             return []
 
+        #use the offline crs catalogue if available
+        index = getCrsIndex()
+        if index is not None:
+            results = index.search(query)
+            log.debug('Search results (offline) : {}'.format([(r.get('code'), r.get('name')) for r in results]))
+            return results
+
         if query.isdigit():
             url = "https://epsg.io/{CODE}.json".replace("{CODE}", query)
             log.debug('Search crs : {}'.format(url))
@@ -177,6 +185,11 @@ class EPSGIO():
 
     @staticmethod
     def getEsriWkt(epsg):
+        index = getCrsIndex()
+        if index is not None:
+            wkt = index.getEsriWkt(epsg)
+            if wkt is not None:
+                return wkt
         url = "https://epsg.io/{CODE}.esriwkt"
         url = url.replace("{CODE}", str(epsg))
         log.debug(url)
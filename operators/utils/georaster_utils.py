@@ -27,47 +27,7 @@ import math
 import logging
 log = logging.getLogger(__name__)
 
-from ...core.georaster import GeoRaster
-
-
-def _exportAsMesh(georaster, dx=0, dy=0, step=1, buildFaces=True, flat=False, subset=False, reproj=None):
-    '''Numpy test'''
-
-    if subset and georaster.subBoxGeo is None:
-        subset = False
-
-    if not subset:
-        georef = georaster.georef
-    else:
-        georef = georaster.getSubBoxGeoRef()
-
-    x0, y0 = georef.origin #pxcenter
-    pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
-    w, h = georef.rSize.x, georef.rSize.y
-
-    #adjust against step
-    w, h = math.ceil(w/step), math.ceil(h/step)
-    pxSizeX, pxSizeY = pxSizeX * step, pxSizeY * step
-
-    x = np.array([(x0 + (pxSizeX * i)) - dx for i in range(0, w)])
-    y = np.array([(y0 + (pxSizeY * i)) - dy for i in range(0, h)])
-    xx, yy = np.meshgrid(x, y)
-    #TODO reproj
-
-    if flat:
-        zz = np.zeros((h, w))
-    else:
-        zz = georaster.readAsNpArray(subset=subset).data[::step,::step] #TODO raise error if multiband
-
-    verts = np.column_stack((xx.ravel(), yy.ravel(), zz.ravel()))
-    if buildFaces:
-        faces = [(x+y*w, x+y*w+1, x+y*w+1+w, x+y*w+w) for x in range(0, w-1) for y in range(0, h-1)]
-    else:
-        faces = []
-    mesh = bpy.data.meshes.new("DEM")
-    mesh.from_pydata(verts, [], faces)
-    mesh.update()
-    return mesh
+from ...core.georaster import GeoRaster, demToMesh
 
 
 def exportAsMesh(georaster, dx=0, dy=0, step=1, buildFaces=True, subset=False, reproj=None, flat=False):
@@ -80,59 +40,31 @@ def exportAsMesh(georaster, dx=0, dy=0, step=1, buildFaces=True, subset=False, r
         georef = georaster.getSubBoxGeoRef()
 
     if not flat:
-        img = georaster.readAsNpArray(subset=subset)
-        #TODO raise error if multiband
+        #only read the pixels sampled by the mesh, the decimated image comes with its own georef
+        img = georaster.readAsNpArray(subset=subset, targetRes=step*abs(georaster.pxSize.x))
         data = img.data
+        if data.shape[0:2] != (georef.rSize.y, georef.rSize.x):
+            georef, step = img.georef, 1
+    else:
+        data = None
 
-    x0, y0 = georef.origin #pxcenter
-    pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
-    w, h = georef.rSize.x, georef.rSize.y
-
-    #Build the mesh (Note : avoid using bmesh because it's very slow with large mesh, use from_pydata instead)
-    verts = []
-    faces = []
-    nodata = []
-    idxMap = {}
-    for py in range(0, h, step):
-        for px in range(0, w, step):
-            x = x0 + (pxSizeX * px)
-            y = y0 + (pxSizeY * py)
-
-            if reproj is not None:
-                x, y = reproj.pt(x, y)
-
-            #shift
-            x -= dx
-            y -= dy
-
-            if flat:
-                z = 0
-            else:
-                z = data[py, px]
-
-            #vertex index
-            v1 = px + py * w #bottom right
-
-            #Filter nodata
-            if z == georaster.noData:
-                nodata.append(v1)
-            else:
-                verts.append((x, y, z))
-                idxMap[v1] = len(verts) - 1
-
-                #build face from bottomright to topright (using only points already created)
-                if buildFaces and px > 0 and py > 0: #filter first row and column
-                    v2 = v1 - step #bottom left
-                    v3 = v2 - w * step #topleft
-                    v4 = v3 + step #topright
-                    f = [v4, v3, v2, v1] #anticlockwise --> face up
-                    if not any(v in f for v in nodata): #TODO too slow ?
-                        f = [idxMap[v] for v in f]
-                        faces.append(f)
+    #Build vertices and faces arrays with numpy, nodata cells are discarded
+    verts, faces = demToMesh(georef, data, step=step, noData=georaster.noData, dx=dx, dy=dy, reproj=reproj, buildFaces=buildFaces)
 
+    #Note : avoid using bmesh or from_pydata because they are very slow with large mesh,
+    #fill the mesh attributes straight from the numpy buffers instead
     mesh = bpy.data.meshes.new("DEM")
-    mesh.from_pydata(verts, [], faces)
-    mesh.update()
+    nbFaces = len(faces)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set("co", verts.astype(np.float32).ravel())
+    mesh.loops.add(nbFaces * 4)
+    mesh.loops.foreach_set("vertex_index", faces.astype(np.int32).ravel())
+    mesh.polygons.add(nbFaces)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, nbFaces * 4, 4, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        #read only since Blender 4.0, the polygon sizes are then deduced from loop_start
+        mesh.polygons.foreach_set("loop_total", np.full(nbFaces, 4, dtype=np.int32))
+    mesh.update(calc_edges=True)
 
     return mesh
 
@@ -35,7 +35,7 @@ from gpu_extras.batch import batch_for_shader
 
 #core imports
 from ..core import HAS_GDAL, HAS_PIL, HAS_IMGIO
-from ..core.proj import reprojPt, reprojBbox, dd2meters, meters2dd
+from ..core.proj import reprojPt, reprojBbox, getReproj, dd2meters, meters2dd
 from ..core.basemaps import GRIDS, SOURCES, MapService
 
 from ..core import settings
@@ -436,9 +436,6 @@ class VIEW3D_OT_map_start(Operator):
             layout.prop(self, 'src', text='Source')
             layout.prop(self, 'lay', text='Layer')
             col = layout.column()
-            if not HAS_GDAL:
-                col.enabled = False
-                col.label(text='(No raster reprojection support)')
             col.prop(self, 'grd', text='Tile matrix set')
 
             #srcCRS = GRIDS[SOURCES[self.src]['grid']]['CRS']
@@ -505,9 +502,13 @@ class VIEW3D_OT_map_start(Operator):
             #if not geoscn.hasCRS:
                 #geoscn.crs = grdCRS
             #Check if raster reproj is needed
+            #without GDAL, rasters are reprojected with numpy but coordinates must still be reprojectable
             if geoscn.hasCRS and geoscn.crs != grdCRS and not HAS_GDAL:
-                self.report({'ERROR'}, "Please install gdal to enable raster reprojection support")
-                return {'CANCELLED'}
+                try:
+                    getReproj(grdCRS, geoscn.crs)
+                except Exception as e:
+                    self.report({'ERROR'}, "Unable to reproject the map, please install gdal to enable full reprojection support")
+                    return {'CANCELLED'}
 
         #Move scene origin to the researched place
         if self.dialog == 'SEARCH':
@@ -10,6 +10,7 @@ import addon_utils
 
 from . import bl_info
 from .core.proj.reproj import EPSGIO
+from .core.proj.crsdb import CrsIndex, getCrsIndex
 from .core.proj.srs import SRS
 from .core.checkdeps import HAS_GDAL, HAS_PYPROJ, HAS_PIL, HAS_IMGIO
 from .core import settings
@@ -348,6 +349,14 @@ class BGIS_PREFS(AddonPreferences):
         row.operator("bgis.edit_predef_crs", icon='PREFERENCES')
         row.operator("bgis.rmv_predef_crs", icon='REMOVE')
         row.operator("bgis.reset_predef_crs", icon='PLAY_REVERSE')
+        row = box.row()
+        index = getCrsIndex()
+        if index is not None:
+            row.label(text='Offline CRS database : {} definitions ({})'.format(index.meta.get('count'), index.meta.get('source')))
+        else:
+            row.label(text='No offline CRS database, searches use epsg.io')
+        if HAS_PYPROJ:
+            row.operator("bgis.build_crs_index", icon='FILE_REFRESH')
 
         #Basemaps
         box = layout.box()
@@ -450,7 +459,7 @@ class BGIS_OT_add_predef_crs(Operator):
         return True
 
     def search(self, context):
-        if not EPSGIO.ping():
+        if getCrsIndex() is None and not EPSGIO.ping():
             self.report({'ERROR'}, "Cannot request epsg.io website")
         else:
             results = EPSGIO.search(self.query)
@@ -554,6 +563,23 @@ class BGIS_OT_reset_predef_crs(Operator):
         context.area.tag_redraw()
         return {'FINISHED'}
 
+class BGIS_OT_build_crs_index(Operator):
+
+    bl_idname = "bgis.build_crs_index"
+    bl_description = 'Build an offline database of CRS definitions from PROJ registry, used instead of epsg.io website'
+    bl_label = "Build offline CRS database"
+    bl_options = {'INTERNAL'}
+
+    def execute(self, context):
+        try:
+            CrsIndex.build()
+        except Exception as e:
+            log.error('Cannot build CRS database', exc_info=True)
+            self.report({'ERROR'}, "Cannot build CRS database, check logs for more infos")
+            return {'CANCELLED'}
+        context.area.tag_redraw()
+        return {'FINISHED'}
+
 class BGIS_OT_edit_predef_crs(Operator):
 
     bl_idname = "bgis.edit_predef_crs"
@@ -896,6 +922,7 @@ BGIS_PREFS,
 BGIS_OT_add_predef_crs,
 BGIS_OT_rmv_predef_crs,
 BGIS_OT_reset_predef_crs,
+BGIS_OT_build_crs_index,
 BGIS_OT_edit_predef_crs,
 BGIS_OT_add_osm_tag,
 BGIS_OT_rmv_osm_tag,
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+
+'''
+Benchmark of GeoPackage.getTiles for dense, sparse and multi zoom requests
+The exact lookup (temporary table joined on the tiles index) is compared to the former
+bbox range query that returns every cached tile between the min and max indices
+usage : python tests/bench_gettiles.py
+'''
+
+import os
+import time
+import random
+import tempfile
+
+from tileserver import pngTile
+from core.basemaps import GeoPackage, TileMatrix, GRIDS
+
+
+def rangeQuery(gpkg, tiles):
+    '''Former getTiles() : range scan on the bounds of the requested tiles, all zooms mixed'''
+    xs, ys, zs = zip(*tiles)
+    db = gpkg.connections.reader()
+    query = "SELECT tile_column, tile_row, zoom_level, tile_data FROM gpkg_tiles " \
+        "WHERE zoom_level BETWEEN ? AND ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+    return db.execute(query, (min(zs), max(zs), min(xs), max(xs), min(ys), max(ys))).fetchall()
+
+
+def bench(fn, gpkg, tiles, repeat=5):
+    t = time.perf_counter()
+    for i in range(repeat):
+        result = fn(gpkg, tiles)
+    t = (time.perf_counter() - t) / repeat
+    return len(result), sum([len(r[3]) for r in result]), t
+
+
+def main():
+    gpkg = GeoPackage(os.path.join(tempfile.mkdtemp(), 'cache.gpkg'), TileMatrix(GRIDS['WM']))
+    data = pngTile()
+    n = 128 #cache holds 128x128 tiles at zoom 14, 15 and 16
+    for z in (14, 15, 16):
+        gpkg.putTiles([(x, y, z, data) for x in range(n) for y in range(n)])
+
+    rnd = random.Random(0)
+    requests = {
+        'dense 32x32' : [(x, y, 15) for x in range(32) for y in range(32)],
+        'diagonal 128' : [(i, i, 15) for i in range(n)],
+        'sparse 200' : [(rnd.randrange(n), rnd.randrange(n), 15) for i in range(200)],
+        #same bbox on 3 zoom levels, like a BBoxRequestMZ
+        'multi zoom bbox' : [(x, y, z) for z in (14, 15, 16) for x in range(8 * 2**(z-14)) for y in range(8 * 2**(z-14))],
+    }
+    for name, tiles in requests.items():
+        for label, fn in (('range', rangeQuery), ('exact', GeoPackage.getTiles)):
+            nb, size, t = bench(fn, gpkg, tiles)
+            print('{:<17} {:<5} : {} tiles requested, {} returned, {:.1f} MB read, {:.1f} ms'.format(
+                name, label, len(set(tiles)), nb, size / 1024**2, t * 1000))
+    gpkg.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+
+'''
+Read/write contention benchmark of the GeoPackage tiles cache
+A writer thread inserts batches of tiles (like a seeding run) while reader threads request
+single tiles (like the map viewer). The shared connections manager (WAL, per thread readers,
+single write connection) is compared to a connection opened for each call on a rollback journal database.
+With several writers (like seeding threads), queued writes are committed together, compare the
+number of commits to the number of writes.
+The readers are busy loops : with the shared manager they never wait on sqlite locks and take most
+of the GIL, so the writer throughput depends on the number of readers much more than on sqlite.
+usage : python tests/bench_gpkg.py [duration] [nbReaders] [nbWriters]
+'''
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+
+from tileserver import pngTile
+from core.basemaps import GeoPackage, TileMatrix, GRIDS
+
+
+class ConnectPerCall():
+    '''Cache access opening a new connection for each call, writes serialized by a lock'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        db = sqlite3.connect(path)
+        db.execute("""CREATE TABLE gpkg_tiles (id INTEGER PRIMARY KEY AUTOINCREMENT, zoom_level INTEGER NOT NULL,
+            tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL,
+            UNIQUE (zoom_level, tile_column, tile_row))""")
+        db.close()
+
+    def getTile(self, x, y, z):
+        db = sqlite3.connect(self.path, timeout=30)
+        result = db.execute('SELECT tile_data FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, y)).fetchone()
+        db.close()
+        return result[0] if result else None
+
+    def putTiles(self, tiles):
+        with self.lock:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.executemany("INSERT OR REPLACE INTO gpkg_tiles (tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)", tiles)
+            db.commit()
+            db.close()
+
+
+def bench(cache, duration, nbReaders, nbWriters=1, batchSize=50):
+    data = pngTile()
+    zoom = 15
+    cache.putTiles([(x, y, zoom, data) for x in range(64) for y in range(64)])
+    stop = threading.Event()
+    latencies, errors, written = [], [], [0]
+    writeLock = threading.Lock()
+
+    def reader():
+        rnd = random.Random()
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                cache.getTile(rnd.randrange(64), rnd.randrange(64), zoom)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - t0)
+
+    def writer(row):
+        i = 0
+        while not stop.is_set():
+            tiles = [(1000 + i + k, row, zoom, data) for k in range(batchSize)]
+            try:
+                cache.putTiles(tiles)
+                with writeLock:
+                    written[0] += len(tiles)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+            i += batchSize
+
+    threads = [threading.Thread(target=reader) for i in range(nbReaders)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(nbWriters)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    if not latencies:
+        return '{:.0f} tiles written/s, {} lock errors'.format(written[0] / duration, len(errors))
+    latencies.sort()
+    pct = lambda p: latencies[int(p * (len(latencies) - 1))] * 1000
+    return '{:.0f} reads/s (p50 {:.2f}ms, p99 {:.2f}ms, max {:.1f}ms), {:.0f} tiles written/s, {} lock errors'.format(
+        len(latencies) / duration, pct(0.5), pct(0.99), latencies[-1] * 1000, written[0] / duration, len(errors))
+
+
+def main(duration=5, nbReaders=4, nbWriters=1):
+    folder = tempfile.mkdtemp()
+    print('connect per call :', bench(ConnectPerCall(os.path.join(folder, 'legacy.sqlite')), duration, nbReaders, nbWriters))
+    gpkg = GeoPackage(os.path.join(folder, 'cache.gpkg'), TileMatrix(GRIDS['WM']))
+    print('shared manager   :', bench(gpkg, duration, nbReaders, nbWriters))
+    print('writer commits {}, queued writes {}'.format(gpkg.connections.nbCommits, gpkg.connections.nbWrites))
+    gpkg.close()
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]] + [int(arg) for arg in sys.argv[2:4]])
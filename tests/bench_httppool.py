@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+
+'''
+Benchmark of the keep-alive connections pool against one urlopen() connection per tile
+Tiles are downloaded by 10 threads from a local stand-in tile server
+usage : python tests/bench_httppool.py [nbTiles]
+'''
+
+import sys
+import time
+import urllib.request
+import concurrent.futures
+
+from tileserver import TileServer
+from core.basemaps.httppool import ConnectionPool
+
+
+def bench(fetch, url, nbTiles, nbThread=10):
+    urls = [url + '{}/{}/{}.png'.format(17, i % 512, i // 512) for i in range(nbTiles)]
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nbThread) as executor:
+        sizes = list(executor.map(fetch, urls))
+    assert all(sizes)
+    return time.perf_counter() - t0
+
+
+def main(nbTiles=2000):
+    def urlopen(url):
+        with urllib.request.urlopen(url, timeout=4) as handle:
+            return len(handle.read())
+
+    pool = ConnectionPool(maxsize=10, idleTimeout=30)
+    def pooled(url):
+        return len(pool.request(url, timeout=4))
+
+    with TileServer() as server:
+        n = server.nbConnections
+        t = bench(urlopen, server.url, nbTiles)
+        print('urlopen : {} tiles in {:.2f}s, {:.0f} tiles/s, {} connections'.format(
+            nbTiles, t, nbTiles / t, server.nbConnections - n))
+        n = server.nbConnections
+        t = bench(pooled, server.url, nbTiles)
+        print('pool    : {} tiles in {:.2f}s, {:.0f} tiles/s, {} connections'.format(
+            nbTiles, t, nbTiles / t, server.nbConnections - n))
+        print('pool stats', pool.stats)
+        pool.clear()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+'''
+Memory usage of large getImage mosaics, in memory against the memmap backend
+Each mode runs in its own process, the peak anonymous (RAM) and file backed (mapped pages,
+reclaimable by the system) resident memory are sampled from /proc (Linux only)
+usage : python tests/bench_memmap.py [nbTiles per side]
+'''
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+
+from tileserver import TileServer
+from core.basemaps import MapService, SOURCES
+
+
+def rss():
+    '''Return resident anonymous and file backed memory in MB'''
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('RssAnon', 'RssFile')):
+                k, v = line.split(':')
+                values[k] = int(v.split()[0]) // 1024
+    return values['RssAnon'], values['RssFile']
+
+
+def run(mode, n, cacheFolder, zoom=13):
+    with TileServer(colored=True) as server:
+        SOURCES['BENCH'] = dict(SOURCES['OSM'], urlTemplate=server.url + '{Z}/{X}/{Y}.png', policy={})
+        ms = MapService('BENCH', cacheFolder)
+        ms.running = True
+        tm = ms.srcTms
+        xmin, ymax = tm.getTileCoords(2000, 2000, zoom)
+        size = tm.tileSize * tm.getRes(zoom)
+        eps = size / 100
+        bbox = (xmin + eps, ymax - n * size + eps, xmin + n * size - eps, ymax - eps)
+        ms.seedCache('MAPNIK', bbox, zoom, toDstGrid=False)
+        ms.tilesLRU.clear()
+
+        peaks = [0, 0]
+        done = threading.Event()
+        def sample():
+            while not done.is_set():
+                peaks[:] = [max(a, b) for a, b in zip(peaks, rss())]
+                time.sleep(0.02)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        t = time.perf_counter()
+        img = ms.getImage('MAPNIK', bbox, zoom, toDstGrid=False, memmap=(mode == 'memmap'), cpt=False)
+        t = time.perf_counter() - t
+        done.set()
+        sampler.join()
+        h, w = img.data.shape[0:2]
+        print('{:<7}: {} tiles, {:.0f} Mpx, {:.1f}s, peak RAM {} MB, peak mapped file pages {} MB'.format(
+            mode, n * n, w * h / 1e6, t, peaks[0], peaks[1]))
+        ms.running = False
+
+
+def main(n=40):
+    cacheFolder = tempfile.mkdtemp()
+    for mode in ('memory', 'memmap'):
+        #a new process for each mode, so that peaks are not shared
+        subprocess.run([sys.executable, __file__, mode, str(n), cacheFolder], check=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        run(sys.argv[1], int(sys.argv[2]), sys.argv[3])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+
+'''
+Benchmark of demToMesh against the former per pixel loop of exportAsMesh, the bpy mesh filling is not included
+Both builders are first checked to return the same mesh on a small grid with nodata cells
+The loop keeps python tuples for every vertex and face, it needs around 5GB on a 4000x4000 grid
+so it is timed on a smaller grid by default
+usage : python tests/bench_mesh.py [grid size] [loop grid size]
+'''
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from core.georaster import GeoRef, demToMesh
+
+
+def loopToMesh(georef, data, step=1, noData=None):
+    '''Former exportAsMesh loop, without the bpy calls'''
+    x0, y0 = georef.origin
+    pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
+    w, h = georef.rSize.x, georef.rSize.y
+    verts = []
+    faces = []
+    nodata = []
+    idxMap = {}
+    for py in range(0, h, step):
+        for px in range(0, w, step):
+            x = x0 + (pxSizeX * px)
+            y = y0 + (pxSizeY * py)
+            z = data[py, px]
+            v1 = px + py * w
+            if z == noData:
+                nodata.append(v1)
+            else:
+                verts.append((x, y, z))
+                idxMap[v1] = len(verts) - 1
+                if px > 0 and py > 0:
+                    v2 = v1 - step
+                    v3 = v2 - w * step
+                    v4 = v3 + step
+                    f = [v4, v3, v2, v1]
+                    if not any(v in f for v in nodata):
+                        f = [idxMap[v] for v in f]
+                        faces.append(f)
+    return verts, faces
+
+
+def grid(n):
+    georef = GeoRef((n, n), (5, -5), (600000, 6800000), pxCenter=False)
+    yy, xx = np.mgrid[0:n, 0:n]
+    data = (100 + 50 * np.sin(xx / 50) * np.cos(yy / 70)).astype(np.float32)
+    return georef, data
+
+
+def check():
+    georef, data = grid(300)
+    data[100:110, 200:205] = -9999
+    verts, faces = demToMesh(georef, data, noData=-9999)
+    refVerts, refFaces = loopToMesh(georef, data, noData=-9999)
+    assert np.allclose(verts, np.array(refVerts))
+    assert np.array_equal(faces, np.array(refFaces))
+    print('check ok : {} vertices, {} faces'.format(len(verts), len(faces)))
+
+
+def measure(fn):
+    tracemalloc.start()
+    t = time.perf_counter()
+    verts, faces = fn()
+    t = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(verts), len(faces), t, peak
+
+
+def main(n=4000, loopSize=1000):
+    check()
+    runs = [
+        ('demToMesh', demToMesh, n),
+        ('per pixel loop', loopToMesh, loopSize)
+    ]
+    for name, fn, size in runs:
+        georef, data = grid(size)
+        nbVerts, nbFaces, t, peak = measure(lambda: fn(georef, data))
+        print('{:<15}: {}x{} grid, {} vertices, {} faces, {:.2f}s, {:.2f} Mpx/s, peak traced memory {:.0f} MB'.format(
+            name, size, size, nbVerts, nbFaces, t, size**2 / 1e6 / t, peak / 1024**2))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+
+'''
+Benchmark of the destination grid seeding, tile by tile against metatiles
+Web mercator tiles from a local stand-in tile server are reprojected to the french Lambert 93 grid,
+the tiles built in both modes are then compared
+usage : python tests/bench_metatile.py [zoom] [metatileSize]
+'''
+
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+from tileserver import TileServer
+from core.basemaps import MapService, SOURCES, BBoxRequest
+from core.georaster import NpImage
+
+
+BBOX = (640000, 6850000, 680000, 6880000) #Paris, Lambert 93
+
+
+def seed(url, zoom, metatileSize):
+    SOURCES['BENCH'] = dict(SOURCES['OSM'], urlTemplate=url + '{Z}/{X}/{Y}.png', policy={})
+    ms = MapService('BENCH', tempfile.mkdtemp(), dstGridKey='LB93', metatileSize=metatileSize)
+    ms.tilesLRU.clear()
+    ms.running = True
+    t0 = time.perf_counter()
+    ms.seedCache('MAPNIK', BBOX, zoom, toDstGrid=True)
+    t = time.perf_counter() - t0
+    ms.running = False
+    tiles = BBoxRequest(ms.dstTms, BBOX, zoom).tiles
+    cache = ms.getCache('MAPNIK', True)
+    return t, {(x, y, z): NpImage(data).data for x, y, z, data in cache.getTiles(tiles)}, len(tiles)
+
+
+def main(zoom=9, metatileSize=4):
+    with TileServer(colored=True) as server:
+        t1, tiles1, nb = seed(server.url, zoom, 1)
+        nbRq1 = server.nbRequests
+        t2, tiles2, nb = seed(server.url, zoom, metatileSize)
+        nbRq2 = server.nbRequests - nbRq1
+    print('{} destination tiles at zoom {}'.format(nb, zoom))
+    print('tile by tile   : {:.2f}s, {:.1f} tiles/s, {} tiles built, {} source tiles downloaded'.format(t1, nb / t1, len(tiles1), nbRq1))
+    print('metatiles {}x{} : {:.2f}s, {:.1f} tiles/s, {} tiles built, {} source tiles downloaded'.format(metatileSize, metatileSize, t2, nb / t2, len(tiles2), nbRq2))
+    diffs = [np.abs(tiles1[k][:, :, 0:3].astype(int) - tiles2[k][:, :, 0:3]) for k in tiles1 if k in tiles2]
+    diffs = np.concatenate([d.ravel() for d in diffs])
+    print('pixels difference : max {}, mean {:.3f}, {:.3%} of values differ by more than 1'.format(diffs.max(), diffs.mean(), (diffs > 1).mean()))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
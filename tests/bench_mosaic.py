@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+'''
+Benchmark of the mosaic assembly in getImage : throughput and peak memory (tracemalloc)
+of the former per tile NpImage paste, the preallocated in memory builder and the memmap backend
+Tiles are first seeded in the cache from a local stand-in tile server
+usage : python tests/bench_mosaic.py [nbTiles per side]
+'''
+
+import sys
+import time
+import tempfile
+import tracemalloc
+
+from tileserver import TileServer
+from core.basemaps import MapService, SOURCES, BBoxRequest
+from core.basemaps.mapservice import MOSAIC_BKG_COLOR
+from core.georaster import NpImage
+
+
+def pasteMosaic(ms, rq):
+    '''Former assembly, one NpImage and one paste per tile'''
+    mosaic = NpImage.new(rq.nbTilesX * rq.tileSize, rq.nbTilesY * rq.tileSize, bkgColor=MOSAIC_BKG_COLOR)
+    for col, row, z, data in ms.getCache('MAPNIK', False).getTiles(rq.tiles):
+        mosaic.paste(NpImage(data), (col - rq.firstCol) * rq.tileSize, (row - rq.firstRow) * rq.tileSize)
+    return mosaic
+
+
+def measure(fn):
+    tracemalloc.start()
+    t = time.perf_counter()
+    img = fn()
+    t = time.perf_counter() - t
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return img, t, peak
+
+
+def main(n=24, zoom=12):
+    with TileServer(colored=True) as server:
+        SOURCES['BENCH'] = dict(SOURCES['OSM'], urlTemplate=server.url + '{Z}/{X}/{Y}.png', policy={})
+        ms = MapService('BENCH', tempfile.mkdtemp())
+        ms.running = True
+        tm = ms.srcTms
+        xmin, ymax = tm.getTileCoords(1000, 1000, zoom)
+        size = tm.tileSize * tm.getRes(zoom)
+        eps = size / 100
+        bbox = (xmin + eps, ymax - n * size + eps, xmin + n * size - eps, ymax - eps)
+        ms.seedCache('MAPNIK', bbox, zoom, toDstGrid=False)
+        rq = BBoxRequest(tm, bbox, zoom)
+        mpx = rq.nbTiles * rq.tileSize**2 / 1e6
+        print('{} tiles, {:.1f} megapixels, {:.0f} MB rgba'.format(rq.nbTiles, mpx, mpx * 4))
+
+        #in memory mosaics also keep a copy of the decoded tiles in the LRU, up to its memory budget
+        lruSize = ms.tilesLRU.maxBytes
+        runs = [
+            ('paste per tile', lruSize, lambda: pasteMosaic(ms, rq)),
+            ('in memory', lruSize, lambda: ms.getImage('MAPNIK', bbox, zoom, toDstGrid=False, cpt=False)),
+            ('in memory, no LRU', 0, lambda: ms.getImage('MAPNIK', bbox, zoom, toDstGrid=False, cpt=False)),
+            ('memmap', lruSize, lambda: ms.getImage('MAPNIK', bbox, zoom, toDstGrid=False, memmap=True, cpt=False)),
+        ]
+        for name, maxBytes, fn in runs:
+            ms.tilesLRU.clear()
+            ms.tilesLRU.maxBytes = maxBytes
+            img, t, peak = measure(fn)
+            print('{:<18}: {:.2f}s, {:.0f} tiles/s, {:.1f} Mpx/s, peak traced memory {:.0f} MB'.format(
+                name, t, rq.nbTiles / t, mpx / t, peak / 1024**2))
+            del img
+        ms.tilesLRU.clear()
+        ms.tilesLRU.maxBytes = lruSize
+        ms.running = False
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+
+'''
+Scaling of reprojArrays with the number of workers, for the builtin and pyproj engines
+Results are checked against the single threaded transform
+usage : python tests/bench_reprojarrays.py [nb points] [max workers]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from core import settings
+from core.checkdeps import HAS_PYPROJ
+from core.proj import reprojArrays
+
+
+def run(engine, xs, ys, maxWorkers):
+    settings.proj_engine = engine
+    t = time.perf_counter()
+    ref = reprojArrays(4326, 32631, xs, ys, poolType=None)
+    base = time.perf_counter() - t
+    print('{:<8} single thread : {:.2f}s'.format(engine, base))
+    for poolType in ('THREAD', 'PROCESS'):
+        for poolSize in sorted({1, 2, 4, maxWorkers}):
+            if poolSize > maxWorkers:
+                continue
+            t = time.perf_counter()
+            res = reprojArrays(4326, 32631, xs, ys, poolType=poolType, poolSize=poolSize)
+            t = time.perf_counter() - t
+            assert np.array_equal(res[0], ref[0]) and np.array_equal(res[1], ref[1])
+            print('{:<8} {:<7} x{:<2}   : {:.2f}s, speedup {:.2f}'.format(engine, poolType, poolSize, t, base / t))
+
+
+def main(n=8000000, maxWorkers=None):
+    maxWorkers = maxWorkers or max(4, os.cpu_count() or 1)
+    print('{} points, {} cpu'.format(n, os.cpu_count()))
+    rng = np.random.default_rng(0)
+    xs, ys = rng.uniform(0, 6, n), rng.uniform(40, 50, n)
+    engines = ['BUILTIN'] + (['PYPROJ'] if HAS_PYPROJ else [])
+    for engine in engines:
+        run(engine, xs, ys, maxWorkers)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+import numpy as np
+
+import pytest
+
+from core.checkdeps import HAS_GDAL
+from core.georaster import GeoRef
+
+pytestmark = pytest.mark.skipif(not HAS_GDAL, reason='BigTiffWriter requires GDAL')
+
+if HAS_GDAL:
+    from osgeo import gdal
+    from core.georaster import BigTiffWriter
+
+
+W, H = 300, 200
+OPTIONS = {'TILED': 'YES', 'COMPRESS': 'DEFLATE'} #lossless, rgba bands
+
+
+def image(w=W, h=H):
+    rows, cols = np.mgrid[0:h, 0:w]
+    return np.dstack([cols % 256, rows % 256, (cols + rows) % 256, np.full((h, w), 255)]).astype(np.uint8)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_writeStrip(tmp_path, background):
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False)
+    writer = BigTiffWriter(path, W, H, georef, geoTiffOptions=OPTIONS, background=background)
+    data = image()
+    for y in range(0, H, 64):
+        writer.writeStrip(data[y:y+64], 0, y)
+    writer.flush()
+    assert writer.writer is None
+    writer.close()
+    assert writer.ds is None
+    ds = gdal.Open(path)
+    assert np.array_equal(np.dstack([ds.GetRasterBand(i + 1).ReadAsArray() for i in range(4)]), data)
+    assert ds.GetGeoTransform() == (600000, 10, 0, 6800000, 0, -10)
+
+
+def test_writerError(tmp_path):
+    '''An error of the background writer is raised by the next calls, close() and the finalizer stop the thread'''
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False)
+    writer = BigTiffWriter(path, W, H, georef, geoTiffOptions=OPTIONS, background=True)
+    writer.writeStrip(np.zeros((64, W), np.uint8), 0, 0) #no bands axis, fails in the writer thread
+    thread = writer.writer
+    with pytest.raises(IndexError):
+        writer.flush()
+    assert not thread.is_alive()
+    with pytest.raises(IndexError):
+        writer.writeStrip(image(W, 64), 0, 64)
+    with pytest.raises(IndexError):
+        writer.close()
+    assert writer.ds is None
+    #the finalizer of a failed writer with a running thread neither raises nor blocks
+    writer = BigTiffWriter(path, W, H, georef, geoTiffOptions=OPTIONS, background=True)
+    writer.writeStrip(np.zeros((64, W), np.uint8), 0, 0)
+    thread = writer.writer
+    writer.__del__()
+    assert not thread.is_alive()
@@ -0,0 +1,125 @@
+import os
+import time
+import statistics
+
+import pytest
+
+from core.checkdeps import HAS_PYPROJ
+from core.proj import crsdb, EPSGIO
+from core.proj.crsdb import CrsIndex
+
+pytestmark = pytest.mark.skipif(not HAS_PYPROJ, reason='the catalogue is built from the pyproj database')
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    '''EPSG catalogue, built once for the module (about 10 seconds)'''
+    index = CrsIndex.build(str(tmp_path_factory.mktemp('crs') / 'crs.sqlite'), auths=('EPSG',))
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def like(index, monkeypatch):
+    '''Same index, searched without the FTS5 extension'''
+    monkeypatch.setattr(index, 'hasFTS', False)
+    return index
+
+
+def codes(results):
+    return [r['code'] for r in results]
+
+
+def test_build(index):
+    assert index.hasFTS
+    assert int(index.meta['count']) > 5000
+    crs = index.get(2154)
+    assert crs['name'] == 'RGF93 v1 / Lambert-93' and crs['kind'] == 'PROJECTED_CRS'
+    assert '+proj=lcc' in crs['proj4'] and crs['wkt'].startswith('PROJCS')
+    assert index.getEsriWkt('4326').startswith('GEOGCS')
+    assert index.get(99999999) is None and index.getProj4(99999999) is None
+
+
+def test_searchCode(index):
+    assert codes(index.search('2154')) == ['2154']
+    #exact code first, then codes starting with the query by length
+    results = codes(index.search('215', limit=10))
+    assert results[0] == '2154' and all(code.startswith('215') for code in results)
+    assert index.search('0000000') == []
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('wgs 84 utm 31', {'32631', '32731'}),
+    ('WGS 84 / UTM zone 31N', {'32631'}),
+    ('lambert 93', {'2154'}),
+    ('pseudo mercator', {'3857'}),
+    ('Réunion', {'3727'})
+])
+def test_searchRanking(index, query, expected):
+    results = codes(index.search(query))
+    assert set(results[:len(expected)]) == expected
+
+
+def test_searchRankingKind(index):
+    '''2D crs come before the compound crs built on them'''
+    results = index.search('RGF93 Lambert')
+    kinds = [r['kind'] for r in results]
+    assert kinds.index('COMPOUND_CRS') > kinds.index('PROJECTED_CRS')
+    assert results[0]['code'] == '2154'
+
+
+def test_searchLatency(index):
+    '''Typical searches take less than a millisecond, a few broad words can take a bit longer'''
+    queries = ['2154', '326', 'wgs 84 utm 31', 'WGS 84 / UTM zone 31N', 'lambert 93', 'pseudo mercator', 'Réunion',
+        'RGF93 Lambert', 'etrs89 laea', 'gda94 mga 55', 'british national grid', 'amersfoort rd new', 'ed50 utm 32']
+    index.search('warm up')
+    durations = []
+    for query in queries:
+        best = float('inf')
+        for i in range(5):
+            t0 = time.perf_counter()
+            index.search(query)
+            best = min(best, time.perf_counter() - t0)
+        durations.append(best)
+    assert statistics.median(durations) < 0.001
+    assert max(durations) < 0.01
+    t0 = time.perf_counter()
+    index.search('utm')
+    assert time.perf_counter() - t0 < 0.05
+
+
+def test_defaultPath():
+    '''The catalogue is stored with the user data, not in the addon sources'''
+    assert not crsdb.CRS_DB_PATH.startswith(os.path.dirname(crsdb.__file__))
+
+
+def test_searchDeprecated(index):
+    results = index.search('wgs 84', limit=1000)
+    deprecated = [r['deprecated'] for r in results]
+    assert deprecated == sorted(deprecated)
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('wgs 84 utm 31', {'32631', '32731'}),
+    ('pseudo mercator', {'3857'}),
+    ('reunion', {'3727', '4626'})
+])
+def test_searchLike(like, query, expected):
+    results = codes(like.search(query))
+    assert set(results[:len(expected)]) == expected
+
+
+def test_searchLikeMatchesFTS(index, monkeypatch):
+    '''Without FTS5, word searches find at least the same crs (substrings instead of words prefixes)'''
+    fts = set(codes(index.search('lambert 93', limit=1000)))
+    monkeypatch.setattr(index, 'hasFTS', False)
+    like = set(codes(index.search('lambert 93', limit=1000)))
+    assert fts and like >= fts
+
+
+def test_epsgio(index, monkeypatch):
+    '''EPSGIO answers from the catalogue when it exists, without network access'''
+    monkeypatch.setattr(crsdb, 'CRS_DB_PATH', index.path)
+    assert codes(EPSGIO.search('2154')) == ['2154']
+    assert EPSGIO.getEsriWkt(2154) == index.getEsriWkt(2154)
+    crsdb._closeCrsIndex(index.path)
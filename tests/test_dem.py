@@ -0,0 +1,106 @@
+import numpy as np
+
+import pytest
+
+tifffile = pytest.importorskip('tifffile')
+
+from core.georaster import GeoRaster, GeoRef, demToMesh
+from core.utils import BBOX
+
+
+W, H, RES = 300, 200, 10
+XMIN, YMAX = 1000, 5000
+
+
+def position(cols, rows):
+    '''Value of the known raster at a position in pixels (pixel centers at integer coordinates)'''
+    return (cols * 1000 + rows).astype(np.float32)
+
+
+def expected(georef):
+    '''Values of the known raster at the pixel centers of a georef'''
+    rows, cols = np.mgrid[0:georef.rSize.y, 0:georef.rSize.x]
+    x = georef.origin.x + cols * georef.pxSize.x
+    y = georef.origin.y + rows * georef.pxSize.y
+    return position((x - XMIN) / RES - 0.5, (YMAX - y) / RES - 0.5)
+
+
+def writeDem(path, overviews=False, **kwargs):
+    '''float32 tiff with an optional half resolution overview, georeferenced with a world file'''
+    rows, cols = np.mgrid[0:H, 0:W]
+    data = position(cols, rows)
+    with tifffile.TiffWriter(path) as tif:
+        tif.write(data, **kwargs)
+        if overviews:
+            rows, cols = np.mgrid[0:H//2, 0:W//2]
+            tif.write(position(cols * 2 + 0.5, rows * 2 + 0.5), subfiletype=1, **kwargs)
+    GeoRef((W, H), (RES, -RES), (XMIN, YMAX), pxCenter=False).toWorldFile(path[:-4] + '.tfw')
+    return data
+
+
+@pytest.fixture
+def dem(tmp_path):
+    '''uncompressed float32 tiff, read through a memory map'''
+    path = str(tmp_path / 'dem.tif')
+    return path, writeDem(path)
+
+
+def test_decimatedRead(dem):
+    path, data = dem
+    rast = GeoRaster(path)
+    img = rast.readAsNpArray(targetRes=4 * RES)
+    assert img.data.shape == (H // 4, W // 4)
+    assert np.array_equal(img.data, data[::4, ::4])
+    #the georef is located at the sampled pixels
+    assert tuple(img.georef.pxSize) == (4 * RES, -4 * RES)
+    assert tuple(img.georef.origin) == (XMIN + RES / 2, YMAX - RES / 2)
+    assert np.array_equal(img.data, expected(img.georef))
+    #the raster georef is not modified
+    assert tuple(rast.georef.rSize) == (W, H)
+    #a step is the integer part of the resolution ratio
+    img = rast.readAsNpArray(targetRes=2.5 * RES)
+    assert np.array_equal(img.data, data[::2, ::2])
+    assert rast.readAsNpArray(targetRes=1.5 * RES).data.shape == (H, W)
+
+
+def test_decimatedSubset(dem):
+    path, data = dem
+    rast = GeoRaster(path, subBoxGeo=BBOX(XMIN + 500, YMAX - 1000, XMIN + 1500, YMAX - 300))
+    box = rast.subBoxPx
+    full = data[box.ymin:box.ymax+1, box.xmin:box.xmax+1]
+    img = rast.readAsNpArray(subset=True, targetRes=3 * RES)
+    assert np.array_equal(img.data, full[::3, ::3])
+    assert np.array_equal(img.data, expected(img.georef))
+    subGeoref = rast.getSubBoxGeoRef()
+    assert tuple(img.georef.origin) == tuple(subGeoref.origin)
+
+
+@pytest.mark.parametrize('targetRes', [2, 3, 4, 7])
+@pytest.mark.parametrize('compression', [None, 'deflate'])
+def test_decimatedOverview(tmp_path, targetRes, compression):
+    '''Coarse reads are sampled from the overview, with the georef of the overview pixels'''
+    path = str(tmp_path / 'dem.tif')
+    writeDem(path, overviews=True, compression=compression)
+    rast = GeoRaster(path)
+    img = rast.readAsNpArray(targetRes=targetRes * RES)
+    step = targetRes // 2 * 2 #steps are a multiple of the overview pixels size
+    assert tuple(img.georef.pxSize) == (step * RES, -step * RES)
+    assert img.data.shape == (-(-H // step), -(-W // step))
+    assert np.array_equal(img.data, expected(img.georef))
+    assert np.all(img.data % 1 == 0.5) #overview values, between the full resolution pixels centers
+    #with a sub box, the window is extended to the overview pixels covering it
+    rast = GeoRaster(path, subBoxGeo=BBOX(XMIN + 505, YMAX - 1000, XMIN + 1500, YMAX - 295))
+    img = rast.readAsNpArray(subset=True, targetRes=targetRes * RES)
+    assert np.array_equal(img.data, expected(img.georef))
+    assert img.georef.bbox.xmin <= XMIN + 500 and img.georef.bbox.ymax >= YMAX - 300
+
+
+def test_decimatedMesh(dem):
+    '''A mesh built on the decimated read matches the strided full resolution mesh'''
+    path, data = dem
+    rast = GeoRaster(path)
+    img = rast.readAsNpArray(targetRes=5 * RES)
+    verts, faces = demToMesh(img.georef, img.data)
+    ref, refFaces = demToMesh(rast.georef, data, step=5)
+    assert np.array_equal(faces, refFaces)
+    assert np.allclose(verts, ref)
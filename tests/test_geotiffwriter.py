@@ -0,0 +1,101 @@
+import numpy as np
+
+import pytest
+from PIL import Image
+
+from core.georaster import GeoRef, GeoTiffWriter, TiffReader
+from core.georaster.geotiffwriter import downsample
+from core.proj.srs import SRS
+from core.lib import Tyf
+
+
+W, H = 600, 300 #not a multiple of the tile size, two overviews (300x150 and 150x75)
+
+
+def image(w=W, h=H, nbBands=4):
+    rows, cols = np.mgrid[0:h, 0:w]
+    bands = [cols % 256, rows % 256, (cols * rows) % 256, (cols + rows) % 256]
+    return np.dstack(bands[0:nbBands]).astype(np.uint8)
+
+
+def write(path, data, georef, strip=100, **kwargs):
+    h, w = data.shape[0:2]
+    with GeoTiffWriter(path, w, h, georef, nbBands=data.shape[2], **kwargs) as writer:
+        for y in range(0, h, strip):
+            writer.writeStrip(data[y:y+strip], 0, y)
+
+
+def geoKeys(tif):
+    directory = tif.get(34735).value
+    return {directory[i]: directory[i+3] for i in range(4, len(directory), 4)}
+
+
+@pytest.mark.parametrize('nbBands, compress', [(4, 6), (3, 6), (1, 0)])
+def test_roundTrip(tmp_path, nbBands, compress):
+    '''Pixels and overviews read back with TiffReader and PIL match the written image'''
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False, crs=SRS(3857))
+    data = image(nbBands=nbBands)
+    write(path, data, georef, compress=compress)
+
+    assert TiffReader.levels(path) == [(0, W, H), (1, 300, 150), (2, 150, 75)]
+    expected = data
+    for idx, w, h in TiffReader.levels(path):
+        reader = TiffReader(path, idx)
+        assert reader.isTiled and reader.blockWidth == 256
+        out = reader.readWindow(0, 0, w, h)
+        assert np.array_equal(out.reshape(expected.shape), expected)
+        expected = downsample(expected)
+
+    with Image.open(path) as img:
+        assert img.size == (W, H)
+        assert np.array_equal(np.asarray(img).reshape(data.shape), data)
+
+
+def test_geotags(tmp_path):
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False, crs=SRS(2154))
+    write(path, image(), georef)
+    tifs = Tyf.open(path)
+    tif = tifs[0]
+    assert tif.get(33922).value == (0, 0, 0, 600000, 6800000, 0)
+    assert tif.get(33550).value == (10, 10, 0)
+    assert geoKeys(tif) == {1024: 1, 1025: 1, 3072: 2154}
+    assert tuple(GeoRef.fromTyf(tif).origin) == tuple(georef.origin)
+    #overviews are flagged as reduced resolution images and carry no geotags
+    assert [t.get(254).value[0] for t in tifs] == [0, 1, 1]
+    assert tifs[1].get(34735) is None
+
+    #world file
+    wf = GeoRef.fromWorldFile(str(tmp_path / 'out.tfw'), (W, H))
+    assert tuple(wf.origin) == tuple(georef.origin) == (600005, 6799995)
+    assert tuple(wf.pxSize) == (10, -10)
+
+    #geographic crs
+    georef.crs = SRS(4326)
+    write(path, image(), georef)
+    assert geoKeys(Tyf.open(path)[0]) == {1024: 2, 1025: 1, 2048: 4326}
+
+
+def test_noWorldFile(tmp_path):
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False)
+    write(path, image(), georef, worldFile=False, overviews=False)
+    assert not (tmp_path / 'out.tfw').exists()
+    assert TiffReader.levels(path) == [(0, W, H)]
+    assert geoKeys(Tyf.open(path)[0]) == {1025: 1}
+
+
+def test_incomplete(tmp_path):
+    '''Rows missing when the writer is closed are transparent'''
+    path = str(tmp_path / 'out.tif')
+    georef = GeoRef((W, H), (10, -10), (600000, 6800000), pxCenter=False)
+    data = image()
+    writer = GeoTiffWriter(path, W, H, georef)
+    writer.writeStrip(data[0:100], 0, 0)
+    with pytest.raises(ValueError):
+        writer.writeStrip(data[200:300], 0, 200)
+    writer.close()
+    out = TiffReader(path).readWindow(0, 0, W, H)
+    assert np.array_equal(out[0:100], data[0:100])
+    assert not out[100:].any()
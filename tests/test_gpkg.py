@@ -0,0 +1,78 @@
+import random
+import sqlite3
+import threading
+
+import pytest
+
+from core.basemaps import GeoPackage, TileMatrix, GRIDS
+
+
+@pytest.fixture
+def gpkg(tmp_path):
+    cache = GeoPackage(str(tmp_path / 'cache.gpkg'), TileMatrix(GRIDS['WM']))
+    #dense blocks on two zoom levels, data identify the tile
+    tiles = [(x, y, z) for z in (10, 11) for x in range(32) for y in range(32)]
+    cache.putTiles([(x, y, z, '{}/{}/{}'.format(x, y, z).encode()) for x, y, z in tiles])
+    yield cache
+    cache.close()
+
+
+def test_getTiles_diagonal(gpkg):
+    #a diagonal has the same bbox than the whole block, only the requested tiles must be returned
+    tiles = [(i, i, 10) for i in range(32)]
+    result = gpkg.getTiles(tiles)
+    assert sorted((x, y, z) for x, y, z, data in result) == sorted(tiles)
+    assert all(data == '{}/{}/{}'.format(x, y, z).encode() for x, y, z, data in result)
+
+
+def test_getTiles_multizoom_sparse(gpkg):
+    rnd = random.Random(0)
+    tiles = [(rnd.randrange(40), rnd.randrange(40), rnd.choice((10, 11, 12))) for i in range(200)]
+    expected = set(t for t in tiles if t[2] != 12 and t[0] < 32 and t[1] < 32)
+    result = gpkg.getTiles(tiles)
+    assert len(result) == len(expected) #duplicates in the request are returned once
+    assert set((x, y, z) for x, y, z, data in result) == expected
+    assert gpkg.listExistingTiles(tiles) == expected
+    assert gpkg.listMissingTiles(tiles) == set(tiles) - expected
+
+
+def test_failedTiles(gpkg):
+    gpkg.putFailures([(40, 40, 10, 'NOT_FOUND', 3600), (41, 41, 10, 'TIMEOUT', -1)])
+    tiles = [(40, 40, 10), (41, 41, 10), (0, 0, 10)]
+    assert gpkg.listFailedTiles(tiles) == {(40, 40, 10)} #expired failure can be retried
+    assert gpkg.listMissingTiles(tiles) == {(41, 41, 10)}
+    #valid data clear the failure record
+    gpkg.putTiles([(40, 40, 10, b'data')])
+    assert gpkg.listFailedTiles(tiles) == set()
+
+
+def test_empty_request(gpkg):
+    assert gpkg.getTiles([]) == []
+    assert gpkg.listExistingTiles([]) == set()
+
+
+def test_concurrentWrites(gpkg):
+    '''Writes of concurrent threads are all committed, a faulty write only fails in its own thread'''
+    errors = []
+
+    def write(i):
+        try:
+            if i == 3:
+                gpkg.connections.write('INSERT INTO missing_table VALUES (?)', (i,))
+            else:
+                gpkg.putTiles([(100 + i, k, 12, b'data') for k in range(20)])
+        except sqlite3.OperationalError as e:
+            errors.append(i)
+
+    connections = gpkg.connections
+    nbWrites = connections.nbWrites
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == [3]
+    tiles = [(100 + i, k, 12) for i in range(8) for k in range(20) if i != 3]
+    assert gpkg.listExistingTiles(tiles) == set(tiles)
+    assert connections.nbWrites - nbWrites == 7
+    assert connections.jobs.empty()
@@ -0,0 +1,80 @@
+import time
+import asyncio
+import threading
+import urllib.request
+
+import pytest
+
+from tileserver import TileServer
+from core.basemaps.httppool import ConnectionPool, CancelToken, RequestCanceled, useProxy
+from core.basemaps.asynchttp import AsyncConnectionPool
+
+
+@pytest.fixture
+def server():
+    with TileServer() as server:
+        yield server
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    '''A proxy on a closed port, requests sent through it fail'''
+    for var in ('http_proxy', 'HTTP_PROXY', 'no_proxy', 'NO_PROXY'):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:9')
+    #urlopen() caches an opener built with the proxies of the environment at its first call
+    monkeypatch.setattr(urllib.request, '_opener', None)
+
+
+def test_proxy(server, proxy):
+    url = server.url + '0/0/0.png'
+    assert useProxy(url)
+    with pytest.raises(OSError):
+        ConnectionPool().request(url, timeout=5)
+    assert server.nbRequests == 0
+
+
+def test_proxyBypass(server, proxy, monkeypatch):
+    '''Hosts listed in no_proxy are reached directly through the pool'''
+    monkeypatch.setenv('no_proxy', 'localhost,127.0.0.1')
+    url = server.url + '0/0/0.png'
+    assert not useProxy(url)
+    pool = ConnectionPool()
+    assert pool.request(url, timeout=5) == server.tile
+    assert pool.request(url, timeout=5) == server.tile
+    assert pool.stats['created'] == 1 and pool.stats['reused'] == 1
+
+    async def fetch():
+        pool = AsyncConnectionPool()
+        try:
+            return await pool.request(url, timeout=5), pool.stats
+        finally:
+            await pool.aclose()
+    data, stats = asyncio.run(fetch())
+    assert data == server.tile and stats['created'] == 1
+    assert server.nbRequests == 3
+
+
+def test_noProxy(server, monkeypatch):
+    for var in ('http_proxy', 'HTTP_PROXY'):
+        monkeypatch.delenv(var, raising=False)
+    assert not useProxy(server.url)
+
+
+def test_cancel():
+    '''A canceled request is aborted right away and its connection is not reused'''
+    with TileServer(latency=2) as server:
+        pool = ConnectionPool()
+        token = CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+        t0 = time.perf_counter()
+        with pytest.raises(RequestCanceled):
+            pool.request(server.url, timeout=5, cancel=token)
+        assert time.perf_counter() - t0 < 1
+        assert pool.stats['idle'] == 0
+        #a token canceled before the request
+        with pytest.raises(RequestCanceled):
+            pool.request(server.url, timeout=5, cancel=token)
+        server.latency = 0
+        assert pool.request(server.url, timeout=5, cancel=CancelToken()) == server.tile
+        assert pool.stats['idle'] == 1
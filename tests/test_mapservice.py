@@ -0,0 +1,302 @@
+import os
+import socket
+import sqlite3
+import asyncio
+import functools
+import threading
+import urllib.error
+
+import numpy as np
+
+import pytest
+
+from tileserver import TileServer
+from core.basemaps import MapService, SOURCES, mapservice
+from core.basemaps.mapservice import EMPTY_TILE_COLOR
+from core.basemaps.policy import DownloadPolicy
+from core.basemaps.httppool import ConnectionPool
+from core.basemaps.singleflight import SingleFlight
+from core.georaster import NpImage, GeoTiffWriter, TiffReader, npimg
+from core.georaster.warp import warp
+
+
+TILES = [(x, y, 11) for x in range(1000, 1004) for y in range(700, 703)]
+
+
+@pytest.fixture
+def server():
+    with TileServer(colored=True) as server:
+        yield server
+
+
+@pytest.fixture
+def mapService(tmp_path, monkeypatch):
+    '''Factory of map services downloading from a local tile server, without retries'''
+    #policies are shared by source key, each test gets its own
+    monkeypatch.setattr(DownloadPolicy, '_policies', {})
+    services = []
+
+    def make(server, engine='THREAD', **kwargs):
+        monkeypatch.setitem(SOURCES, 'TEST', dict(SOURCES['OSM'], urlTemplate=server.url + '{Z}/{X}/{Y}.png',
+            policy={'retries': 0}))
+        ms = MapService('TEST', str(tmp_path), engine=engine, **kwargs)
+        ms.running = True
+        services.append(ms)
+        return ms
+
+    MapService.tilesLRU.clear()
+    yield make
+    for ms in services:
+        ms.running = False
+    MapService.tilesLRU.clear()
+
+
+def bboxTiles(ms, col, row, zoom, nx, ny):
+    '''bbox covering exactly nx x ny tiles of the source grid, slightly inside the tiles edges'''
+    tm = ms.srcTms
+    xmin, ymax = tm.getTileCoords(col, row, zoom)
+    size = tm.tileSize * tm.getRes(zoom)
+    eps = size / 100
+    return (xmin + eps, ymax - ny * size + eps, xmin + nx * size - eps, ymax - eps)
+
+
+def failureReasons(cache):
+    '''Return {(x,y,z) : reason} of the failed tiles recorded in a cache database'''
+    db = sqlite3.connect(cache.dbPath)
+    try:
+        rows = db.execute('SELECT tile_column, tile_row, zoom_level, reason FROM bgis_failed_tiles').fetchall()
+    finally:
+        db.close()
+    return {(x, y, z) : reason for x, y, z, reason in rows}
+
+
+@pytest.mark.parametrize('engine', MapService.ENGINES)
+def test_seed(server, mapService, engine):
+    ms = mapService(server, engine)
+    ms.seedTiles('MAPNIK', TILES, toDstGrid=False, nbThread=4, cpt=False)
+    cache = ms.getCache('MAPNIK', False)
+    tiles = cache.getTiles(TILES)
+    assert set((x, y, z) for x, y, z, data in tiles) == set(TILES)
+    #colored server, each url gets its own tile
+    assert len(set(data for x, y, z, data in tiles)) == len(TILES)
+    assert server.nbRequests == len(TILES)
+    #cached tiles are not requested again
+    ms.seedTiles('MAPNIK', TILES, toDstGrid=False, nbThread=4, cpt=False)
+    assert server.nbRequests == len(TILES)
+
+
+@pytest.mark.parametrize('engine', MapService.ENGINES)
+def test_seedErrors(server, mapService, engine):
+    '''Non 200 responses are recorded as failures with their reason, the others tiles are cached'''
+    ms = mapService(server, engine)
+    server.errors = [404, 500, 429]
+    ms.seedTiles('MAPNIK', TILES, toDstGrid=False, nbThread=4, cpt=False)
+    cache = ms.getCache('MAPNIK', False)
+    reasons = failureReasons(cache)
+    assert sorted(reasons.values()) == ['HTTP_ERROR', 'NOT_FOUND', 'THROTTLED']
+    assert cache.listExistingTiles(TILES) == set(TILES) - set(reasons)
+    assert server.nbRequests == len(TILES)
+    #failed tiles are not requested again before their ttl
+    ms.seedTiles('MAPNIK', TILES, toDstGrid=False, nbThread=4, cpt=False)
+    assert server.nbRequests == len(TILES)
+
+
+@pytest.mark.parametrize('engine', MapService.ENGINES)
+def test_seedTimeout(mapService, monkeypatch, engine):
+    '''Every second response comes after the timeout'''
+    monkeypatch.setattr(mapservice, 'TIMEOUT', 0.3)
+    with TileServer(colored=True, slowEvery=2, slowLatency=1) as server:
+        ms = mapService(server, engine)
+        ms.seedTiles('MAPNIK', TILES, toDstGrid=False, nbThread=4, cpt=False)
+        cache = ms.getCache('MAPNIK', False)
+        reasons = failureReasons(cache)
+        assert list(reasons.values()) == ['TIMEOUT'] * (len(TILES) // 2)
+        assert cache.listExistingTiles(TILES) == set(TILES) - set(reasons)
+
+
+@pytest.mark.parametrize('e, reason', [
+    (urllib.error.HTTPError('', 404, 'Not Found', None, None), 'NOT_FOUND'),
+    (urllib.error.HTTPError('', 410, 'Gone', None, None), 'NOT_FOUND'),
+    (urllib.error.HTTPError('', 429, 'Too Many Requests', None, None), 'THROTTLED'),
+    (urllib.error.HTTPError('', 500, 'Internal Server Error', None, None), 'HTTP_ERROR'),
+    (urllib.error.HTTPError('', 503, 'Service Unavailable', None, None), 'HTTP_ERROR'),
+    (socket.timeout('timed out'), 'TIMEOUT'),
+    (asyncio.TimeoutError(), 'TIMEOUT'),
+    (urllib.error.URLError(TimeoutError('timed out')), 'TIMEOUT'),
+    (urllib.error.URLError(ConnectionRefusedError(111, 'Connection refused')), 'NETWORK'),
+    (ConnectionResetError(), 'NETWORK')
+])
+def test_failureReason(e, reason):
+    assert MapService.getFailureReason(e) == reason
+
+
+def test_failedTilesImage(server, mapService):
+    '''Tiles answered by 404 or 500 are recorded and drawn as empty tiles, without new requests'''
+    ms = mapService(server)
+    bbox = bboxTiles(ms, 1000, 700, 11, 3, 1)
+    server.errors = [404, 500]
+    img = ms.getImage('MAPNIK', bbox, 11, toDstGrid=False, nbThread=1, cpt=False)
+    reasons = failureReasons(ms.getCache('MAPNIK', False))
+    assert sorted(reasons.values()) == ['HTTP_ERROR', 'NOT_FOUND']
+    for col in range(1000, 1003):
+        tile = img.data[:, (col - 1000) * 256:(col - 999) * 256]
+        assert np.all(tile == EMPTY_TILE_COLOR) == ((col, 700, 11) in reasons)
+    #failures are read from the cache database, not from the decoded tiles memory
+    ms.tilesLRU.clear()
+    img2 = ms.getImage('MAPNIK', bbox, 11, toDstGrid=False, nbThread=1, cpt=False)
+    assert np.array_equal(img.data, img2.data)
+    assert server.nbRequests == 3
+
+
+def runThreads(fn, n):
+    '''Call fn from n threads started together, return the results or raised exceptions'''
+    results = [None] * n
+    barrier = threading.Barrier(n)
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_singleFlight(mapService):
+    '''Threads requesting the same tile share a single download'''
+    with TileServer(colored=True, latency=0.3) as server:
+        ms = mapService(server)
+        stats = ms.inflight.stats
+        results = runThreads(lambda: ms._tileRequest('MAPNIK', 1000, 700, 11, toDstGrid=False), 8)
+        assert server.nbRequests == 1
+        data, reason = results[0]
+        assert data is not None and reason is None
+        assert all(result == (data, None) for result in results)
+        assert ms.inflight.stats['calls'] - stats['calls'] == 1
+        assert ms.inflight.stats['avoided'] - stats['avoided'] == 7
+        #the key is released, the next request is a new download
+        assert ms.inflight.stats['inFlight'] == 0
+        assert ms._tileRequest('MAPNIK', 1000, 700, 11, toDstGrid=False) == (data, None)
+        assert server.nbRequests == 2
+        #failures are shared too
+        server.errors = [500]
+        results = runThreads(lambda: ms._tileRequest('MAPNIK', 1000, 700, 11, toDstGrid=False), 8)
+        assert results == [(None, 'HTTP_ERROR')] * 8
+        assert server.nbRequests == 3
+
+
+def test_singleFlightError():
+    '''The exception raised by the leading call reaches all the waiting threads'''
+    flight = SingleFlight()
+    pool = ConnectionPool()
+    with TileServer(latency=0.3) as server:
+        server.errors = [404]
+        results = runThreads(lambda: flight.do('key', pool.request, server.url, timeout=5), 8)
+        assert server.nbRequests == 1
+        assert all(isinstance(e, urllib.error.HTTPError) and e.code == 404 for e in results)
+        assert flight.stats == {'calls': 1, 'avoided': 7, 'inFlight': 0}
+        #the key is released after a failure
+        assert flight.do('key', pool.request, server.url, timeout=5) == server.tile
+        assert server.nbRequests == 2
+
+
+def test_metatiles(server, mapService, monkeypatch, tmp_path):
+    '''
+    Destination tiles built by metatiles are the same than the tiles built one by one, for partial blocks
+    inside the grid and at its edges. The numpy warper is used with the exact transform, otherwise
+    the approximated one gives slightly different pixels along the source tiles edges
+    '''
+    monkeypatch.setattr(npimg, 'HAS_GDAL', False)
+    monkeypatch.setattr(npimg, 'warp', functools.partial(warp, maxErr=0))
+    tiles = [(col, row, 8) for col, row in [
+        (0, 0), (1, 0), (0, 1), (-1, 0), #top left corner of the grid
+        (123, 51), (124, 51), (123, 52), (124, 52), #4 blocks of 4x4 tiles
+        (255, 237), (256, 237), (255, 238) #bottom right corner
+    ]]
+    results = []
+    for metatileSize in (1, 4):
+        ms = mapService(server, dstGridKey='LB93', metatileSize=metatileSize)
+        ms.cacheFolder = str(tmp_path / str(metatileSize)) #separate caches, source tiles included
+        os.mkdir(ms.cacheFolder)
+        ms.seedTiles('MAPNIK', tiles, toDstGrid=True, nbThread=4, cpt=False)
+        cache = ms.getCache('MAPNIK', True)
+        results.append({(x, y, z) : NpImage(data).data for x, y, z, data in cache.getTiles(tiles)})
+        assert failureReasons(cache) == {}
+    tiles1, tiles4 = results
+    assert set(tiles1) == set(tiles[:3] + tiles[4:9])
+    assert set(tiles4) == set(tiles1)
+    for tile, data in tiles1.items():
+        assert np.array_equal(tiles4[tile], data), tile
+
+
+def boxFilter(tiles, col, row, zoom):
+    '''Expected parent tile, average of each 2x2 block of pixels of its 4 children'''
+    children = [[tiles[(2 * col + dx, 2 * row + dy, zoom + 1)].astype(np.uint16) for dx in (0, 1)] for dy in (0, 1)]
+    block = np.vstack([np.hstack(children[0]), np.hstack(children[1])])
+    return ((block[0::2, 0::2] + block[0::2, 1::2] + block[1::2, 0::2] + block[1::2, 1::2] + 2) // 4).astype(np.uint8)
+
+
+def test_pyramid(server, mapService):
+    '''Levels 11 and 10 are built from the tiles of level 12 without download, parents of a failed tile stay missing'''
+    ms = mapService(server)
+    bbox = bboxTiles(ms, 2000, 1400, 12, 4, 4)
+    server.errors = [404]
+    ms.seedCache('MAPNIK', bbox, 12, toDstGrid=False)
+    assert server.nbRequests == 16
+    cache = ms.getCache('MAPNIK', False)
+    failed = list(failureReasons(cache))
+    assert len(failed) == 1
+    x, y, z = failed[0]
+    ms.buildPyramid('MAPNIK', bbox, [10, 11], toDstGrid=False, cpt=False)
+    assert server.nbRequests == 16
+    tiles = ms.bboxRequest(bbox, 12, dstGrid=False).tiles + ms.bboxRequest(bbox, 11, dstGrid=False).tiles + [(500, 350, 10)]
+    tiles = {(col, row, zoom) : NpImage(data).data for col, row, zoom, data in cache.getTiles(tiles)}
+    assert len(tiles) == 15 + 3
+    assert (x // 2, y // 2, 11) not in tiles and (500, 350, 10) not in tiles
+    for col, row, zoom in list(tiles):
+        if zoom == 11:
+            assert np.array_equal(tiles[(col, row, zoom)], boxFilter(tiles, col, row, zoom))
+    #without missing child, the level 10 tile is built from the level 11 tiles just computed
+    ms.putInCache('MAPNIK', [(x // 2, y // 2, 11, NpImage(np.zeros((256, 256, 3), dtype=np.uint8)).toBLOB())], cache, False)
+    ms.buildPyramid('MAPNIK', bbox, [10], toDstGrid=False, cpt=False)
+    tiles.update({(col, row, zoom) : NpImage(data).data for col, row, zoom, data in cache.getTiles([(x // 2, y // 2, 11), (500, 350, 10)])})
+    assert np.array_equal(tiles[(500, 350, 10)], boxFilter(tiles, 500, 350, 10))
+    assert server.nbRequests == 16
+
+
+@pytest.mark.parametrize('stop', [None, 0, 2, 'error'])
+def test_bigTiffCancel(server, mapService, monkeypatch, tmp_path, stop):
+    '''A bigTiff output canceled (while or after writing the strips) or failed is closed and removed'''
+    ms = mapService(server)
+    monkeypatch.setattr(mapservice, 'HAS_GDAL', False)
+    strips = []
+
+    class Writer(GeoTiffWriter):
+        def writeStrip(self, data, x, y):
+            if stop == 'error':
+                raise IOError('disk full')
+            super().writeStrip(data, x, y)
+            if len(strips) == stop:
+                ms.running = False
+            strips.append(y)
+
+    monkeypatch.setattr(mapservice, 'GeoTiffWriter', Writer)
+    path = str(tmp_path / 'out.tif')
+    bbox = bboxTiles(ms, 1000, 700, 11, 3, 3)
+    if stop == 'error':
+        with pytest.raises(IOError):
+            ms.getImage('MAPNIK', bbox, 11, path=path, bigTiff=True, toDstGrid=False, cpt=False)
+    else:
+        assert ms.getImage('MAPNIK', bbox, 11, path=path, bigTiff=True, toDstGrid=False, cpt=False) is None
+    if stop is None:
+        assert TiffReader(path).size == (3 * 256, 3 * 256)
+        return
+    assert not os.path.exists(path)
+    if stop == 'error':
+        assert strips == []
+    else:
+        assert strips == [y * 256 for y in range(stop + 1)]
@@ -0,0 +1,82 @@
+import numpy as np
+
+import pytest
+
+from tileserver import TileServer
+from core.basemaps import MapService, SOURCES, BBoxRequest
+from core.basemaps.mapservice import MOSAIC_BKG_COLOR, EMPTY_TILE_COLOR
+from core.basemaps.policy import DownloadPolicy
+from core.georaster import NpImage
+
+
+@pytest.fixture
+def srv(tmp_path, monkeypatch):
+    with TileServer(colored=True) as server:
+        monkeypatch.setitem(SOURCES, 'TEST', dict(SOURCES['OSM'], urlTemplate=server.url + '{Z}/{X}/{Y}.png', policy={}))
+        monkeypatch.setattr(DownloadPolicy, '_policies', {})
+        ms = MapService('TEST', str(tmp_path))
+        ms.server = server
+        ms.running = True
+        ms.tilesLRU.clear()
+        yield ms
+        ms.running = False
+        ms.tilesLRU.clear()
+
+
+def bboxTiles(ms, col, row, zoom, nx, ny):
+    '''bbox covering exactly nx x ny tiles of the source grid, slightly inside the tiles edges'''
+    tm = ms.srcTms
+    xmin, ymax = tm.getTileCoords(col, row, zoom)
+    size = tm.tileSize * tm.getRes(zoom)
+    eps = size / 100
+    return (xmin + eps, ymax - ny * size + eps, xmin + nx * size - eps, ymax - eps)
+
+
+def pasteMosaic(ms, bbox, zoom):
+    '''Mosaic assembled the former way, one NpImage and one paste per tile'''
+    rq = BBoxRequest(ms.srcTms, bbox, zoom)
+    mosaic = NpImage.new(rq.nbTilesX * rq.tileSize, rq.nbTilesY * rq.tileSize, bkgColor=MOSAIC_BKG_COLOR)
+    for col, row, z, data in ms.getCache('MAPNIK', False).getTiles(rq.tiles):
+        mosaic.paste(NpImage(data), (col - rq.firstCol) * rq.tileSize, (row - rq.firstRow) * rq.tileSize)
+    return mosaic.data
+
+
+def test_directDecode(srv):
+    bbox = bboxTiles(srv, 1000, 700, 11, 4, 3)
+    img = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, cpt=False)
+    assert img.data.shape == (3 * 256, 4 * 256, 4)
+    assert np.array_equal(img.data, pasteMosaic(srv, bbox, 11))
+    #decoded tiles are now served by the LRU
+    img2 = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, cpt=False)
+    assert np.array_equal(img.data, img2.data)
+
+
+def test_processDecode(srv):
+    bbox = bboxTiles(srv, 1000, 700, 11, 3, 2)
+    srv.DECODE_POOL, srv.DECODE_WORKERS = 'PROCESS', 2
+    img = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, cpt=False)
+    assert np.array_equal(img.data, pasteMosaic(srv, bbox, 11))
+
+
+def test_memmap(srv):
+    bbox = bboxTiles(srv, 1000, 700, 11, 4, 3)
+    img = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, cpt=False)
+    srv.tilesLRU.clear()
+    mapped = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, memmap=True, cpt=False)
+    assert isinstance(mapped.data.base, np.memmap) or isinstance(mapped.data, np.memmap)
+    assert np.array_equal(img.data, mapped.data)
+    assert mapped.georef.bbox == img.georef.bbox
+
+
+def test_failedTiles(srv):
+    bbox = bboxTiles(srv, 1000, 700, 11, 2, 1)
+    srv.server.errors = [404]
+    img = srv.getImage('MAPNIK', bbox, 11, toDstGrid=False, nbThread=1, cpt=False)
+    tiles = [img.data[:, 0:256], img.data[:, 256:512]]
+    empty = [np.all(tile == EMPTY_TILE_COLOR) for tile in tiles]
+    assert sorted(empty) == [False, True]
+
+
+def test_emptyBbox(srv):
+    assert srv.getImage('MAPNIK', (0, 0, 0, 0), 5, toDstGrid=False, cpt=False) is None
+    assert srv.getImage('MAPNIK', (0, 0, 0, 0), 5, toDstGrid=False, memmap=True, cpt=False) is None
@@ -0,0 +1,164 @@
+import time
+import asyncio
+import threading
+import urllib.error
+
+import pytest
+
+from tileserver import TileServer
+from core.basemaps.policy import DownloadPolicy, TokenBucket, HEDGE_WORKERS
+from core.basemaps.httppool import ConnectionPool, RequestCanceled
+from core.basemaps.asynchttp import AsyncConnectionPool
+
+
+@pytest.fixture
+def server():
+    with TileServer() as server:
+        yield server
+
+
+def test_tokenBucket_burst_then_rate():
+    bucket = TokenBucket(rate=100, burst=5)
+    delays = [bucket.reserve() for i in range(15)]
+    assert delays[:5] == [0] * 5
+    #each extra token is available 1/rate second after the previous one
+    assert delays[5:] == pytest.approx([(i + 1) / 100 for i in range(10)], abs=5e-3)
+    assert not bucket.tryAcquire()
+
+
+def test_rateLimit(server):
+    policy = DownloadPolicy(rate=50, burst=5)
+    pool = ConnectionPool()
+    t0 = time.perf_counter()
+    for i in range(30):
+        policy.request(pool.request, server.url, timeout=4)
+    elapsed = time.perf_counter() - t0
+    assert elapsed >= (30 - 5) / 50 * 0.95
+    #requests arrival rate at the server never exceeds the burst + rate budget
+    times = server.times
+    for i, t in enumerate(times):
+        nb = sum([1 for t2 in times if t <= t2 < t + 0.2])
+        assert nb <= 5 + 0.2 * 50 + 1
+
+
+def test_retry_backoff(server):
+    policy = DownloadPolicy(retries=2, backoff=0.1)
+    pool = ConnectionPool()
+    server.errors = [503, 503]
+    t0 = time.perf_counter()
+    assert policy.request(pool.request, server.url, timeout=4) == server.tile
+    elapsed = time.perf_counter() - t0
+    assert server.nbRequests == 3
+    assert policy.stats['retries'] == 2
+    #full jitter : attempt n waits between 0 and backoff * 2**n
+    assert elapsed < 0.1 + 0.2 + 0.2
+
+
+def test_retry_exhausted_and_not_retryable(server):
+    policy = DownloadPolicy(retries=1, backoff=0.01)
+    pool = ConnectionPool()
+    server.errors = [500, 500]
+    with pytest.raises(urllib.error.HTTPError) as e:
+        policy.request(pool.request, server.url, timeout=4)
+    assert e.value.code == 500 and server.nbRequests == 2
+    server.errors = [404]
+    with pytest.raises(urllib.error.HTTPError) as e:
+        policy.request(pool.request, server.url, timeout=4)
+    assert e.value.code == 404 and server.nbRequests == 3
+
+
+def test_retryAfter():
+    policy = DownloadPolicy(retries=1, backoff=10, maxBackoff=1)
+    attempts = []
+    def fn():
+        attempts.append(time.perf_counter())
+        if len(attempts) == 1:
+            raise urllib.error.HTTPError('url', 429, 'Too Many Requests', {'Retry-After': '0.3'}, None)
+        return b'data'
+    assert policy.request(fn) == b'data'
+    assert 0.3 <= attempts[1] - attempts[0] < 0.6
+    #the header is capped by maxBackoff
+    e = urllib.error.HTTPError('url', 429, 'Too Many Requests', {'Retry-After': '3600'}, None)
+    assert policy.retryDelay(0, e) == 1
+
+
+def test_hedge():
+    with TileServer(latency=0.01, slowEvery=10, slowLatency=2) as server:
+        policy = DownloadPolicy(hedge=True, hedgePercentile=90, hedgeMinSamples=5)
+        pool = ConnectionPool()
+        durations = []
+        for i in range(10):
+            t0 = time.perf_counter()
+            policy.request(pool.request, server.url, timeout=4)
+            durations.append(time.perf_counter() - t0)
+    #the 10th request is slow on the server side, the hedged request answers first and the slow one
+    #is aborted. Requests just above the percentile may also be hedged, but lose
+    assert policy.stats['hedged'] >= 1 and policy.stats['hedgeWins'] == 1
+    assert durations[-1] < 0.5
+
+
+def slowRequest(calls, slow):
+    '''Fake request function, the calls listed in slow wait until they are canceled'''
+    def fn(cancel):
+        calls.append((threading.current_thread(), cancel))
+        if len(calls) in slow:
+            t0 = time.perf_counter()
+            while not cancel.canceled:
+                if time.perf_counter() - t0 > 2:
+                    return b'late'
+                time.sleep(0.005)
+            raise RequestCanceled()
+        time.sleep(0.05)
+        return b'data'
+    return fn
+
+
+@pytest.mark.parametrize('slow, wins', [({1}, 1), ({2}, 0)])
+def test_hedgeCancel(slow, wins):
+    '''The first request runs in the calling thread, the hedged one in the pool, the slower one is canceled'''
+    policy = DownloadPolicy(hedge=True, hedgeMinSamples=1)
+    policy.latency.add(0.01)
+    calls = []
+    t0 = time.perf_counter()
+    assert policy.request(slowRequest(calls, slow)) == b'data'
+    assert time.perf_counter() - t0 < 0.5
+    assert calls[0][0] is threading.current_thread() and calls[1][0] is not threading.current_thread()
+    assert policy.stats['hedged'] == 1 and policy.stats['hedgeWins'] == wins
+    #the loser is canceled
+    loser = calls[min(slow) - 1][1]
+    t0 = time.perf_counter()
+    while not loser.canceled and time.perf_counter() - t0 < 1:
+        time.sleep(0.01)
+    assert loser.canceled
+
+
+def test_hedgeWorkers():
+    '''The hedging pool grows with the number of threads sending requests'''
+    policy = DownloadPolicy(hedge=True, hedgeMinSamples=1)
+    policy.latency.add(1)
+    barrier = threading.Barrier(HEDGE_WORKERS + 5)
+    def fn(cancel):
+        barrier.wait(timeout=5)
+        return b'data'
+    threads = [threading.Thread(target=policy.request, args=(fn,)) for i in range(HEDGE_WORKERS + 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert policy.nbHedgeWorkers >= HEDGE_WORKERS + 1
+    policy.setHedgeWorkers(2) #never shrinks
+    assert policy.nbHedgeWorkers >= HEDGE_WORKERS + 1
+
+
+def test_retry_async(server):
+    async def run():
+        policy = DownloadPolicy(retries=2, backoff=0.05)
+        pool = AsyncConnectionPool()
+        server.errors = [429, 502]
+        try:
+            return await policy.requestAsync(pool.request, server.url, timeout=4), policy
+        finally:
+            await pool.aclose()
+    data, policy = asyncio.run(run())
+    assert data == server.tile
+    assert server.nbRequests == 3 and policy.stats['retries'] == 2
@@ -0,0 +1,231 @@
+import threading
+
+import numpy as np
+
+import pytest
+
+from core import settings
+from core.checkdeps import HAS_GDAL, HAS_PYPROJ
+from core.proj import utm, Reproj, reprojArrays
+from core.proj import reproj
+from core.proj.reproj import ReprojCache, webMercToLonLat, lonLatToWebMerc, webMercToLonLatArrays, lonLatToWebMercArrays
+
+
+@pytest.fixture
+def builtin(monkeypatch):
+    monkeypatch.setattr(settings, 'proj_engine', 'BUILTIN')
+
+
+def lonlats(lonmin, latmin, lonmax, latmax, n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(lonmin, lonmax, n), rng.uniform(latmin, latmax, n)
+
+
+@pytest.mark.parametrize('zone, north, latmin, latmax', [(31, True, 0, 84), (31, False, -80, 0), (1, True, 40, 50)])
+def test_utmParity(zone, north, latmin, latmax):
+    proj = utm.UTM(zone, north)
+    lon0 = utm.zone_number_to_central_longitude(zone)
+    lons, lats = lonlats(lon0 - 3, latmin, lon0 + 3, latmax)
+    xs, ys = proj.lonlat_to_utm_arrays(lons, lats)
+    assert np.array_equal(np.column_stack((xs, ys)), [proj.lonlat_to_utm(lon, lat) for lon, lat in zip(lons, lats)])
+    lons2, lats2 = proj.utm_to_lonlat_arrays(xs, ys)
+    assert np.array_equal(np.column_stack((lons2, lats2)), [proj.utm_to_lonlat(x, y) for x, y in zip(xs, ys)])
+    #the builtin series are approximations, a few micro degrees off near the poles
+    assert np.allclose(lons2, lons, atol=1e-5) and np.allclose(lats2, lats, atol=1e-5)
+
+
+def test_utmOutOfRange():
+    proj = utm.UTM(31, True)
+    with pytest.raises(utm.OutOfRangeError):
+        proj.lonlat_to_utm(3, 85)
+    with pytest.raises(utm.OutOfRangeError):
+        proj.lonlat_to_utm_arrays([3, 3], [45, 85])
+    with pytest.raises(utm.OutOfRangeError):
+        proj.utm_to_lonlat_arrays([500000, 1200000], [5000000, 5000000])
+
+
+def test_webMercParity():
+    lons, lats = lonlats(-180, -85, 180, 85)
+    xs, ys = lonLatToWebMercArrays(lons, lats)
+    ref = np.array([lonLatToWebMerc(lon, lat) for lon, lat in zip(lons, lats)])
+    assert np.allclose(xs, ref[:, 0], rtol=1e-15, atol=1e-8)
+    assert np.allclose(ys, ref[:, 1], rtol=1e-15, atol=1e-8)
+    lons2, lats2 = webMercToLonLatArrays(xs, ys)
+    ref = np.array([webMercToLonLat(x, y) for x, y in zip(xs, ys)])
+    assert np.allclose(lons2, ref[:, 0], rtol=1e-15, atol=1e-12)
+    assert np.allclose(lats2, ref[:, 1], rtol=1e-15, atol=1e-12)
+
+
+@pytest.mark.parametrize('crs1, crs2, bounds', [
+    (4326, 3857, (-180, -85, 180, 85)),
+    (4326, 32631, (0, 0, 6, 84)),
+    (4326, 32731, (0, -80, 6, 0))
+])
+def test_reprojArraysParity(builtin, crs1, crs2, bounds):
+    '''Reproj.arrays() against the scalar builtin path, in both directions'''
+    lons, lats = lonlats(*bounds, n=50) #under BUILTIN_ARRAYS_MIN_PTS, pts() uses the scalar functions
+    for c1, c2 in ((crs1, crs2), (crs2, crs1)):
+        rprj = Reproj(c1, c2)
+        assert rprj.iproj == 'BUILTIN'
+        xs, ys = rprj.arrays(lons, lats)
+        assert np.allclose(np.column_stack((xs, ys)), rprj.pts(list(zip(lons, lats))), rtol=1e-15, atol=1e-8)
+        lons, lats = xs, ys
+
+
+def approxCases():
+    cases = [
+        ('BUILTIN', 4326, 3857, (2, 45, 4, 47), 0.1),
+        ('BUILTIN', 4326, 3857, (2, 45, 4, 47), 1),
+        ('BUILTIN', 4326, 32631, (0, 40, 6, 50), 1),
+        ('BUILTIN', 3857, 4326, (2e5, 5.6e6, 4e5, 5.8e6), 1e-6)
+    ]
+    if HAS_PYPROJ:
+        cases += [
+            ('PYPROJ', 4326, 2154, (2, 45, 4, 47), 0.1),
+            ('PYPROJ', 2154, 4326, (600000, 6800000, 700000, 6900000), 1e-6)
+        ]
+    return cases
+
+
+@pytest.mark.parametrize('engine, crs1, crs2, bounds, maxErr', approxCases())
+def test_approxErrorBound(monkeypatch, engine, crs1, crs2, bounds, maxErr):
+    '''Interpolated points stay within maxErr of the exact transform, with far less exact evaluations'''
+    monkeypatch.setattr(settings, 'proj_engine', engine)
+    rprj = Reproj(crs1, crs2)
+    xs, ys = lonlats(*bounds, n=200000)
+    ex, ey = rprj.arrays(xs, ys)
+    approx = rprj.approx(maxErr)
+    ax, ay = approx.arrays(xs, ys)
+    stats = approx.stats
+    assert stats['cells'] > 0 and stats['fallbackPts'] < stats['points']
+    assert stats['exactPts'] < stats['points'] / 2
+    err = np.hypot(ax - ex, ay - ey).max()
+    assert err <= maxErr
+    assert stats['maxErr'] <= maxErr
+
+
+def test_approxFallback(builtin):
+    '''A tolerance the tree can not reach within its budget gives the exact results'''
+    rprj = Reproj(4326, 3857)
+    xs, ys = lonlats(2, 45, 4, 47, n=20000)
+    ex, ey = rprj.arrays(xs, ys)
+    approx = rprj.approx(1e-6)
+    ax, ay = approx.arrays(xs, ys)
+    assert approx.stats['fallbackPts'] == approx.stats['points']
+    assert np.array_equal(ax, ex) and np.array_equal(ay, ey)
+    #under APPROX_MIN_PTS, the exact transformer is used directly
+    ax, ay = approx.arrays(xs[:10], ys[:10])
+    assert approx.stats['gridPts'] == 0
+    assert np.array_equal(ax, ex[:10])
+
+
+@pytest.mark.parametrize('poolType', ['THREAD', 'PROCESS'])
+def test_reprojArraysPool(builtin, poolType):
+    '''Chunks reprojected by a pool of workers give the same results than a single transform'''
+    lons, lats = lonlats(0, 40, 6, 50, n=10000)
+    ref = Reproj(4326, 32631).arrays(lons, lats)
+    xs, ys = reprojArrays(4326, 32631, lons.reshape(100, 100), lats.reshape(100, 100), poolType=poolType, poolSize=2,
+        chunkSize=3000)
+    assert xs.shape == (100, 100)
+    assert np.array_equal(xs.ravel(), ref[0]) and np.array_equal(ys.ravel(), ref[1])
+
+
+@pytest.mark.parametrize('engine', ['PYPROJ', 'GDAL'])
+def test_reprojArraysThreads(monkeypatch, engine):
+    '''With thread safe engines, each worker thread reprojects its chunks with its own transformer'''
+    if not {'PYPROJ': HAS_PYPROJ, 'GDAL': HAS_GDAL}[engine]:
+        pytest.skip('{} is not installed'.format(engine))
+    monkeypatch.setattr(settings, 'proj_engine', engine)
+    monkeypatch.setattr(reproj, 'reprojCache', ReprojCache())
+    lons, lats = lonlats(0, 40, 6, 50, n=10000)
+    ref = Reproj(4326, 32631).arrays(lons, lats)
+    users = {} # {Reproj id : threads}
+    arrays = Reproj.arrays
+    def record(self, xs, ys):
+        users.setdefault(id(self), set()).add(threading.get_ident())
+        return arrays(self, xs, ys)
+    monkeypatch.setattr(Reproj, 'arrays', record)
+    xs, ys = reprojArrays(4326, 32631, lons, lats, poolType='THREAD', poolSize=4, chunkSize=500)
+    assert np.array_equal(xs, ref[0]) and np.array_equal(ys, ref[1])
+    assert len(users) > 1 and all(len(threads) == 1 for threads in users.values())
+    assert threading.get_ident() not in set.union(*users.values())
+
+
+def test_reprojCacheLRU(builtin):
+    cache = ReprojCache(maxSize=2)
+    a = cache.get(4326, 3857)
+    b = cache.get(3857, 4326)
+    assert cache.get('EPSG:4326', 3857) is a #same key for equivalent crs definitions
+    c = cache.get(4326, 32631) #evict the least recently used object
+    assert cache.stats == {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2, 'maxSize': 2}
+    assert cache.get(4326, 3857) is a and cache.get(4326, 32631) is c
+    assert cache.get(3857, 4326) is not b
+    assert cache.stats == {'hits': 3, 'misses': 4, 'evictions': 2, 'size': 2, 'maxSize': 2}
+    cache.clear()
+    assert cache.stats['size'] == 0
+
+
+def getInThreads(cache, crs1, crs2, n=4):
+    '''Get from n threads alive at the same time, so they don't reuse the identifier of a finished thread'''
+    results = [None] * n
+    barrier = threading.Barrier(n, timeout=5)
+    def get(i):
+        results[i] = cache.get(crs1, crs2)
+        barrier.wait()
+    threads = [threading.Thread(target=get, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_reprojCacheKeys(monkeypatch):
+    '''Builtin objects are shared by all threads, a change of engine gives another object'''
+    cache = ReprojCache()
+    monkeypatch.setattr(settings, 'proj_engine', 'BUILTIN')
+    rprj = cache.get(4326, 3857)
+    assert rprj.iproj == 'BUILTIN'
+    assert all(r is rprj for r in getInThreads(cache, 4326, 3857))
+    if not HAS_PYPROJ:
+        return
+    monkeypatch.setattr(settings, 'proj_engine', 'PYPROJ')
+    other = cache.get(4326, 3857)
+    assert other is not rprj and other.iproj == 'PYPROJ'
+    assert cache.get(4326, 3857) is other
+    #pyproj transformers are not thread safe, each thread gets its own instance
+    results = getInThreads(cache, 4326, 3857)
+    assert len(set(map(id, results + [other]))) == len(results) + 1
+    assert cache.stats['size'] == 2 + len(results)
+
+
+@pytest.mark.parametrize('engine', ['BUILTIN', 'PYPROJ'])
+def test_reprojCacheThreads(monkeypatch, engine):
+    '''Concurrent calls on a small cache keep it consistent and bounded'''
+    if engine == 'PYPROJ' and not HAS_PYPROJ:
+        pytest.skip('pyproj is not installed')
+    monkeypatch.setattr(settings, 'proj_engine', engine)
+    cache = ReprojCache(maxSize=3)
+    pairs = [(4326, 3857), (3857, 4326), (4326, 32631), (32631, 4326)]
+    nbThreads, nbCalls = 8, 50
+    errors = []
+    def run(i):
+        try:
+            for j in range(nbCalls):
+                crs1, crs2 = pairs[(i + j) % len(pairs)]
+                rprj = cache.get(crs1, crs2)
+                if crs1 == 4326:
+                    rprj.pt(2, 45)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(nbThreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    stats = cache.stats
+    assert stats['hits'] + stats['misses'] == nbThreads * nbCalls
+    assert stats['size'] <= 3
+    #two threads missing the same key both build it, the second one replaces the first
+    assert stats['misses'] - stats['evictions'] >= stats['size']
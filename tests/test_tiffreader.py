@@ -0,0 +1,168 @@
+import numpy as np
+
+import pytest
+from PIL import Image, features
+
+from core.georaster import TiffReader
+from core.georaster.tiffreader import sampleIndices
+
+tifffile = pytest.importorskip('tifffile')
+requiresLibtiff = pytest.mark.skipif(not features.check('libtiff'), reason='PIL compressed tiff encoders require libtiff')
+
+
+W, H = 97, 61 #odd sizes, the last strip and the edge tiles are partial
+
+DTYPES = {
+    'rgb': (np.uint8, 3),
+    'rgba': (np.uint8, 4),
+    'uint8': (np.uint8, 1),
+    'uint16': (np.uint16, 1),
+    'int32': (np.int32, 1),
+    'float32': (np.float32, 1),
+}
+
+
+def image(dtype, nbBands=1, w=W, h=H):
+    '''Smooth gradients with random noise, so the predictors matter and the lzw table gets full'''
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:h, 0:w]
+    shape = (h, w, nbBands) if nbBands > 1 else (h, w)
+    noise = rng.integers(0, 16, shape)
+    if nbBands > 1:
+        rows, cols = rows[:, :, None], cols[:, :, None] * np.arange(1, nbBands + 1)
+    if np.dtype(dtype).kind == 'f':
+        return (np.sin(rows / 10) * cols + noise / 16).astype(dtype)
+    info = np.iinfo(dtype)
+    return (rows * 37 + cols * 11 + noise).clip(info.min, info.max).astype(dtype)
+
+
+def savePIL(path, data, compression, predictor=1, rowsPerStrip=8):
+    tiffinfo = {278: rowsPerStrip}
+    if predictor != 1:
+        tiffinfo[317] = predictor
+    Image.fromarray(data).save(path, compression=compression, tiffinfo=tiffinfo)
+
+
+def check(path, data):
+    reader = TiffReader(path)
+    assert reader.size == (data.shape[1], data.shape[0])
+    out = reader.readWindow(0, 0, reader.width, reader.height)
+    assert out.dtype == data.dtype and np.array_equal(out, data)
+    return reader
+
+
+@requiresLibtiff
+@pytest.mark.parametrize('compression', ['raw', 'packbits', 'tiff_lzw', 'tiff_adobe_deflate'])
+@pytest.mark.parametrize('dtype', list(DTYPES))
+def test_pil(tmp_path, compression, dtype):
+    path = str(tmp_path / 'pil.tif')
+    data = image(*DTYPES[dtype])
+    savePIL(path, data, compression)
+    reader = check(path, data)
+    assert not reader.isTiled and reader.blockHeight == 8
+
+
+@requiresLibtiff
+@pytest.mark.parametrize('compression', ['tiff_lzw', 'tiff_adobe_deflate'])
+@pytest.mark.parametrize('dtype, predictor', [('rgb', 2), ('uint16', 2), ('int32', 2), ('float32', 3)])
+def test_pilPredictor(tmp_path, compression, dtype, predictor):
+    path = str(tmp_path / 'pil.tif')
+    data = image(*DTYPES[dtype])
+    savePIL(path, data, compression, predictor)
+    assert check(path, data).predictor == predictor
+
+
+@pytest.mark.parametrize('compression', [None, 'packbits', 'lzw', 'deflate', 'adobe_deflate'])
+@pytest.mark.parametrize('predictor', [False, True])
+@pytest.mark.parametrize('dtype', ['rgba', 'uint16', 'float32'])
+def test_tiled(tmp_path, compression, predictor, dtype):
+    '''Tiled files are written with tifffile, PIL can't write them. The predictor is floating point for floats'''
+    if predictor and compression is None:
+        pytest.skip('No predictor without compression')
+    data = image(*DTYPES[dtype])
+    path = str(tmp_path / 'tiled.tif')
+    tifffile.imwrite(path, data, tile=(32, 32), compression=compression, predictor=predictor)
+    reader = check(path, data)
+    assert reader.isTiled and (reader.nbBlocksX, reader.nbBlocksY) == (4, 2)
+    assert reader.predictor == (1 if not predictor else 3 if data.dtype.kind == 'f' else 2)
+
+
+@pytest.mark.parametrize('tile', [None, (16, 16)])
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_planar(tmp_path, tile, byteorder):
+    '''Bands stored in separate planes, little and big endian'''
+    data = image(np.uint16, 3)
+    path = str(tmp_path / 'planar.tif')
+    tifffile.imwrite(path, data.transpose(2, 0, 1), planarconfig='separate', photometric='rgb', tile=tile,
+        rowsperstrip=8, compression='deflate', predictor='horizontal', byteorder=byteorder)
+    reader = check(path, data)
+    assert reader.planar == 2 and reader.byteorder == byteorder
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_window(tmp_path, tiled):
+    data = image(np.uint8, 3, 200, 150)
+    path = str(tmp_path / 'window.tif')
+    if tiled:
+        tifffile.imwrite(path, data, tile=(64, 64), compression='deflate')
+    else:
+        tifffile.imwrite(path, data, rowsperstrip=16, compression='deflate')
+    reader = TiffReader(path)
+
+    #across block boundaries, inside a single block, single pixel, last pixel
+    for x, y, w, h in [(50, 10, 100, 90), (3, 4, 10, 5), (70, 33, 1, 1), (199, 149, 1, 1)]:
+        assert np.array_equal(reader.readWindow(x, y, w, h), data[y:y+h, x:x+w])
+    #clipped to the raster extent
+    assert np.array_equal(reader.readWindow(-10, -5, 50, 50), data[0:45, 0:40])
+    assert np.array_equal(reader.readWindow(180, 140, 50, 50), data[140:, 180:])
+    for x, y in [(200, 0), (0, 150), (-50, 0)]:
+        with pytest.raises(ValueError):
+            reader.readWindow(x, y, 50, 50)
+
+    #decimated, the sampled pixels are the nearest of the output pixels centers
+    for x, y, w, h, outSize in [(0, 0, 200, 150, (50, 30)), (17, 9, 120, 100, (7, 13)), (0, 0, 200, 150, (1, 1))]:
+        xs = x + sampleIndices(w, outSize[0])
+        ys = y + sampleIndices(h, outSize[1])
+        out = reader.readWindow(x, y, w, h, outSize=outSize)
+        assert out.shape == (outSize[1], outSize[0], 3)
+        assert np.array_equal(out, data[np.ix_(ys, xs)])
+    #an output size equal to the window is a plain read
+    assert np.array_equal(reader.readWindow(5, 5, 20, 10, outSize=(20, 10)), data[5:15, 5:25])
+
+
+def test_sampleIndices():
+    assert list(sampleIndices(8, 4)) == [1, 3, 5, 7]
+    assert list(sampleIndices(10, 3)) == [1, 5, 8]
+    assert list(sampleIndices(5, 5)) == [0, 1, 2, 3, 4]
+    assert list(sampleIndices(3, 6)) == [0, 0, 1, 1, 2, 2] #upsampling repeats pixels
+
+
+def test_memmap(tmp_path):
+    data = image(np.int32, 1, 300, 200)
+    path = str(tmp_path / 'raw.tif')
+    tifffile.imwrite(path, data, contiguous=True)
+    reader = TiffReader(path)
+    assert reader.isContiguous
+    assert np.array_equal(reader.memmap()[::7, ::3], data[::7, ::3])
+    xs, ys = np.arange(5, 300, 7), np.arange(0, 200, 3)
+    assert np.array_equal(reader.readSampled(xs, ys), data[np.ix_(ys, xs)])
+    tifffile.imwrite(path, data, compression='deflate')
+    reader = TiffReader(path)
+    assert not reader.isContiguous
+    assert np.array_equal(reader.readSampled(xs, ys), data[np.ix_(ys, xs)])
+    with pytest.raises(NotImplementedError):
+        reader.memmap()
+
+
+def test_unsupported(tmp_path):
+    path = str(tmp_path / 'out.tif')
+    tifffile.imwrite(path, image(np.uint8), bigtiff=True)
+    with pytest.raises(NotImplementedError):
+        TiffReader(path)
+    Image.fromarray(image(np.uint8, 3)).save(path, compression='jpeg')
+    with pytest.raises(NotImplementedError):
+        TiffReader(path)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+    with pytest.raises(IOError):
+        TiffReader(path)
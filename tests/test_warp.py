@@ -0,0 +1,162 @@
+import numpy as np
+
+import pytest
+
+from core.checkdeps import HAS_GDAL
+from core.georaster import GeoRef
+from core.georaster.warp import warp, resample
+from core.proj import SRS, reprojBbox
+from core.proj.reproj import reprojImgGrid, lonLatToWebMercArrays
+from core.utils import BBOX
+
+if HAS_GDAL:
+    from osgeo import gdal
+    from core.proj.reproj import reprojImg
+
+
+W, H = 60, 40
+
+
+def grid(w=W, h=H, origin=(0, H), res=1, crs=3857):
+    '''Georef of a w x h raster with its top left corner at origin'''
+    return GeoRef((w, h), (res, -res), origin, pxCenter=False, crs=SRS(crs))
+
+
+def linearField(w=W, h=H):
+    rows, cols = np.mgrid[0:h, 0:w]
+    return (3.5 * cols - 2 * rows + 100).astype(np.float64)
+
+
+@pytest.mark.parametrize('resamplAlg', ['BL', 'CB'])
+def test_linearExact(resamplAlg):
+    '''Bilinear and cubic kernels reproduce a linear field exactly, at any sub pixel position'''
+    data = linearField()
+    #output grid shifted by a third of pixel, cropped so that the cubic kernel stays inside the source
+    dx, dy = 1/3, 1/4
+    out, georef = warp(data, grid(), 3857, 3857, out_ul=(2 + dx, H - 2 - dy), out_size=(W - 5, H - 5), out_res=1,
+        resamplAlg=resamplAlg)
+    assert out.shape == (H - 5, W - 5)
+    rows, cols = np.mgrid[0:H-5, 0:W-5]
+    expected = 3.5 * (cols + 2 + dx) - 2 * (rows + 2 + dy) + 100
+    assert np.allclose(out, expected, atol=1e-9)
+    assert georef.origin == pytest.approx((2 + dx + 0.5, H - 2 - dy - 0.5))
+
+
+def test_halfPixelShift():
+    '''A half pixel shift in both directions gives the average of each 2x2 block of pixels'''
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 1000, (H, W))
+    out, _ = warp(data, grid(), 3857, 3857, out_ul=(0.5, H - 0.5), out_size=(W - 1, H - 1), out_res=1)
+    expected = (data[:-1, :-1] + data[:-1, 1:] + data[1:, :-1] + data[1:, 1:]) / 4
+    assert np.allclose(out, expected)
+    #nearest neighbor keeps the source values
+    out, _ = warp(data, grid(), 3857, 3857, out_ul=(0.25, H - 0.25), out_size=(W - 1, H - 1), out_res=1,
+        resamplAlg='NN')
+    assert np.array_equal(out, data[:-1, :-1])
+
+
+def test_webMercTo4326():
+    '''Warp a field linear in web mercator coordinates to geographic coordinates, against the analytic values'''
+    res = 100
+    xmin, ymax = 200000, 5800000
+    w, h = 400, 300
+    rows, cols = np.mgrid[0:h, 0:w]
+    xs, ys = xmin + (cols + 0.5) * res, ymax - (rows + 0.5) * res
+    data = (xs - xmin) / 50 + (ymax - ys) / 20
+    out, georef = warp(data, grid(w, h, (xmin, ymax), res), 3857, 4326, resamplAlg='BL')
+    h2, w2 = out.shape
+    assert (w2, h2) == tuple(georef.rSize)
+    lons = georef.origin.x + georef.pxSize.x * np.arange(w2)
+    lats = georef.origin.y + georef.pxSize.y * np.arange(h2)
+    lons, lats = np.meshgrid(lons, lats)
+    xs, ys = lonLatToWebMercArrays(lons, lats)
+    expected = (xs - xmin) / 50 + (ymax - ys) / 20
+    #output pixels fully inside the source extent, a bilinear resampling is exact on a linear field
+    inside = (xs > xmin + res) & (xs < xmin + (w - 1) * res) & (ys < ymax - res) & (ys > ymax - (h - 1) * res)
+    assert inside.sum() > 0.8 * inside.size
+    #tolerance : error of the approximate transformer (1/8 pixel) times the gradient
+    assert np.abs(out[inside] - expected[inside]).max() < res / 8 * np.hypot(1/50, 1/20)
+    assert np.all(out[~inside & ((xs < xmin) | (ys > ymax))] == 0)
+
+
+def test_resampleNodata():
+    '''Nodata source pixels are excluded from the kernels, areas without any valid pixel are flagged empty'''
+    data = np.full((4, 4, 1), 10.0)
+    data[:, 2:] = -9999
+    data[0, 0] = 20
+    cols = np.array([0.5, 1.5, 2.5, 0.0])
+    rows = np.array([0.5, 0.5, 0.5, 0.0])
+    values, empty = resample(data, cols, rows, 'BL', noData=-9999)
+    assert values[0, 0] == pytest.approx(12.5)
+    #the nodata column on the right is ignored
+    assert values[1, 0] == pytest.approx(10)
+    assert empty.tolist() == [False, False, True, False]
+    #masked arrays
+    mask = data[:, :, 0] == -9999
+    masked, maskedEmpty = resample(data, cols, rows, 'BL', mask=mask)
+    assert np.array_equal(masked[~empty], values[~empty]) and np.array_equal(maskedEmpty, empty)
+
+
+def test_warpNodata():
+    data = linearField()
+    data[10:20, 10:20] = -9999
+    out, _ = warp(data, grid(), 3857, 3857, out_ul=(0.5, H - 0.5), out_size=(W - 1, H - 1), out_res=1, noData=-9999)
+    #inside the hole, pixels get the nodata value, the edges are resampled from valid pixels only
+    assert np.all(out[10:19, 10:19] == -9999)
+    assert np.all(out[9, 9:20] > 0) and np.all(out[9:20, 9] > 0)
+    masked = np.ma.masked_equal(data, -9999)
+    out2, _ = warp(masked, grid(), 3857, 3857, out_ul=(0.5, H - 0.5), out_size=(W - 1, H - 1), out_res=1)
+    hole = out == -9999
+    assert np.allclose(out2[~hole], out[~hole]) and np.all(out2[hole] == 0)
+
+
+def test_alpha():
+    '''With an alpha band, transparent pixels do not bleed their color, outside pixels are transparent'''
+    data = np.zeros((H, W, 4), dtype=np.uint8)
+    data[:, :W//2] = (255, 0, 0, 255)
+    data[:, W//2:] = (0, 0, 255, 0)
+    #output pixels centers are half way between source pixels centers
+    out, _ = warp(data, grid(), 3857, 3857, out_ul=(-2.5, H), out_size=(W + 2, H), out_res=1)
+    edge = out[5, W//2 + 2]
+    assert tuple(edge[:3]) == (255, 0, 0) and edge[3] in (127, 128)
+    assert np.all(out[:, 0:2, 3] == 0)
+    assert np.all(out[:, 2:W//2 + 2, :] == (255, 0, 0, 255))
+
+
+def test_reprojImgGrid():
+    '''With only out_res, the output grid covers the reprojected bbox (the height was negative before)'''
+    bbox = BBOX(200000, 5600000, 240000, 5630000)
+    xmin, ymax, resx, resy, w, h = reprojImgGrid(3857, 4326, bbox, 400, 300, out_res=0.001)
+    _xmin, _ymin, _xmax, _ymax = reprojBbox(3857, 4326, bbox)
+    assert (resx, resy) == (0.001, -0.001)
+    assert w == int((_xmax - _xmin) / 0.001) and h == int((_ymax - _ymin) / 0.001)
+    assert w > 0 and h > 0
+    out, georef = warp(np.zeros((300, 400)), GeoRef((400, 300), (100, -100), (200000, 5630000), pxCenter=False),
+        3857, 4326, out_res=0.001)
+    assert out.shape == (h, w)
+    #size only, the source resolution is kept
+    assert reprojImgGrid(3857, 3857, bbox, 400, 300, out_size=(10, 20))[2:] == (100, -100, 10, 20)
+
+
+@pytest.mark.skipif(not HAS_GDAL, reason='GDAL is not available')
+@pytest.mark.parametrize('resamplAlg', ['NN', 'BL', 'CB'])
+def test_gdal(resamplAlg):
+    '''Compare with gdal.ReprojectImage on a smooth image, outside the extent edges'''
+    res, xmin, ymax = 100, 200000, 5800000
+    w, h = 400, 300
+    rows, cols = np.mgrid[0:h, 0:w]
+    data = (127 + 60 * np.sin(cols / 15) + 60 * np.cos(rows / 11)).astype(np.uint8)
+    ds = gdal.GetDriverByName('MEM').Create('', w, h, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((xmin, res, 0, ymax, 0, -res))
+    ds.GetRasterBand(1).WriteArray(data)
+    ref = reprojImg(3857, 4326, ds, resamplAlg=resamplAlg).GetRasterBand(1).ReadAsArray()
+    out, _ = warp(data, grid(w, h, (xmin, ymax), res), 3857, 4326, resamplAlg=resamplAlg)
+    assert out.shape == ref.shape
+    inner = (slice(3, -3), slice(3, -3))
+    diff = np.abs(out[inner].astype(int) - ref[inner].astype(int))
+    if resamplAlg == 'NN':
+        #both use an approximate transform, so the nearest pixel may differ, but only by a neighbor value
+        assert diff.max() <= 10
+    else:
+        assert np.percentile(diff, 99) <= 1
+    assert diff.mean() < 1
@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+'''
+Local stand-in tile server used by tests and benchmarks
+Serve a small png for any path, with optional latency and error injection
+'''
+
+import os
+import sys
+import time
+import zlib
+import struct
+import threading
+import http.server
+
+#make the addon core package importable from tests and benchmark scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def pngTile(size=256, color=(0, 128, 255)):
+    '''Return the bytes of a valid uniform rgb png'''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    row = b'\x00' + bytes(color) * size
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(row * size)) + chunk(b'IEND', b''))
+
+
+class TileServer():
+    """
+    Threaded http 1.1 server listening on localhost
+    latency : delay in seconds before each response
+    errors : list of http status codes returned by the next requests before serving the tile
+    slowEvery : every n requests, the response is delayed by slowLatency seconds (tail latency)
+    keepAlive : if false, the server close the connection after each response
+    colored : if true, each url gets its own tile color so that mosaics of different tiles can be compared
+    """
+
+    def __init__(self, latency=0, slowEvery=0, slowLatency=1, keepAlive=True, colored=False):
+        self.latency = latency
+        self.slowEvery = slowEvery
+        self.slowLatency = slowLatency
+        self.errors = []
+        self.tile = pngTile()
+        self.colored = colored
+        self.lock = threading.Lock()
+        self.nbRequests = 0
+        self.nbConnections = 0
+        self.times = [] #requests arrival times
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' if keepAlive else 'HTTP/1.0'
+            #send headers and body in a single write, like real servers, to avoid delayed ack stalls
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.nbConnections += 1
+
+            def do_GET(self):
+                with server.lock:
+                    server.nbRequests += 1
+                    server.times.append(time.perf_counter())
+                    n = server.nbRequests
+                    status = server.errors.pop(0) if server.errors else 200
+                delay = server.latency
+                if server.slowEvery and n % server.slowEvery == 0:
+                    delay = server.slowLatency
+                if delay:
+                    time.sleep(delay)
+                if status != 200:
+                    body = b'error'
+                elif server.colored:
+                    h = zlib.crc32(self.path.encode())
+                    body = pngTile(color=(h & 255, (h >> 8) & 255, (h >> 16) & 255))
+                else:
+                    body = server.tile
+                self.send_response(status)
+                self.send_header('Content-Type', 'image/png' if status == 200 else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()